@@ -3,13 +3,15 @@ API de Agentes Personalizados - SPHERE Backend.
 CRUD completo para gestionar agentes custom creados por el usuario.
 Incluye endpoints de templates para creación guiada.
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 from datetime import datetime, timezone
 import uuid
 
 from app.core.database import get_custom_agents_collection
+from app.core.agent_profiles import refresh_agent_profile
+from app.core.answer_warming import rewarm_agent
 from app.core.logger import api_logger as logger
 
 router = APIRouter()
@@ -96,7 +98,7 @@ async def get_agent_template(template_id: str):
 # --- Agent CRUD ---
 
 @router.post("/", response_model=CustomAgentResponse)
-async def create_custom_agent(agent_data: CustomAgentCreate):
+async def create_custom_agent(agent_data: CustomAgentCreate, background_tasks: BackgroundTasks):
     """Crea un nuevo agente con perfil de habilidades."""
     agent_id = str(uuid.uuid4())
 
@@ -117,6 +119,8 @@ async def create_custom_agent(agent_data: CustomAgentCreate):
         collection = get_custom_agents_collection()
         logger.info(f"Creando agente: {agent_id} - '{agent_data.identity.name}'")
         await collection.insert_one(new_agent)
+        # Perfil vectorial para el router de sesiones GROUP (fuera del request)
+        background_tasks.add_task(refresh_agent_profile, agent_id)
         return new_agent
     except Exception as e:
         logger.error(f"Error creando agente: {e}")
@@ -161,7 +165,7 @@ async def get_custom_agent(agent_id: str):
 
 
 @router.patch("/{agent_id}", response_model=CustomAgentResponse)
-async def update_custom_agent(agent_id: str, updates: CustomAgentUpdate):
+async def update_custom_agent(agent_id: str, updates: CustomAgentUpdate, background_tasks: BackgroundTasks):
     """Actualización parcial de un agente personalizado."""
     try:
         collection = get_custom_agents_collection()
@@ -192,6 +196,10 @@ async def update_custom_agent(agent_id: str, updates: CustomAgentUpdate):
 
         result.pop("_id", None)
         result.setdefault("documents_count", 0)
+        if updates.identity is not None or updates.brain_config is not None:
+            background_tasks.add_task(refresh_agent_profile, agent_id)
+        if updates.brain_config is not None:
+            background_tasks.add_task(rewarm_agent, agent_id)
         logger.info(f"Agente {agent_id} actualizado")
         return result
 
@@ -212,10 +220,13 @@ async def delete_custom_agent(agent_id: str):
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Agente no encontrado")
 
-        # Limpiar vectores de knowledge_base asociados
+        # Limpiar vectores de knowledge_base asociados (y del vector store local)
         from app.core.database import db
+        from app.core.document_processor import delete_agent_vectors
         async_db = db.get_async_db()
-        kb_del = await async_db["knowledge_base"].delete_many({"agent_target": agent_id})
+        deleted_vectors = await delete_agent_vectors(agent_id)
+        await async_db["warm_answers"].delete_many({"agent_key": agent_id})
+        await async_db["query_stats"].delete_many({"agent_key": agent_id})
 
         # Limpiar archivos de GridFS asociados
         try:
@@ -226,7 +237,7 @@ async def delete_custom_agent(agent_id: str):
         except Exception:
             pass  # GridFS puede no existir aún si no se han subido archivos
 
-        logger.info(f"Agente {agent_id} eliminado. Vectores limpiados: {kb_del.deleted_count}")
+        logger.info(f"Agente {agent_id} eliminado. Vectores limpiados: {deleted_vectors}")
         return {"status": "deleted", "agent_id": agent_id}
 
     except HTTPException:
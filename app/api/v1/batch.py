@@ -0,0 +1,197 @@
+"""
+API de Inferencia Batch - SPHERE Backend.
+Jobs asíncronos que ejecutan cientos de consultas JSONL contra el grafo
+(regresión de prompts, evaluación de templates, seeding de respuestas) y
+precalentado de respuestas frecuentes por agente.
+"""
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, BackgroundTasks, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from pymongo.errors import DuplicateKeyError
+
+from app.core.answer_warming import (
+    WARM_MIN_COUNT, WARM_TOP_N, get_warm_answers_collection, run_warming
+)
+
+from app.core.batch_runner import (
+    DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE, BatchInputError, load_items, run_batch
+)
+from app.core.database import db
+from app.core.logger import api_logger as logger
+
+router = APIRouter()
+
+MAX_BATCH_ITEMS = 2000
+
+
+def get_batch_jobs_collection():
+    return db.get_async_db()["batch_jobs"]
+
+
+def get_batch_results_collection():
+    return db.get_async_db()["batch_results"]
+
+
+async def run_batch_job(job_id: str):
+    """Ejecuta (o reanuda) un job: salta los items con resultado correcto y reintenta los fallidos."""
+    jobs_col = get_batch_jobs_collection()
+    results_col = get_batch_results_collection()
+
+    job = await jobs_col.find_one({"job_id": job_id})
+    if not job:
+        return
+
+    done_ids = {
+        doc["item_id"]
+        async for doc in results_col.find({"job_id": job_id, "result.status": "ok"}, {"item_id": 1})
+    }
+    await jobs_col.update_one(
+        {"job_id": job_id},
+        {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}}
+    )
+
+    async def sink(result: dict):
+        failed = int(result["status"] == "error")
+        try:
+            # Sustituye un resultado fallido de una ejecución anterior, nunca uno correcto
+            saved = await results_col.update_one(
+                {"job_id": job_id, "item_id": result["id"], "result.status": {"$ne": "ok"}},
+                {"$set": {"result": result, "created_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return  # Otro worker reanudó el mismo job y ya lo guardó con éxito
+        if saved.upserted_id is not None:
+            inc = {"completed": 1, "failed": failed}
+        else:
+            inc = {"failed": failed - 1}  # reintento de un item que ya contaba como fallido
+        await jobs_col.update_one({"job_id": job_id}, {"$inc": inc})
+
+    try:
+        summary = await run_batch(
+            job["items"],
+            sink,
+            concurrency=job.get("concurrency", DEFAULT_CONCURRENCY),
+            requests_per_minute=job.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE),
+            done_ids=done_ids,
+        )
+        await jobs_col.update_one(
+            {"job_id": job_id},
+            {"$set": {"status": "completed", "summary": summary, "finished_at": datetime.now(timezone.utc)}}
+        )
+    except Exception as e:
+        logger.error(f"Batch job {job_id} interrumpido: {e}", exc_info=True)
+        await jobs_col.update_one({"job_id": job_id}, {"$set": {"status": "interrupted", "error": str(e)}})
+
+
+def _job_response(job: dict) -> dict:
+    job.pop("_id", None)
+    job.pop("items", None)
+    return job
+
+
+@router.post("/")
+async def create_batch_job(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+):
+    """Crea un job batch a partir de un fichero JSONL y lo lanza en background."""
+    try:
+        items = load_items((await file.read()).decode("utf-8").splitlines())
+    except (BatchInputError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not items:
+        raise HTTPException(status_code=400, detail="El fichero no contiene consultas")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_BATCH_ITEMS} consultas por job")
+
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "status": "pending",
+        "total": len(items),
+        "completed": 0,
+        "failed": 0,
+        "concurrency": max(1, min(concurrency, 32)),
+        "requests_per_minute": requests_per_minute,
+        "items": items,
+        "created_at": datetime.now(timezone.utc)
+    }
+    await get_batch_jobs_collection().insert_one(job)
+    background_tasks.add_task(run_batch_job, job["job_id"])
+
+    logger.info(f"📦 Batch job {job['job_id']} creado: {len(items)} consultas")
+    return _job_response(dict(job))
+
+
+# --- PRECALENTADO DE RESPUESTAS ---
+
+class WarmRequest(BaseModel):
+    agents: Optional[List[str]] = None  # Default: todos los agentes con queries minadas
+    seeds: Dict[str, List[str]] = Field(default_factory=dict)  # {"CEO": ["¿Qué es SPHERE?"]}
+    top_n: int = Field(default=WARM_TOP_N, ge=1, le=200)
+    min_count: int = Field(default=WARM_MIN_COUNT, ge=1)
+
+
+@router.post("/warm")
+async def warm_answers(request: WarmRequest, background_tasks: BackgroundTasks):
+    """Lanza el job de precalentado (minado + semillas + entradas obsoletas)."""
+    background_tasks.add_task(
+        run_warming, request.agents, request.seeds, request.top_n, request.min_count
+    )
+    return {"status": "scheduled", "agents": request.agents, "seeded": sum(len(q) for q in request.seeds.values())}
+
+
+@router.get("/warm/stats")
+async def warm_answers_stats():
+    """Entradas precalentadas y aciertos por agente."""
+    pipeline = [
+        {"$group": {"_id": "$agent_key", "entries": {"$sum": 1}, "hits": {"$sum": "$hits"}}},
+        {"$sort": {"hits": -1}},
+    ]
+    stats = await get_warm_answers_collection().aggregate(pipeline).to_list(length=None)
+    return {"agents": [{"agent_key": s["_id"], "entries": s["entries"], "hits": s["hits"]} for s in stats]}
+
+
+@router.get("/{job_id}")
+async def get_batch_job(job_id: str):
+    """Estado y progreso de un job batch."""
+    job = await get_batch_jobs_collection().find_one({"job_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return _job_response(job)
+
+
+@router.post("/{job_id}/resume")
+async def resume_batch_job(job_id: str, background_tasks: BackgroundTasks):
+    """Reanuda un job interrumpido o con fallos (solo ejecuta los items sin resultado correcto)."""
+    job = await get_batch_jobs_collection().find_one({"job_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    if job["status"] == "completed" and not job.get("failed"):
+        raise HTTPException(status_code=409, detail="El job ya está completado")
+
+    background_tasks.add_task(run_batch_job, job_id)
+    return {"status": "resuming", "job_id": job_id, "completed": job.get("completed", 0), "total": job["total"]}
+
+
+@router.get("/{job_id}/results")
+async def stream_batch_results(job_id: str):
+    """Resultados del job en JSONL (streaming, en orden de finalización)."""
+    job = await get_batch_jobs_collection().find_one({"job_id": job_id}, {"job_id": 1})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+
+    async def generate():
+        cursor = get_batch_results_collection().find({"job_id": job_id}).sort("created_at", 1)
+        async for doc in cursor:
+            yield json.dumps(doc["result"], ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
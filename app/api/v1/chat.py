@@ -1,7 +1,7 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field, field_validator
 from typing import Optional
-from app.core.orchestrator import app as orchestrator_app
+from app.core.orchestrator import app as orchestrator_app, CHECKPOINT_DURABILITY
 from app.core.logger import api_logger as logger
 
 router = APIRouter()
@@ -38,7 +38,7 @@ async def chat_endpoint(request: ChatRequest):
             "query": request.query,
             "messages": [],
             "target_role": request.target_role,
-        })
+        }, durability=CHECKPOINT_DURABILITY)
 
         return ChatResponse(
             role=result["next_agent"],
@@ -8,7 +8,7 @@ from typing import List
 from datetime import datetime, timezone
 from pathlib import Path
 
-from app.core.database import get_custom_agents_collection, get_gridfs_bucket
+from app.core.database import get_custom_agents_collection, get_gridfs_bucket, get_sessions_collection
 from app.core.document_processor import (
     ALLOWED_EXTENSIONS, MAX_FILE_SIZE_MB, MAX_FILES_PER_AGENT,
     process_document, delete_document_vectors
@@ -163,7 +163,7 @@ async def get_document_status(agent_id: str, file_id: str):
 
 
 @router.delete("/{agent_id}/documents/{file_id}")
-async def delete_document(agent_id: str, file_id: str):
+async def delete_document(agent_id: str, file_id: str, background_tasks: BackgroundTasks):
     """Elimina un documento y todos sus vectores."""
     from bson import ObjectId
 
@@ -184,6 +184,12 @@ async def delete_document(agent_id: str, file_id: str):
     # Eliminar de GridFS
     await bucket.delete(ObjectId(file_id))
 
+    # Ninguna sesión puede seguir limitando su RAG a un archivo que ya no existe
+    await get_sessions_collection().update_many(
+        {"context_files.file_id": file_id},
+        {"$pull": {"context_files": {"file_id": file_id}}}
+    )
+
     # Decrementar documents_count
     agents_col = get_custom_agents_collection()
     await agents_col.update_one(
@@ -191,5 +197,9 @@ async def delete_document(agent_id: str, file_id: str):
         {"$inc": {"documents_count": -1}}
     )
 
+    # La muestra de KB del perfil vectorial y las respuestas precalentadas pueden haber cambiado
+    from app.core.document_processor import refresh_agent_knowledge
+    background_tasks.add_task(refresh_agent_knowledge, agent_id)
+
     logger.info(f"Documento {file_id} eliminado. Vectores: {deleted_vectors}")
     return {"status": "deleted", "file_id": file_id, "vectors_deleted": deleted_vectors}
@@ -3,7 +3,7 @@ Health Check Endpoint - SPHERE Backend.
 Verifica el estado del servicio y la conexión a MongoDB.
 """
 from fastapi import APIRouter
-from typing import Dict
+from typing import Dict, Optional
 
 from app.core.database import db
 from app.core.logger import api_logger as logger
@@ -11,6 +11,64 @@ from app.core.logger import api_logger as logger
 router = APIRouter()
 
 
+def _checkpoint_cache_stats() -> Optional[Dict]:
+    """Hit rate de la caché de checkpoints (None si el orquestador no está cargado)."""
+    try:
+        from app.core.orchestrator import checkpointer
+        return checkpointer.cache_stats()
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener métricas de la caché de checkpoints: {e}")
+        return None
+
+
+def _checkpoint_write_stats() -> Optional[Dict]:
+    """Escrituras de checkpoint y latencia media de turno por modo de durabilidad."""
+    try:
+        from app.core.orchestrator import checkpointer, CHECKPOINT_DURABILITY
+        from app.core.checkpointing import turn_stats
+        return {"durability": CHECKPOINT_DURABILITY, **checkpointer.write_stats, "turns": turn_stats()}
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener métricas de escritura de checkpoints: {e}")
+        return None
+
+
+def _embedding_cache_stats() -> Optional[Dict]:
+    """Hit rate de la caché de embeddings de queries, de frases (compresión) y de resultados del RAG."""
+    try:
+        from app.core.embedding_cache import embedding_cache
+        from app.core.rag import query_batcher, sentence_batcher, sentence_cache
+        from app.core.retrieval_cache import retrieval_cache
+        return {
+            **embedding_cache.stats(),
+            "batching": query_batcher.stats(),
+            "sentences": {**sentence_cache.stats(), "batching": sentence_batcher.stats()},
+            "results": retrieval_cache.stats(),
+        }
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener métricas de la caché de embeddings: {e}")
+        return None
+
+
+def _vector_store_stats() -> Optional[Dict]:
+    """Backend vectorial activo y sus métricas."""
+    try:
+        from app.core.vector_store import get_vector_store, knowledge_stats
+        return {**get_vector_store().stats(), "knowledge_stats": knowledge_stats.stats()}
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener métricas del vector store: {e}")
+        return None
+
+
+def _session_retrieval_stats() -> Optional[Dict]:
+    """Turnos que reutilizaron la recuperación del turno anterior de su sesión."""
+    try:
+        from app.core.session_retrieval import session_memory
+        return session_memory.stats()
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener métricas de la memoria RAG de sesión: {e}")
+        return None
+
+
 @router.get("/health", tags=["Health"])
 async def health_check() -> Dict:
     """
@@ -30,7 +88,12 @@ async def health_check() -> Dict:
         "service": "SPHERE Orchestrator",
         "database": db_status["status"],
         "latency_ms": db_status.get("latency_ms"),
-        "collections": db_status.get("collections", [])
+        "collections": db_status.get("collections", []),
+        "checkpoint_cache": _checkpoint_cache_stats(),
+        "checkpoint_writes": _checkpoint_write_stats(),
+        "embedding_cache": _embedding_cache_stats(),
+        "vector_store": _vector_store_stats(),
+        "rag_sessions": _session_retrieval_stats()
     }
     
     logger.info(f"Health check: {db_status['status']}")
@@ -10,6 +10,7 @@ import uuid
 
 from app.core.database import get_sessions_collection, get_custom_agents_collection
 from app.core.logger import api_logger as logger
+from app.models.session import AttachContextFileRequest, ForkSessionRequest
 
 # Roles de agentes core (no custom)
 CORE_AGENT_IDS = {"CEO", "CTO", "CFO", "CMO", "system", "group-chat"}
@@ -51,6 +52,8 @@ class SessionBase(BaseModel):
     context_files: List[ContextFile] = []
     enabled_tools: List[str] = []
     members: List[str] = []  # List of agent IDs in the group
+    parent_session_id: Optional[str] = None  # Sesión de la que se hizo fork
+    forked_from_checkpoint_id: Optional[str] = None  # Checkpoint padre del fork
     created_at: datetime
 
 
@@ -97,6 +100,7 @@ async def create_session(request: CreateSessionRequest):
         "context_files": [], 
         "enabled_tools": request.enabled_tools or [],
         "members": request.members or [],
+        "started": False,  # Pasa a True en el primer turno (stream.mark_session_started)
         "created_at": datetime.now(timezone.utc)
     }
     
@@ -182,6 +186,141 @@ async def get_session_history(session_id: str):
         }
 
 
+@router.post("/{session_id}/regenerate")
+async def regenerate_last_response(session_id: str, include_reasoning: bool = False):
+    """
+    Regenera la última respuesta del agente (SSE).
+
+    Rebobina el thread de LangGraph al checkpoint previo a la última respuesta
+    y re-ejecuta solo el nodo experto, reutilizando la decisión del router y
+    el contexto RAG: una sola llamada al LLM y sin duplicar el HumanMessage.
+    """
+    from fastapi.responses import StreamingResponse
+    from app.api.v1.stream import prepare_regeneration, generate_regeneration_events, SSE_HEADERS
+
+    sessions_collection = get_sessions_collection()
+    session_doc = await sessions_collection.find_one({"session_id": session_id})
+    if not session_doc:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+    try:
+        prepared = await prepare_regeneration(session_id)
+    except Exception as e:
+        logger.error(f"Error preparando regeneración para {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error al regenerar: {str(e)}")
+
+    if not prepared:
+        raise HTTPException(status_code=409, detail="No hay ninguna respuesta que regenerar")
+
+    resume_config, role = prepared
+    logger.info(f"Regenerando última respuesta de la sesión {session_id} ({role})")
+    return StreamingResponse(
+        generate_regeneration_events(session_id, resume_config, role, include_reasoning),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
+@router.get("/{session_id}/reasoning/{message_id}")
+async def get_message_reasoning(session_id: str, message_id: str):
+    """
+    Razonamiento de una respuesta de un modelo r1 (mensajes con has_reasoning).
+    No forma parte del historial: se guarda aparte si REASONING_STORAGE=separate.
+    """
+    from app.core.reasoning import get_reasoning_collection
+
+    # Los forks heredan mensajes del padre: se recorre la cadena de sesiones
+    doc, current = None, session_id
+    while current and not doc:
+        doc = await get_reasoning_collection().find_one(
+            {"session_id": current, "message_id": message_id}, {"_id": 0}
+        )
+        if not doc:
+            session_doc = await get_sessions_collection().find_one(
+                {"session_id": current}, {"parent_session_id": 1}
+            )
+            current = (session_doc or {}).get("parent_session_id")
+    if not doc:
+        raise HTTPException(status_code=404, detail="Razonamiento no disponible")
+    return doc
+
+
+# --- FORKS ---
+
+@router.get("/{session_id}/checkpoints")
+async def list_session_checkpoints(session_id: str, limit: int = 20):
+    """Lista los checkpoints de una sesión (más reciente primero) para elegir desde dónde hacer fork."""
+    from app.core.orchestrator import app as orchestrator_app
+
+    config = {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
+    checkpoints = []
+    async for snapshot in orchestrator_app.aget_state_history(config, limit=limit):
+        values = snapshot.values or {}
+        checkpoints.append({
+            "checkpoint_id": snapshot.config["configurable"].get("checkpoint_id"),
+            "created_at": snapshot.created_at,
+            "step": (snapshot.metadata or {}).get("step"),
+            "next": list(snapshot.next),
+            "messages_count": len(values.get("messages", [])),
+        })
+    return {"session_id": session_id, "checkpoints": checkpoints}
+
+
+@router.post("/{session_id}/fork", response_model=SessionBase)
+async def fork_session(session_id: str, request: ForkSessionRequest):
+    """
+    Crea una rama de la conversación a partir de cualquier checkpoint.
+
+    Copy-on-write: el thread nuevo solo guarda una referencia al checkpoint
+    padre (O(1) en almacenamiento y tiempo, independientemente de la longitud
+    del historial). Las lecturas se resuelven por la cadena de padres.
+    """
+    from app.core.orchestrator import checkpointer
+
+    sessions_collection = get_sessions_collection()
+    parent = await sessions_collection.find_one({"session_id": session_id})
+    if not parent:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+    try:
+        checkpoint_id = await checkpointer.aresolve_checkpoint_id(session_id, request.checkpoint_id)
+        if not checkpoint_id:
+            raise HTTPException(status_code=404, detail="Checkpoint no encontrado en esta sesión")
+
+        fork_id = str(uuid.uuid4())
+        await checkpointer.aregister_fork(fork_id, session_id, checkpoint_id)
+
+        new_session = {
+            "session_id": fork_id,
+            "user_id": parent.get("user_id", "default_user"),
+            "title": request.title or f"{parent.get('title', 'Sesión')} (rama)",
+            "base_agent_id": parent.get("base_agent_id", "CEO"),
+            "agent_ref_type": parent.get("agent_ref_type", "core"),
+            "type": parent.get("type", SessionType.DIRECT),
+            "visual_config": parent.get("visual_config", {}),
+            "context_files": parent.get("context_files", []),
+            "enabled_tools": parent.get("enabled_tools", []),
+            "members": parent.get("members", []),
+            "folder": parent.get("folder"),
+            "tags": parent.get("tags", []),
+            "parent_session_id": session_id,
+            "forked_from_checkpoint_id": checkpoint_id,
+            "started": True,  # Hereda el historial del padre
+            "created_at": datetime.now(timezone.utc)
+        }
+        await sessions_collection.insert_one(new_session)
+        new_session.pop("_id", None)
+
+        logger.info(f"Fork creado: {session_id}@{checkpoint_id} -> {fork_id}")
+        return new_session
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creando fork de {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error al crear fork: {str(e)}")
+
+
 class UpdateSessionRequest(BaseModel):
     title: Optional[str] = None
     visual_config: Optional[VisualConfig] = None
@@ -257,15 +396,23 @@ async def delete_session(session_id: str):
             logger.warning(f"Sesión no encontrada: {session_id}")
             raise HTTPException(status_code=404, detail="Sesión no encontrada")
 
-        # Limpiar checkpoints de LangGraph asociados al thread_id
-        from app.core.database import db
-        async_db = db.get_async_db()
-        checkpoints_del = await async_db["checkpoints"].delete_many({"thread_id": session_id})
-        writes_del = await async_db["checkpoint_writes"].delete_many({"thread_id": session_id})
-        logger.info(
-            f"Sesión {session_id} eliminada. "
-            f"Checkpoints limpiados: {checkpoints_del.deleted_count} checkpoints, {writes_del.deleted_count} writes"
-        )
+        # Los forks de esta sesión leen su historial compartido a través de
+        # estos checkpoints: solo se limpian si ningún fork depende de ellos.
+        # Al borrar un fork se recogen también los padres ya eliminados cuyos
+        # checkpoints solo se conservaban por él.
+        from app.core.orchestrator import checkpointer
+
+        async def has_session(thread_id: str) -> bool:
+            return await sessions_collection.find_one({"session_id": thread_id}, {"_id": 1}) is not None
+
+        released = await checkpointer.arelease_thread(session_id, has_session)
+        if not released:
+            logger.info(f"Sesión {session_id} eliminada. Checkpoints conservados: tiene forks dependientes")
+            return {"status": "deleted", "session_id": session_id}
+
+        from app.core.reasoning import get_reasoning_collection
+        await get_reasoning_collection().delete_many({"session_id": {"$in": released}})
+        logger.info(f"Sesión {session_id} eliminada. Checkpoints limpiados de los threads: {released}")
 
         return {"status": "deleted", "session_id": session_id}
 
@@ -276,6 +423,68 @@ async def delete_session(session_id: str):
         raise HTTPException(status_code=500, detail=f"Error al eliminar sesión: {str(e)}")
 
 
+# --- CONTEXT FILES ---
+
+@router.post("/{session_id}/context-files", response_model=List[ContextFile])
+async def attach_context_file(session_id: str, request: AttachContextFileRequest):
+    """
+    Añade un documento ya procesado al contexto de la sesión. Desde ese turno
+    el RAG busca solo en los archivos de contexto (pre-filtro por
+    source_file_id en el índice vectorial): no se re-vectoriza nada.
+    """
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    from app.core.database import get_gridfs_bucket
+    from app.core.vector_store import ATLAS_INDEX_NAME
+
+    sessions_collection = get_sessions_collection()
+    session_doc = await sessions_collection.find_one({"session_id": session_id})
+    if not session_doc:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+    try:
+        grid_file = await get_gridfs_bucket()._files.find_one({"_id": ObjectId(request.file_id)})
+    except InvalidId:
+        grid_file = None
+    if not grid_file:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+
+    meta = grid_file.get("metadata", {})
+    owners = {session_doc.get("base_agent_id"), *session_doc.get("members", [])}
+    if meta.get("agent_id") not in owners:
+        raise HTTPException(status_code=404, detail="Documento no pertenece a los agentes de esta sesión")
+    if meta.get("processing_status") != "completed":
+        raise HTTPException(status_code=409, detail="El documento aún no está procesado")
+
+    context_file = ContextFile(
+        file_id=request.file_id, name=grid_file.get("filename", request.file_id), vector_index_id=ATLAS_INDEX_NAME
+    )
+    # Idempotente: solo se añade si no estaba ya
+    await sessions_collection.update_one(
+        {"session_id": session_id, "context_files.file_id": {"$ne": request.file_id}},
+        {"$push": {"context_files": context_file.model_dump()}},
+    )
+    doc = await sessions_collection.find_one({"session_id": session_id}, {"context_files": 1})
+    logger.info(f"📎 Archivo {request.file_id} añadido al contexto de la sesión {session_id}")
+    return doc.get("context_files", [])
+
+
+@router.delete("/{session_id}/context-files/{file_id}", response_model=List[ContextFile])
+async def detach_context_file(session_id: str, file_id: str):
+    """Quita un archivo del contexto de la sesión (sin tocar sus vectores)."""
+    sessions_collection = get_sessions_collection()
+    doc = await sessions_collection.find_one_and_update(
+        {"session_id": session_id},
+        {"$pull": {"context_files": {"file_id": file_id}}},
+        projection={"context_files": 1},
+        return_document=True,
+    )
+    if not doc:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    logger.info(f"📎 Archivo {file_id} retirado del contexto de la sesión {session_id}")
+    return doc.get("context_files", [])
+
+
 # --- PINS ---
 
 class PinRequest(BaseModel):
@@ -9,14 +9,19 @@ Eventos:
 - artifact_open: Abre una tarjeta nueva en el frontend
 - artifact_chunk: Envía contenido progresivamente (efecto hacker)
 - artifact_close: Finaliza el artefacto y habilita descarga
+- reasoning: Razonamiento de modelos r1 (solo si include_reasoning=true)
 """
 import json
 import re
-from typing import Optional
+import time
+from typing import AsyncIterator, List, Optional
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTasks
 from pydantic import BaseModel, Field
-from app.core.orchestrator import app as orchestrator_app
+from app.core.orchestrator import app as orchestrator_app, CHECKPOINT_DURABILITY
+from app.core.checkpointing import track_turn_writes, record_turn
+from app.core.turn_context import TurnContext, get_turn_context, prefetch_turn
 from app.core.logger import stream_logger as logger
 
 router = APIRouter()
@@ -25,44 +30,213 @@ class StreamRequest(BaseModel):
     query: str = Field(..., min_length=1, max_length=10_000)
     session_id: str  # <--- OBLIGATORIO AHORA
     target_role: Optional[str] = None  # Para chats privados
+    include_reasoning: bool = False  # Emitir eventos 'reasoning' (modelos r1)
 
 # Regex para validar y parsear la etiqueta de apertura
 OPEN_TAG_PATTERN = re.compile(r'<sphere_artifact\s+([^>]+)>')
 
-async def generate_chat_events(query: str, session_id: str, target_role: Optional[str] = None):
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"
+}
+
+
+async def generate_chat_events(
+    query: str,
+    session_id: str,
+    target_role: Optional[str] = None,
+    members: Optional[List[str]] = None,
+    include_reasoning: bool = False,
+    agent: Optional[dict] = None,
+    file_ids: Optional[List[str]] = None,
+):
     """
     Generador asíncrono que escucha los eventos del grafo 
     y envía chunks formateados para SSE.
+
+    `agent`: documento del agente custom si el endpoint ya lo leyó (se
+    reutiliza en el router en lugar de volver a consultarlo).
+    `file_ids`: context_files de la sesión (el RAG busca solo en esos archivos).
+    """
+    logger.info(f"Iniciando stream para sesión: {session_id} | Query: '{query[:50]}...'")
+
+    # Configuración del thread para memoria (LangGraph Checkpointer)
+    config = {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
+
+    # 1. Preparar el nuevo mensaje humano
+    from langchain_core.messages import HumanMessage
+    new_message = HumanMessage(content=query)
+
+    # 2. Estado inicial. LangGraph añadirá new_message al historial
+    # gracias a Annotated[List, add_messages] en AgentState.
+    initial_state = {
+        "query": query, 
+        "messages": [new_message],
+        "target_role": target_role,
+        "members": members or [],
+        "rag_files": file_ids or [],
+    }
+
+    # 3. Prefetch en paralelo (agente, embedding, búsqueda vectorial) mientras
+    # LangGraph carga el checkpoint; las tareas se cancelan al salir
+    async with TurnContext(
+        query, target_role, rag_role=target_role, session_id=session_id, file_ids=file_ids
+    ) as turn_ctx:
+        prefetch_turn(turn_ctx, members=members, agent=agent)
+        config["configurable"]["turn_context"] = turn_ctx
+
+        async for event in _stream_graph_events(initial_state, config, session_id, include_reasoning):
+            yield event
+
+
+WARM_CHUNK_CHARS = 48
+
+
+async def generate_warm_events(query: str, session_id: str, target_role: str, warm: dict):
+    """
+    Sirve una respuesta precalentada con la misma forma de eventos que el
+    grafo (meta + tokens/artefactos + [DONE]) y la registra en el checkpoint
+    como si el experto acabara de responder, para que la conversación siga.
+    """
+    from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+    from app.core.answer_warming import WARM_STATE_KEYS
+
+    config = {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
+    state = warm.get("state") or {}
+    role = state.get("next_agent") or target_role
+    answer = warm["answer"]
+
+    logger.info(f"🔥 Respuesta precalentada para sesión {session_id} ({target_role}): '{query[:50]}'")
+    await orchestrator_app.aupdate_state(
+        config,
+        {
+            # Solo claves vigentes del estado (un documento antiguo puede traer otras)
+            **{k: v for k, v in state.items() if k in WARM_STATE_KEYS},
+            "query": query,
+            "target_role": target_role,
+            "final_response": answer,
+            "messages": [
+                HumanMessage(content=query),
+                AIMessage(content=answer, additional_kwargs={"agent_role": role, "warm_cache": True}),
+            ],
+        },
+        as_node="expert_agent",
+    )
+
+    async def warm_events():
+        yield {"event": "on_chain_end", "name": "router", "data": {"output": {"next_agent": role}}}
+        for i in range(0, len(answer), WARM_CHUNK_CHARS):
+            chunk = AIMessageChunk(content=answer[i:i + WARM_CHUNK_CHARS])
+            yield {"event": "on_chat_model_stream", "name": "warm_cache", "data": {"chunk": chunk}}
+
+    async for event in _stream_graph_events(None, config, session_id, events=warm_events()):
+        yield event
+
+
+async def prepare_regeneration(session_id: str) -> Optional[tuple]:
+    """
+    Rebobina el thread al checkpoint previo a la última respuesta del experto.
+
+    Reutiliza la decisión del router y el contexto RAG ya recuperado, de modo
+    que regenerar cuesta una sola llamada al LLM y no duplica el HumanMessage.
+
+    Returns:
+        (config del checkpoint desde el que reanudar, rol) o None si no hay
+        respuesta que regenerar.
+    """
+    from langchain_core.messages import HumanMessage, RemoveMessage
+
+    config = {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
+    head = await orchestrator_app.aget_state(config)
+    values = head.values or {}
+    messages = values.get("messages", [])
+
+    human_indexes = [i for i, msg in enumerate(messages) if isinstance(msg, HumanMessage)]
+    if not human_indexes or human_indexes[-1] == len(messages) - 1:
+        return None
+    last_human = human_indexes[-1]
+
+    # Recuperación de la última respuesta: se inyecta en el checkpoint rebobinado
+    reuse = {
+        "rag_query": values.get("rag_query"),
+        "rag_role": values.get("rag_role"),
+        "rag_refs": values.get("rag_refs"),
+        "rag_scope": values.get("rag_scope"),
+    }
+
+    # 1. Buscar el checkpoint tras el router y antes del experto (del último turno)
+    async for snapshot in orchestrator_app.aget_state_history(config):
+        snapshot_messages = (snapshot.values or {}).get("messages", [])
+        if (
+            snapshot.next == ("expert_agent",)
+            and len(snapshot_messages) == last_human + 1
+            and isinstance(snapshot_messages[-1], HumanMessage)
+        ):
+            logger.info(f"⏪ Regenerando desde checkpoint {snapshot.config['configurable'].get('checkpoint_id')}")
+            resume_config = await orchestrator_app.aupdate_state(snapshot.config, reuse, as_node="router")
+            return resume_config, snapshot.values.get("next_agent")
+
+    # 2. Fallback (sin checkpoint intermedio): retirar las respuestas del
+    # último turno del historial y reanudar como si el router acabara de decidir
+    logger.info("⏪ Sin checkpoint previo al experto, regenerando sobre el último estado")
+    removals = [RemoveMessage(id=msg.id) for msg in messages[last_human + 1:]]
+    resume_config = await orchestrator_app.aupdate_state(
+        config, {**reuse, "messages": removals}, as_node="router"
+    )
+    return resume_config, values.get("next_agent")
+
+
+async def generate_regeneration_events(
+    session_id: str,
+    resume_config: dict,
+    role: Optional[str],
+    include_reasoning: bool = False,
+):
+    """Stream SSE de una regeneración: solo se re-ejecuta el nodo experto."""
+    if role:
+        yield f"data: {json.dumps({'type': 'meta', 'role': role})}\n\n"
+
+    # input=None: LangGraph reanuda desde el checkpoint indicado en la config
+    async for event in _stream_graph_events(None, resume_config, session_id, include_reasoning):
+        yield event
+
+
+async def _stream_graph_events(
+    graph_input: Optional[dict],
+    config: dict,
+    session_id: str,
+    include_reasoning: bool = False,
+    events: Optional[AsyncIterator[dict]] = None,
+):
+    """
+    Ejecuta el grafo y traduce sus eventos a SSE (tokens, tools, artefactos).
+    El razonamiento de modelos r1 nunca se mezcla con los tokens de respuesta:
+    se emite como evento 'reasoning' si el cliente lo pide, o se omite.
+
+    `events` permite alimentar el parser con eventos ya generados (respuestas
+    precalentadas) en lugar de ejecutar el grafo.
     """
     try:
-        logger.info(f"Iniciando stream para sesión: {session_id} | Query: '{query[:50]}...'")
-        
-        # Configuración del thread para memoria (LangGraph Checkpointer)
-        config = {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
-        
-        # 1. Preparar el nuevo mensaje humano
-        from langchain_core.messages import HumanMessage
-        new_message = HumanMessage(content=query)
-        
-        # 2. Estado inicial. LangGraph añadirá new_message al historial
-        # gracias a Annotated[List, add_messages] en AgentState.
-        initial_state = {
-            "query": query, 
-            "messages": [new_message],
-            "target_role": target_role
-        }
-        
         # Variables de estado para el parser de baja latencia
         buffer = ""
         artifact_buffer = ""  # Buffer específico para contenido dentro de artefactos
         is_inside_artifact = False
 
         # Escuchar eventos del grafo (v1 es la API estable de eventos)
-        async for event in orchestrator_app.astream_events(
-            initial_state, 
-            config=config, # <--- LA CLAVE DE LA MEMORIA
-            version="v1"
-        ):
+        turn_writes = None
+        turn_ctx = get_turn_context(config)
+        if events is None:
+            turn_start = time.perf_counter()
+            turn_writes = track_turn_writes()
+            events = orchestrator_app.astream_events(
+                graph_input,
+                config=config, # <--- LA CLAVE DE LA MEMORIA
+                version="v1",
+                durability=CHECKPOINT_DURABILITY
+            )
+
+        async for event in events:
             kind = event["event"]
             
             # --- A. DETECCIÓN DE ROL (Router) ---
@@ -89,7 +263,13 @@ async def generate_chat_events(query: str, session_id: str, target_role: Optiona
             # --- C. STREAMING DE TOKENS ---
             if kind == "on_chat_model_stream":
                 chunk = event.get("data", {}).get("chunk")
+                if turn_ctx and "ttft" not in turn_ctx.timings and chunk and chunk.content:
+                    turn_ctx.timings["ttft"] = round(turn_ctx.elapsed_ms(), 1)
                 if chunk and hasattr(chunk, 'content'):
+                    reasoning = chunk.additional_kwargs.get("reasoning_content")
+                    if reasoning and include_reasoning:
+                        yield f"data: {json.dumps({'type': 'reasoning', 'content': reasoning})}\n\n"
+
                     content = chunk.content
                     if not content:
                         continue
@@ -173,6 +353,16 @@ async def generate_chat_events(query: str, session_id: str, target_role: Optiona
         
         if buffer.strip():
             yield f"data: {json.dumps({'type': 'token', 'content': buffer})}\n\n"
+
+        if turn_writes is not None:
+            elapsed_ms = (time.perf_counter() - turn_start) * 1000
+            record_turn(CHECKPOINT_DURABILITY, elapsed_ms, turn_writes)
+            logger.info(
+                f"⏱️ Turno {session_id}: {elapsed_ms:.0f}ms | durability={CHECKPOINT_DURABILITY} | "
+                f"checkpoints={turn_writes['checkpoints']} writes={turn_writes['writes']}"
+            )
+        if turn_ctx:
+            logger.info(f"⏱️ Etapas {session_id}: {turn_ctx.summary()}")
         
         yield "data: [DONE]\n\n"
         logger.info(f"Stream finalizado para sesión: {session_id}")
@@ -185,6 +375,14 @@ async def generate_chat_events(query: str, session_id: str, target_role: Optiona
         yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
         yield "data: [DONE]\n\n"
 
+async def mark_session_started(session_id: str) -> None:
+    """Marca la sesión como iniciada (una sola escritura en toda su vida)."""
+    from app.core.database import get_sessions_collection
+    await get_sessions_collection().update_one(
+        {"session_id": session_id, "started": {"$ne": True}}, {"$set": {"started": True}}
+    )
+
+
 @router.post("/")
 async def chat_stream_endpoint(request: StreamRequest):
     """Endpoint SSE para streaming de respuestas."""
@@ -195,13 +393,18 @@ async def chat_stream_endpoint(request: StreamRequest):
         session_doc = await sessions_collection.find_one({"session_id": request.session_id})
 
         final_target_role = request.target_role
+        members = []
+        agent = None
+        # Archivos de contexto de la sesión: pre-filtro del RAG por source_file_id
+        file_ids = [f["file_id"] for f in (session_doc or {}).get("context_files", []) if f.get("file_id")]
 
         if not final_target_role and session_doc:
             session_type = session_doc.get("type", "direct")
             if session_type == "group":
                 # Sesiones GROUP: dejar target_role en None para que el router clasifique
                 final_target_role = None
-                logger.debug("Sesión GROUP detectada: router clasificará la consulta")
+                members = session_doc.get("members", [])
+                logger.debug(f"Sesión GROUP detectada: router clasificará la consulta ({len(members)} miembros)")
             else:
                 # Sesiones DIRECT: resolver según tipo de agente
                 agent_ref_type = session_doc.get("agent_ref_type", "core")
@@ -220,14 +423,41 @@ async def chat_stream_endpoint(request: StreamRequest):
                 final_target_role = base_agent_id
                 logger.debug(f"Sesión DIRECT ({agent_ref_type}): target_role={final_target_role}")
 
+        # Primer turno: lo dice el flag `started` de la sesión (ya leída), sin
+        # consultar el checkpointer. Sesiones anteriores al flag (o sin
+        # documento) lo averiguan una vez con el último checkpoint
+        background = BackgroundTasks()
+        started = (session_doc or {}).get("started")
+        if session_doc is not None and started is not True:
+            background.add_task(mark_session_started, request.session_id)
+
+        # Primer turno de una sesión con agente fijo: candidata a respuesta
+        # precalentada (y se contabiliza para el minado de queries frecuentes).
+        # Con context_files no: la respuesta precalentada sale de toda la KB
+        if final_target_role and not members and not file_ids:
+            if started is None:
+                from app.core.orchestrator import checkpointer
+                started = await checkpointer.aresolve_checkpoint_id(request.session_id) is not None
+            if not started:
+                from app.core.answer_warming import lookup_warm_answer, record_first_turn
+                background.add_task(record_first_turn, final_target_role, request.query)
+                warm = await lookup_warm_answer(final_target_role, request.query)
+                if warm:
+                    return StreamingResponse(
+                        generate_warm_events(request.query, request.session_id, final_target_role, warm),
+                        media_type="text/event-stream",
+                        headers=SSE_HEADERS,
+                        background=background
+                    )
+
         return StreamingResponse(
-            generate_chat_events(request.query, request.session_id, final_target_role),
+            generate_chat_events(
+                request.query, request.session_id, final_target_role, members, request.include_reasoning, agent,
+                file_ids,
+            ),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"
-            }
+            headers=SSE_HEADERS,
+            background=background
         )
     except HTTPException:
         raise
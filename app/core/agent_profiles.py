@@ -0,0 +1,214 @@
+"""
+Perfiles vectoriales de agentes para el router de sesiones GROUP.
+
+Cada agente custom guarda en `custom_agents.profile_embedding` el embedding
+de su descripción + system prompt + una muestra de su knowledge_base. Se
+recalcula al crear/actualizar el agente y al ingerir o eliminar documentos.
+Los agentes anteriores a los perfiles se completan al arrancar
+(backfill_agent_profiles) y, si el router llega antes, en el propio turno.
+Los roles core usan su prompt por defecto (cacheado en proceso).
+
+El router elige, entre los `members` de la sesión, el agente cuyo perfil es
+más similar a la query: un embedding + una lectura en lugar de una llamada
+al LLM router. Decide el LLM router, limitado a los miembros, si ningún
+perfil llega a MEMBER_ROUTING_MIN_SCORE o si la query se parece más a una
+frase fuera de tema (OFF_TOPIC_ANCHORS: saludos, agradecimientos) que al
+mejor perfil.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from app.core.database import db, get_custom_agents_collection
+from app.core.logger import checkpoint_logger as logger
+from app.core.rag import embed_texts
+
+# Nº de chunks de la knowledge_base que entran en el perfil
+PROFILE_KB_SAMPLE = 5
+PROFILE_KB_CHUNK_CHARS = 600
+PROFILE_MAX_CHARS = 8000
+# Similitud mínima query-perfil para enrutar sin LLM. Con text-embedding-3-small
+# una query corta sin relación con un perfil largo ronda 0.1-0.25 y una del
+# dominio del agente 0.35-0.6
+MEMBER_ROUTING_MIN_SCORE = float(os.getenv("MEMBER_ROUTING_MIN_SCORE", "0.35"))
+# Frases sin dominio: si la query se parece más a alguna que al mejor perfil, decide el LLM
+OFF_TOPIC_ANCHORS = (
+    "Hola, ¿qué tal?",
+    "Buenos días, ¿cómo estáis?",
+    "Gracias, eso es todo.",
+    "Vale, perfecto.",
+    "Cuéntame un chiste.",
+)
+
+CORE_MEMBER_ROLES = ("CEO", "CTO", "CFO", "CMO")
+# Ids con los que un rol core aparece en `members` (API y frontend: "CTO", "cto-1").
+# Cualquier otro id es un agent_id de custom_agents.
+CORE_MEMBER_IDS: Dict[str, str] = {
+    "CEO": "CEO", "ceo": "CEO", "ceo-1": "CEO",
+    "CTO": "CTO", "cto": "CTO", "cto-1": "CTO",
+    "CFO": "CFO", "cfo": "CFO", "cfo-1": "CFO",
+    "CMO": "CMO", "cmo": "CMO", "cmo-1": "CMO",
+}
+
+# Perfiles de roles core: {rol: embedding}
+_core_profiles: Dict[str, List[float]] = {}
+# Embeddings de OFF_TOPIC_ANCHORS (una llamada por proceso)
+_off_topic: List[List[float]] = []
+
+
+def core_role_for_member(member_id: str) -> Optional[str]:
+    """Rol core de un id de miembro según CORE_MEMBER_IDS; None si es un agente custom."""
+    return CORE_MEMBER_IDS.get(member_id)
+
+
+def build_profile_text(agent: dict, kb_samples: List[str]) -> str:
+    """Texto que representa a un agente: identidad + prompt + muestra de KB."""
+    identity = agent.get("identity", {})
+    brain = agent.get("brain_config", {})
+    parts = [
+        identity.get("name", ""),
+        identity.get("role", ""),
+        identity.get("description") or "",
+        brain.get("system_prompt", ""),
+        *kb_samples,
+    ]
+    return "\n".join(p for p in parts if p)[:PROFILE_MAX_CHARS]
+
+
+async def _compute_profile(agent: dict) -> List[float]:
+    """Calcula y persiste el embedding de perfil de un agente custom ya leído."""
+    agent_id = agent["agent_id"]
+    kb_col = db.get_async_db()["knowledge_base"]
+    cursor = kb_col.find(
+        {"agent_target": agent_id},
+        {"_id": 0, "content_markdown": 1},
+    ).sort("chunk_index", 1).limit(PROFILE_KB_SAMPLE)
+    kb_samples = [doc.get("content_markdown", "")[:PROFILE_KB_CHUNK_CHARS] async for doc in cursor]
+
+    vector = (await embed_texts([build_profile_text(agent, kb_samples)]))[0]
+    await get_custom_agents_collection().update_one(
+        {"agent_id": agent_id},
+        {"$set": {
+            "profile_embedding": vector,
+            "profile_updated_at": datetime.now(timezone.utc),
+        }}
+    )
+    logger.info(f"🧭 Perfil de agente {agent_id} actualizado ({len(kb_samples)} chunks de KB)")
+    return vector
+
+
+async def refresh_agent_profile(agent_id: str) -> Optional[List[float]]:
+    """Recalcula y persiste el embedding de perfil de un agente custom."""
+    try:
+        agent = await get_custom_agents_collection().find_one({"agent_id": agent_id})
+        if not agent:
+            return None
+        return await _compute_profile(agent)
+
+    except Exception as e:
+        logger.error(f"Error actualizando perfil del agente {agent_id}: {e}")
+        return None
+
+
+async def backfill_agent_profiles() -> int:
+    """Calcula el perfil de los agentes custom que no lo tienen (creados antes de los perfiles)."""
+    missing = {"$or": [{"profile_embedding": {"$exists": False}}, {"profile_embedding": {"$in": [None, []]}}]}
+    done = 0
+    try:
+        async for agent in get_custom_agents_collection().find(missing, {"agent_id": 1}):
+            if await refresh_agent_profile(agent["agent_id"]) is not None:
+                done += 1
+    except Exception as e:
+        logger.error(f"Error completando perfiles de agentes: {e}")
+    if done:
+        logger.info(f"🧭 Perfiles completados para {done} agentes custom")
+    return done
+
+
+async def _get_core_profiles(core_prompts: Dict[str, str]) -> Dict[str, List[float]]:
+    """Embeddings de los roles core (una sola llamada batch por proceso)."""
+    missing = [role for role in CORE_MEMBER_ROLES if role not in _core_profiles]
+    if missing:
+        vectors = await embed_texts([core_prompts[role][:PROFILE_MAX_CHARS] for role in missing])
+        _core_profiles.update(zip(missing, vectors))
+    return _core_profiles
+
+
+async def _get_off_topic() -> List[List[float]]:
+    """Embeddings de OFF_TOPIC_ANCHORS (una sola llamada batch por proceso)."""
+    if not _off_topic:
+        _off_topic.extend(await embed_texts(list(OFF_TOPIC_ANCHORS)))
+    return _off_topic
+
+
+async def route_to_member(
+    query_vector: List[float],
+    members: List[str],
+    core_prompts: Dict[str, str],
+) -> Optional[dict]:
+    """
+    Elige el miembro de la sesión más similar a la query. A igual score gana
+    el miembro listado antes en la sesión. Un agente custom sin perfil lo
+    calcula aquí (y queda guardado).
+
+    Returns:
+        {"member_id", "score", "core_role" | None, "agent" | None} o None si
+        ningún miembro tiene perfil disponible, ninguno llega a
+        MEMBER_ROUTING_MIN_SCORE o la query está más cerca de una frase
+        fuera de tema que del mejor perfil.
+    """
+    import numpy as np
+
+    vectors: Dict[str, List[float]] = {}
+    candidates: Dict[str, dict] = {}
+
+    core_members = {m: core_role_for_member(m) for m in members}
+    if any(core_members.values()):
+        core_profiles = await _get_core_profiles(core_prompts)
+        for member_id, role in core_members.items():
+            if role:
+                candidates[member_id] = {"member_id": member_id, "core_role": role, "agent": None}
+                vectors[member_id] = core_profiles[role]
+
+    custom_ids = [m for m, role in core_members.items() if not role]
+    if custom_ids:
+        agents_col = get_custom_agents_collection()
+        missing = []
+        async for agent in agents_col.find({"agent_id": {"$in": custom_ids}}):
+            vector = agent.pop("profile_embedding", None)
+            if vector:
+                candidates[agent["agent_id"]] = {"member_id": agent["agent_id"], "core_role": None, "agent": agent}
+                vectors[agent["agent_id"]] = vector
+            else:
+                missing.append(agent)
+        # Agentes anteriores a los perfiles que el backfill aún no cubrió
+        computed = await asyncio.gather(*(_compute_profile(agent) for agent in missing), return_exceptions=True)
+        for agent, vector in zip(missing, computed):
+            if isinstance(vector, BaseException) or not vector:
+                logger.warning(f"Agente {agent['agent_id']} sin perfil vectorial, excluido del routing: {vector}")
+                continue
+            candidates[agent["agent_id"]] = {"member_id": agent["agent_id"], "core_role": None, "agent": agent}
+            vectors[agent["agent_id"]] = vector
+
+    # Orden de la sesión: argmax se queda con el primero en caso de empate
+    ranked = [candidates[m] for m in dict.fromkeys(members) if m in candidates]
+    if not ranked:
+        return None
+
+    # Los embeddings de OpenAI vienen normalizados: coseno == producto escalar
+    query = np.asarray(query_vector, dtype=np.float32)
+    scores = np.asarray([vectors[c["member_id"]] for c in ranked], dtype=np.float32) @ query
+    for candidate, score in zip(ranked, scores.tolist()):
+        candidate["score"] = score
+    best = ranked[int(np.argmax(scores))]
+    summary = ", ".join(f"{c['member_id']}={c['score']:.3f}" for c in ranked)
+    if best["score"] < MEMBER_ROUTING_MIN_SCORE:
+        logger.info(f"🧭 Routing por perfil: {summary} -> ninguno supera {MEMBER_ROUTING_MIN_SCORE}")
+        return None
+    off_topic = float(np.max(np.asarray(await _get_off_topic(), dtype=np.float32) @ query))
+    if off_topic >= best["score"]:
+        logger.info(f"🧭 Routing por perfil: {summary} -> fuera de tema ({off_topic:.3f})")
+        return None
+    logger.info(f"🧭 Routing por perfil: {summary} -> {best['member_id']}")
+    return best
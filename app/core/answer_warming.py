@@ -0,0 +1,310 @@
+"""
+Precalentado offline de respuestas frecuentes por agente.
+
+1. Minado: cada primer turno de una sesión DIRECT suma 1 a su query
+   normalizada en `query_stats`; las más frecuentes por agente (más las de
+   una lista semilla) son candidatas.
+2. Cómputo: se ejecutan contra el grafo sin checkpointer con el prompt, la
+   KB y el modelo actuales del agente.
+3. Almacén: `warm_answers` guarda cada respuesta con la huella (fingerprint)
+   de prompt + modelo + KB con la que se generó.
+4. Servicio: un primer turno cuya query normalizada coincide y cuya huella
+   sigue vigente se responde al instante con los eventos SSE normales.
+
+Si cambia el prompt o la KB del agente la huella deja de coincidir: la
+entrada no se sirve y se recalcula (al momento para agentes custom, en el
+siguiente ciclo del job para los roles core).
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.core.database import db, get_custom_agents_collection
+from app.core.logger import checkpoint_logger as logger
+
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "20"))               # Queries por agente
+WARM_MIN_COUNT = int(os.getenv("WARM_MIN_COUNT", "3"))        # Apariciones mínimas
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "2"))
+WARM_INTERVAL_HOURS = float(os.getenv("WARM_INTERVAL_HOURS", "0"))  # 0 = solo manual
+WARM_SEEDS_FILE = os.getenv("WARM_SEEDS_FILE")                # JSON {"CEO": ["..."]}
+
+# Cambiar si cambia el formato de las entradas (invalida todo el almacén)
+WARM_SCHEMA_VERSION = 1
+FINGERPRINT_TTL_S = 60
+
+# Campos del estado final que se restauran al servir (el experto no se re-ejecuta)
+WARM_STATE_KEYS = ("next_agent", "system_prompt", "model_config", "rag_query", "rag_role", "rag_refs")
+
+_fingerprints: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
+def get_warm_answers_collection():
+    return db.get_async_db()["warm_answers"]
+
+
+def get_query_stats_collection():
+    return db.get_async_db()["query_stats"]
+
+
+def normalize_query(query: str) -> str:
+    """Forma canónica para coincidencias casi exactas (mayúsculas, tildes, puntuación, espacios)."""
+    text = unicodedata.normalize("NFKD", query.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+# --- Huella de versión (prompt + modelo + KB) ---
+
+async def _kb_version(targets: List[str]) -> dict:
+    kb_col = db.get_async_db()["knowledge_base"]
+    query = {"agent_target": {"$in": targets}}
+    count = await kb_col.count_documents(query)
+    latest = await kb_col.find_one(query, {"_id": 1}, sort=[("_id", -1)])
+    return {"count": count, "latest": str(latest["_id"]) if latest else None}
+
+
+async def agent_fingerprint(agent_key: str) -> Optional[str]:
+    """Huella de la configuración que determina las respuestas del agente (cacheada 60s)."""
+    cached = _fingerprints.get(agent_key)
+    if cached and time.monotonic() - cached[0] < FINGERPRINT_TTL_S:
+        return cached[1]
+
+    from app.core.orchestrator import AGENT_PROMPT_TEMPLATE, DEFAULT_CORE_PROMPTS, llm_expert
+
+    if agent_key in DEFAULT_CORE_PROMPTS:
+        parts = {
+            "prompt": DEFAULT_CORE_PROMPTS[agent_key],
+            "model": [llm_expert.model_name, llm_expert.temperature],
+            "kb": await _kb_version([agent_key]),
+        }
+    else:
+        agent = await get_custom_agents_collection().find_one({"agent_id": agent_key}, {"brain_config": 1})
+        if not agent:
+            _fingerprints[agent_key] = (time.monotonic(), None)
+            return None
+        parts = {
+            "brain": agent.get("brain_config", {}),
+            "kb": await _kb_version([agent_key, "all"]),
+        }
+
+    parts["template"] = AGENT_PROMPT_TEMPLATE
+    parts["schema"] = WARM_SCHEMA_VERSION
+    fingerprint = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    _fingerprints[agent_key] = (time.monotonic(), fingerprint)
+    return fingerprint
+
+
+def invalidate_fingerprint(agent_key: str) -> None:
+    _fingerprints.pop(agent_key, None)
+
+
+# --- Servicio ---
+
+async def record_first_turn(agent_key: str, query: str) -> None:
+    """Contabiliza un primer turno para el minado de queries frecuentes."""
+    query_norm = normalize_query(query)
+    if not query_norm:
+        return
+    try:
+        await get_query_stats_collection().update_one(
+            {"agent_key": agent_key, "query_norm": query_norm},
+            {
+                "$inc": {"count": 1},
+                "$set": {"query": query, "last_seen": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        logger.warning(f"No se pudo registrar primer turno de {agent_key}: {e}")
+
+
+async def lookup_warm_answer(agent_key: str, query: str) -> Optional[dict]:
+    """Respuesta precalculada vigente para la query, o None."""
+    try:
+        doc = await get_warm_answers_collection().find_one(
+            {"agent_key": agent_key, "query_norm": normalize_query(query)}
+        )
+        if not doc:
+            return None
+        if doc["fingerprint"] != await agent_fingerprint(agent_key):
+            logger.debug(f"🔥 Respuesta precalentada obsoleta para {agent_key}: '{query[:50]}'")
+            return None
+        await get_warm_answers_collection().update_one({"_id": doc["_id"]}, {"$inc": {"hits": 1}})
+        return doc
+    except Exception as e:
+        logger.warning(f"Error consultando respuestas precalentadas: {e}")
+        return None
+
+
+# --- Cómputo ---
+
+async def warm_query(agent_key: str, query: str, fingerprint: str, graph=None) -> bool:
+    """
+    Calcula y guarda la respuesta a una query. Las respuestas que usaron tools
+    (datos en vivo, acciones) no se cachean.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+    if graph is None:
+        from app.core.orchestrator import stateless_app as graph
+
+    state = await graph.ainvoke({
+        "query": query,
+        "messages": [HumanMessage(content=query)],
+        "target_role": agent_key,
+    })
+    messages = state.get("messages", [])
+    if any(isinstance(m, ToolMessage) or (isinstance(m, AIMessage) and m.tool_calls) for m in messages):
+        logger.info(f"🔥 '{query[:50]}' ({agent_key}) usa tools: no se precalienta")
+        return False
+    if not state.get("final_response"):
+        return False
+    if state.get("rag_refs") is None:
+        logger.warning(f"🔥 '{query[:50]}' ({agent_key}) respondida sin RAG (recuperación fallida): no se precalienta")
+        return False
+
+    now = datetime.now(timezone.utc)
+    await get_warm_answers_collection().update_one(
+        {"agent_key": agent_key, "query_norm": normalize_query(query)},
+        {
+            "$set": {
+                "query": query,
+                "answer": state["final_response"],
+                "state": {k: state.get(k) for k in WARM_STATE_KEYS},
+                "fingerprint": fingerprint,
+                "updated_at": now,
+            },
+            "$setOnInsert": {"created_at": now, "hits": 0},
+        },
+        upsert=True,
+    )
+    return True
+
+
+async def mine_frequent_queries(
+    agents: Optional[Iterable[str]] = None,
+    top_n: int = WARM_TOP_N,
+    min_count: int = WARM_MIN_COUNT,
+) -> Dict[str, List[str]]:
+    """Queries de primer turno más frecuentes por agente."""
+    match = {"count": {"$gte": min_count}}
+    if agents is not None:
+        match["agent_key"] = {"$in": list(agents)}
+
+    mined: Dict[str, List[str]] = {}
+    cursor = get_query_stats_collection().find(match, {"agent_key": 1, "query": 1}).sort("count", -1)
+    async for doc in cursor:
+        queries = mined.setdefault(doc["agent_key"], [])
+        if len(queries) < top_n:
+            queries.append(doc["query"])
+    return mined
+
+
+def load_seed_file(path: Optional[str] = WARM_SEEDS_FILE) -> Dict[str, List[str]]:
+    if not path:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"No se pudo leer WARM_SEEDS_FILE {path}: {e}")
+        return {}
+
+
+async def run_warming(
+    agents: Optional[List[str]] = None,
+    seeds: Optional[Dict[str, List[str]]] = None,
+    top_n: int = WARM_TOP_N,
+    min_count: int = WARM_MIN_COUNT,
+    graph=None,
+) -> dict:
+    """
+    Job de precalentado: minado + semillas + entradas existentes obsoletas.
+    Las entradas cuya huella sigue vigente no se recalculan.
+    """
+    candidates: Dict[str, Dict[str, str]] = {}
+    summary = {"agents": 0, "warmed": 0, "fresh": 0, "skipped": 0, "errors": 0}
+
+    def add(agent_key: str, queries: Iterable[str]):
+        if agents is not None and agent_key not in agents:
+            return
+        for query in queries:
+            candidates.setdefault(agent_key, {}).setdefault(normalize_query(query), query)
+
+    # Cada fuente de candidatas falla por separado: sin minado se precalientan
+    # las semillas y las entradas existentes, y viceversa
+    try:
+        for agent_key, queries in (await mine_frequent_queries(agents, top_n, min_count)).items():
+            add(agent_key, queries)
+    except Exception as e:
+        summary["errors"] += 1
+        logger.error(f"Error minando queries frecuentes: {e}")
+    for agent_key, queries in {**load_seed_file(), **(seeds or {})}.items():
+        add(agent_key, queries)
+
+    existing: Dict[Tuple[str, str], str] = {}
+    warm_filter = {"agent_key": {"$in": agents}} if agents is not None else {}
+    try:
+        async for doc in get_warm_answers_collection().find(warm_filter, {"agent_key": 1, "query_norm": 1, "query": 1, "fingerprint": 1}):
+            existing[(doc["agent_key"], doc["query_norm"])] = doc["fingerprint"]
+            add(doc["agent_key"], [doc["query"]])
+    except Exception as e:
+        summary["errors"] += 1
+        logger.error(f"Error leyendo respuestas precalentadas existentes: {e}")
+
+    summary["agents"] = len(candidates)
+    semaphore = asyncio.Semaphore(max(1, WARM_CONCURRENCY))
+
+    async def warm(agent_key: str, query: str, fingerprint: str):
+        async with semaphore:
+            try:
+                summary["warmed" if await warm_query(agent_key, query, fingerprint, graph) else "skipped"] += 1
+            except Exception as e:
+                summary["errors"] += 1
+                logger.error(f"Error precalentando '{query[:50]}' ({agent_key}): {e}")
+
+    jobs = []
+    for agent_key, queries in candidates.items():
+        invalidate_fingerprint(agent_key)
+        try:
+            fingerprint = await agent_fingerprint(agent_key)
+            if fingerprint is None:
+                # Agente eliminado: sus entradas ya no se pueden servir
+                await get_warm_answers_collection().delete_many({"agent_key": agent_key})
+                continue
+        except Exception as e:
+            summary["errors"] += 1
+            logger.error(f"Error calculando la huella de {agent_key}, no se precalienta: {e}")
+            continue
+        for query_norm, query in queries.items():
+            if existing.get((agent_key, query_norm)) == fingerprint:
+                summary["fresh"] += 1
+            else:
+                jobs.append(warm(agent_key, query, fingerprint))
+
+    await asyncio.gather(*jobs)
+    logger.info(f"🔥 Precalentado terminado: {summary}")
+    return summary
+
+
+async def rewarm_agent(agent_key: str) -> dict:
+    """Recalcula las respuestas de un agente tras cambiar su prompt o su KB."""
+    invalidate_fingerprint(agent_key)
+    return await run_warming(agents=[agent_key])
+
+
+async def warming_loop(interval_hours: float = WARM_INTERVAL_HOURS):
+    """Job periódico (WARM_INTERVAL_HOURS > 0), lanzado desde el lifespan."""
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            await run_warming()
+        except Exception as e:
+            logger.error(f"Error en el ciclo de precalentado: {e}")
@@ -0,0 +1,215 @@
+"""
+Runner de inferencia batch (offline) para el grafo de agentes.
+
+Entrada JSONL, una consulta por línea:
+    {"id": "q1", "query": "...", "role": "CTO"}
+    {"id": "q2", "query": "...", "agent_id": "<uuid>"}
+    {"id": "q3", "query": "..."}                 # sin destino: decide el router
+
+Cada item se ejecuta contra el grafo SIN checkpointer (no ensucia el
+historial de sesiones), con concurrencia acotada y un límite de requests por
+minuto para respetar los rate limits del proveedor. Un 429 del proveedor se
+reintenta con backoff exponencial. Cada resultado incluye latencia y uso de
+tokens, y se entrega a un `sink` en cuanto termina, de modo que una ejecución
+interrumpida puede reanudarse saltando los ids ya hechos con éxito (los que
+fallaron se vuelven a ejecutar).
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from app.core.logger import api_logger as logger
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 60
+# Reintentos de un item ante un 429 del proveedor (espera BACKOFF * 2^intento)
+RATE_LIMIT_RETRIES = int(os.getenv("BATCH_RATE_LIMIT_RETRIES", "3"))
+RATE_LIMIT_BACKOFF_S = float(os.getenv("BATCH_RATE_LIMIT_BACKOFF_S", "2"))
+
+
+class BatchInputError(ValueError):
+    """Línea JSONL inválida en la entrada del batch."""
+
+
+def load_items(lines: Iterable[str]) -> List[dict]:
+    """
+    Parsea y valida las líneas JSONL de entrada.
+
+    Returns:
+        Lista de items {"id", "query", "target"} (target None = router)
+    """
+    items = []
+    seen: Set[str] = set()
+    for lineno, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise BatchInputError(f"Línea {lineno}: JSON inválido ({e})")
+
+        query = (raw.get("query") or "").strip()
+        if not query:
+            raise BatchInputError(f"Línea {lineno}: falta 'query'")
+
+        item_id = str(raw.get("id", lineno))
+        if item_id in seen:
+            raise BatchInputError(f"Línea {lineno}: id duplicado '{item_id}'")
+        seen.add(item_id)
+
+        items.append({
+            "id": item_id,
+            "query": query,
+            "target": raw.get("agent_id") or raw.get("role"),
+        })
+    return items
+
+
+class RateLimiter:
+    """Espaciado mínimo entre requests (requests_per_minute <= 0 lo desactiva)."""
+
+    def __init__(self, requests_per_minute: int):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def _sum_usage(usage_by_model: dict) -> dict:
+    """Agrega el uso de tokens de todas las llamadas LLM del item (router + experto)."""
+    totals = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    for usage in usage_by_model.values():
+        for key in totals:
+            totals[key] += usage.get(key, 0) or 0
+    return totals
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """429 del proveedor (openai.RateLimitError y equivalentes con status_code)."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+async def run_item(item: dict, graph=None) -> dict:
+    """Ejecuta un item contra el grafo y devuelve su resultado (nunca lanza)."""
+    from langchain_core.callbacks import UsageMetadataCallbackHandler
+    from langchain_core.messages import HumanMessage
+
+    if graph is None:
+        from app.core.orchestrator import stateless_app as graph
+
+    usage = UsageMetadataCallbackHandler()
+    start = time.perf_counter()
+    result = {"id": item["id"], "query": item["query"], "target": item["target"]}
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            state = await graph.ainvoke(
+                {
+                    "query": item["query"],
+                    "messages": [HumanMessage(content=item["query"])],
+                    "target_role": item["target"],
+                },
+                config={"callbacks": [usage]},
+            )
+            result.update({
+                "status": "ok",
+                "role": state.get("next_agent"),
+                "response": state.get("final_response", ""),
+            })
+            break
+        except Exception as e:
+            if is_rate_limited(e) and attempt < RATE_LIMIT_RETRIES:
+                delay = RATE_LIMIT_BACKOFF_S * 2 ** attempt
+                logger.warning(f"Batch item {item['id']}: rate limit, reintento {attempt + 1} en {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Batch item {item['id']} falló: {e}")
+            result.update({"status": "error", "error": str(e), "rate_limited": is_rate_limited(e)})
+            break
+
+    result["attempts"] = attempt + 1
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    result["usage"] = _sum_usage(usage.usage_metadata)
+    return result
+
+
+async def run_batch(
+    items: List[dict],
+    sink: Callable[[dict], Awaitable[None]],
+    *,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+    done_ids: Optional[Set[str]] = None,
+    graph=None,
+) -> dict:
+    """
+    Ejecuta los items con concurrencia acotada y rate limit.
+
+    Args:
+        items: Items de load_items()
+        sink: Corrutina que recibe cada resultado en cuanto termina
+        concurrency: Máximo de items en vuelo
+        requests_per_minute: Límite de arranque de items por minuto
+        done_ids: Ids completados con éxito en una ejecución previa (se saltan)
+        graph: Grafo a usar (default: orchestrator.stateless_app)
+
+    Returns:
+        Resumen {"total", "skipped", "ok", "error", "elapsed_s"}
+    """
+    done_ids = done_ids or set()
+    pending = [item for item in items if item["id"] not in done_ids]
+    summary = {"total": len(items), "skipped": len(items) - len(pending), "ok": 0, "error": 0}
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(requests_per_minute)
+    start = time.perf_counter()
+
+    async def worker(item: dict):
+        async with semaphore:
+            await limiter.acquire()
+            result = await run_item(item, graph)
+        summary[result["status"]] += 1
+        await sink(result)
+
+    logger.info(
+        f"📦 Batch: {len(pending)} items pendientes ({summary['skipped']} ya hechos), "
+        f"concurrencia={concurrency}, rpm={requests_per_minute}"
+    )
+    await asyncio.gather(*(worker(item) for item in pending))
+
+    summary["elapsed_s"] = round(time.perf_counter() - start, 2)
+    logger.info(f"📦 Batch terminado: {summary}")
+    return summary
+
+
+def read_done_ids(output_path: str) -> Set[str]:
+    """
+    Ids con resultado correcto en un fichero de resultados JSONL (para
+    reanudar). Los items con error se vuelven a ejecutar: su nuevo resultado
+    se añade al final del fichero.
+    """
+    done: Set[str] = set()
+    try:
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    if result.get("status") == "ok":
+                        done.add(str(result["id"]))
+                except (json.JSONDecodeError, KeyError, AttributeError):
+                    continue  # Línea truncada por una interrupción: se re-ejecuta
+    except FileNotFoundError:
+        pass
+    return done
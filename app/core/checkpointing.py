@@ -0,0 +1,553 @@
+"""
+Checkpointer de LangGraph con soporte de forks copy-on-write.
+
+Un fork es un thread nuevo que referencia un checkpoint de su thread padre
+(colección `thread_forks`). Crear un fork es O(1): no se copia ningún
+checkpoint. Mientras el fork no escriba, sus lecturas se resuelven a través
+de la cadena de padres; al escribir, sus checkpoints nuevos quedan en su
+propio thread y el historial compartido sigue viviendo solo en el padre.
+
+Además mantiene una caché LRU write-through del último checkpoint de cada
+thread: el checkpoint que se lee al empezar un turno es el que este mismo
+proceso escribió al terminar el anterior. Con varios workers, un change
+stream sobre la colección de checkpoints (CHECKPOINT_CACHE_WATCH) invalida
+la entrada de un thread en cuanto otro worker le escribe un checkpoint más
+nuevo, y vacía la caché ante cualquier borrado (sesión eliminada en otro
+worker): mientras el stream está abierto los aciertos no consultan Mongo.
+Sin change streams (Mongo standalone) o mientras el stream se reabre, cada
+acierto se verifica con una proyección del checkpoint_id (sin deserializar):
+que la entrada sigue siendo la última del thread o, si se pide por id, que
+sigue existiendo. CHECKPOINT_CACHE_TRUST=true omite toda verificación
+cuando las sesiones son sticky (un único writer por thread).
+
+Cada escritura (checkpoint o write pendiente) se contabiliza globalmente y
+en el turno en curso (`track_turn_writes`), para comparar los modos de
+durabilidad (CHECKPOINT_DURABILITY) por nº de escrituras y latencia.
+"""
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from collections.abc import Awaitable, Callable, Iterator, Sequence
+from datetime import datetime, timezone
+from typing import Any, List, NamedTuple, Optional
+
+from langchain_core.runnables import RunnableConfig, run_in_executor
+from langgraph.checkpoint.base import (
+    ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple, get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.mongodb import MongoDBSaver
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from app.core.logger import checkpoint_logger as logger
+
+CHECKPOINT_CACHE_SIZE = int(os.getenv("CHECKPOINT_CACHE_SIZE", "512"))  # threads; 0 desactiva
+CHECKPOINT_CACHE_TRUST = os.getenv("CHECKPOINT_CACHE_TRUST", "false").lower() == "true"
+CHECKPOINT_CACHE_WATCH = os.getenv("CHECKPOINT_CACHE_WATCH", "true").lower() == "true"
+# Espera antes de reabrir un change stream caído (segundos)
+CHECKPOINT_WATCH_RETRY_S = float(os.getenv("CHECKPOINT_WATCH_RETRY_S", "5"))
+# Códigos de Mongo sin change streams (standalone, no soportado): no se reintenta
+_WATCH_UNSUPPORTED = {40573, 40324, 303}
+
+# Contadores de escrituras del turno en curso (se propagan a los threads del executor)
+_turn_writes: ContextVar[Optional[dict]] = ContextVar("turn_writes", default=None)
+_turn_stats: dict[str, dict] = {}
+_turn_lock = threading.Lock()  # nodos paralelos del mismo turno escriben desde varios threads
+
+
+def track_turn_writes() -> dict:
+    """Empieza a contar las escrituras de checkpoint del turno actual."""
+    counters = {"checkpoints": 0, "writes": 0}
+    _turn_writes.set(counters)
+    return counters
+
+
+def record_turn(durability: str, elapsed_ms: float, counters: dict) -> None:
+    """Acumula latencia y escrituras por modo de durabilidad (expuesto en /health)."""
+    stats = _turn_stats.setdefault(durability, {"turns": 0, "total_ms": 0.0, "checkpoints": 0, "writes": 0})
+    stats["turns"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["checkpoints"] += counters["checkpoints"]
+    stats["writes"] += counters["writes"]
+
+
+def turn_stats() -> dict:
+    return {
+        mode: {
+            "turns": s["turns"],
+            "avg_ms": round(s["total_ms"] / s["turns"], 1),
+            "avg_checkpoints": round(s["checkpoints"] / s["turns"], 2),
+            "avg_writes": round(s["writes"] / s["turns"], 2),
+        }
+        for mode, s in _turn_stats.items()
+    }
+
+
+def _count_write(kind: str) -> None:
+    counters = _turn_writes.get()
+    if counters is not None:
+        with _turn_lock:
+            counters[kind] += 1
+
+
+def _with_thread(config: Optional[RunnableConfig], thread_id: str) -> Optional[RunnableConfig]:
+    """Reescribe el thread_id de una config (para presentar checkpoints del padre como propios)."""
+    if config is None:
+        return None
+    return {"configurable": {**config["configurable"], "thread_id": thread_id}}
+
+
+class _CachedCheckpoint(NamedTuple):
+    """Último checkpoint de un thread, serializado como en Mongo (aislado de mutaciones)."""
+    config: RunnableConfig
+    type_: str
+    data: bytes
+    metadata: CheckpointMetadata
+    parent_config: Optional[RunnableConfig]
+
+    @property
+    def checkpoint_id(self) -> str:
+        return self.config["configurable"]["checkpoint_id"]
+
+
+class ForkAwareMongoDBSaver(MongoDBSaver):
+    """
+    MongoDBSaver que resuelve lecturas de threads forkeados a través del padre.
+
+    Los checkpoints heredados se presentan con el thread_id del fork, de modo
+    que LangGraph escribe siempre en el thread hijo (nunca en el padre).
+    """
+
+    def __init__(
+        self,
+        client,
+        forks_collection_name: str = "thread_forks",
+        cache_size: int = CHECKPOINT_CACHE_SIZE,
+        cache_trust: bool = CHECKPOINT_CACHE_TRUST,
+        cache_watch: bool = CHECKPOINT_CACHE_WATCH,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(client, **kwargs)
+        self.forks_collection = self.db[forks_collection_name]
+        self.forks_collection.create_index(
+            [("thread_id", ASCENDING), ("checkpoint_ns", ASCENDING)], unique=True
+        )
+        self.forks_collection.create_index([("parent_thread_id", ASCENDING)])
+        # Los forks son inmutables: se cachean en proceso tras la primera lectura
+        self._forks: dict[tuple[str, str], dict] = {}
+
+        # Caché LRU del último checkpoint por (thread_id, checkpoint_ns)
+        self.cache_size = cache_size
+        self.cache_trust = cache_trust
+        self._cache: "OrderedDict[tuple[str, str], _CachedCheckpoint]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "verify_reads": 0, "invalidated": 0}
+        self.write_stats = {"checkpoints": 0, "writes": 0}
+        # True mientras el change stream está abierto: los aciertos no se verifican
+        self.watching = False
+        if cache_size and not cache_trust and cache_watch:
+            threading.Thread(target=self._watch_checkpoints, name="checkpoint-cache-watch", daemon=True).start()
+
+    # --- Caché del último checkpoint ---
+
+    def _cache_store(self, key: tuple[str, str], entry: _CachedCheckpoint) -> None:
+        with self._cache_lock:
+            current = self._cache.get(key)
+            # Los ids son monótonos: nunca sustituir por un checkpoint más antiguo
+            if current and current.checkpoint_id > entry.checkpoint_id:
+                return
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self._cache_stats["evictions"] += 1
+
+    def _count(self, stats: dict, name: str) -> None:
+        # Los métodos async de MongoDBSaver ejecutan los síncronos en el executor
+        with self._cache_lock:
+            stats[name] += 1
+
+    def _cache_lookup(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = (thread_id, checkpoint_ns)
+        checkpoint_id = get_checkpoint_id(config)
+
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        if entry is None or (checkpoint_id and checkpoint_id != entry.checkpoint_id):
+            return None
+
+        # "El último" puede haberlo escrito otro worker, y un checkpoint_id
+        # concreto (inmutable) puede haberse borrado con su sesión. Con el
+        # change stream abierto ambos casos ya invalidaron la entrada; sin él
+        # se verifican con una proyección, sin deserializar nada
+        if not self.cache_trust and not self.watching:
+            self._count(self._cache_stats, "verify_reads")
+            if self.resolve_checkpoint_id(thread_id, checkpoint_id, checkpoint_ns) != entry.checkpoint_id:
+                self.invalidate(thread_id, checkpoint_ns)
+                self._count(self._cache_stats, "stale")
+                return None
+
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            self._cache_stats["hits"] += 1
+        return CheckpointTuple(
+            config=copy.deepcopy(entry.config),
+            checkpoint=self.serde.loads_typed((entry.type_, entry.data)),
+            metadata=copy.deepcopy(entry.metadata),
+            parent_config=copy.deepcopy(entry.parent_config),
+            pending_writes=[],
+        )
+
+    def _watch_checkpoints(self) -> None:
+        """Change stream de la colección de checkpoints (thread daemon, se reabre si cae)."""
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "replace", "delete", "drop", "invalidate"]}}},
+            {"$project": {
+                "operationType": 1,
+                "fullDocument.thread_id": 1,
+                "fullDocument.checkpoint_ns": 1,
+                "fullDocument.checkpoint_id": 1,
+            }},
+        ]
+        while True:
+            try:
+                with self.checkpoint_collection.watch(pipeline) as stream:
+                    # Lo cacheado antes de abrir el stream pudo cambiar sin aviso
+                    self.clear_cache()
+                    self.watching = True
+                    logger.info("👀 Caché de checkpoints invalidada por change stream")
+                    for event in stream:
+                        self._on_change(event)
+            except (NotImplementedError, OperationFailure) as e:
+                if isinstance(e, NotImplementedError) or getattr(e, "code", None) in _WATCH_UNSUPPORTED:
+                    self.watching = False
+                    logger.info(f"Change streams no disponibles, caché de checkpoints verificada por lectura: {e}")
+                    return
+                logger.warning(f"⚠️ Change stream de checkpoints caído, reabriendo en {CHECKPOINT_WATCH_RETRY_S}s: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Change stream de checkpoints caído, reabriendo en {CHECKPOINT_WATCH_RETRY_S}s: {e}")
+            self.watching = False
+            time.sleep(CHECKPOINT_WATCH_RETRY_S)
+
+    def _on_change(self, event: dict) -> None:
+        """Invalida lo que otro worker dejó obsoleto (las escrituras propias ya están en la caché)."""
+        if event["operationType"] not in ("insert", "replace"):
+            # Un borrado solo trae el _id: sesión eliminada en algún worker
+            self.clear_cache()
+            return
+        doc = event.get("fullDocument") or {}
+        key = (doc.get("thread_id"), doc.get("checkpoint_ns", ""))
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry and entry.checkpoint_id < doc.get("checkpoint_id", ""):
+                del self._cache[key]
+                self._cache_stats["invalidated"] += 1
+
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def invalidate(self, thread_id: str, checkpoint_ns: Optional[str] = None) -> None:
+        """Descarta el checkpoint cacheado de un thread (todos sus namespaces si ns es None)."""
+        with self._cache_lock:
+            for key in [k for k in self._cache if k[0] == thread_id and checkpoint_ns in (None, k[1])]:
+                del self._cache[key]
+
+    def cache_stats(self) -> dict:
+        """Métricas de la caché (expuestas en /health)."""
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+            size = len(self._cache)
+        lookups = stats["hits"] + stats["misses"] + stats["stale"]
+        return {
+            **stats,
+            "size": size,
+            "capacity": self.cache_size,
+            "mode": "trust" if self.cache_trust else "watch" if self.watching else "verify",
+            "hit_rate": round(stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+    # --- Registro de forks ---
+
+    def get_fork(self, thread_id: str, checkpoint_ns: str = "") -> Optional[dict]:
+        """Devuelve el registro de fork de un thread (o None si no es un fork)."""
+        key = (thread_id, checkpoint_ns)
+        if key not in self._forks:
+            doc = self.forks_collection.find_one(
+                {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}, {"_id": 0}
+            )
+            if not doc:
+                return None
+            self._forks[key] = doc
+        return self._forks[key]
+
+    def register_fork(
+        self,
+        thread_id: str,
+        parent_thread_id: str,
+        parent_checkpoint_id: str,
+        checkpoint_ns: str = "",
+    ) -> dict:
+        """Crea un fork O(1): un único documento apuntando al checkpoint padre."""
+        doc = {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "parent_thread_id": parent_thread_id,
+            "parent_checkpoint_id": parent_checkpoint_id,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self.forks_collection.insert_one(dict(doc))
+        self._forks[(thread_id, checkpoint_ns)] = doc
+        return doc
+
+    def has_forks(self, thread_id: str) -> bool:
+        """True si algún fork depende de los checkpoints de este thread."""
+        return self.forks_collection.count_documents({"parent_thread_id": thread_id}, limit=1) > 0
+
+    def delete_fork(self, thread_id: str) -> None:
+        """Elimina el registro de fork de un thread (no toca los checkpoints del padre)."""
+        self.forks_collection.delete_many({"thread_id": thread_id})
+        for key in [k for k in self._forks if k[0] == thread_id]:
+            del self._forks[key]
+
+    def resolve_checkpoint_id(
+        self,
+        thread_id: str,
+        checkpoint_id: Optional[str] = None,
+        checkpoint_ns: str = "",
+    ) -> Optional[str]:
+        """
+        Verifica que un checkpoint es visible desde el thread (propio o heredado)
+        sin deserializarlo. Sin checkpoint_id, devuelve el último del thread.
+        """
+        query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+        if checkpoint_id:
+            query["checkpoint_id"] = checkpoint_id
+        doc = self.checkpoint_collection.find_one(
+            query, {"checkpoint_id": 1}, sort=[("checkpoint_id", -1)]
+        )
+        if doc:
+            return doc["checkpoint_id"]
+
+        fork = self.get_fork(thread_id, checkpoint_ns)
+        if not fork or (checkpoint_id and checkpoint_id > fork["parent_checkpoint_id"]):
+            return None
+        return self.resolve_checkpoint_id(
+            fork["parent_thread_id"], checkpoint_id or fork["parent_checkpoint_id"], checkpoint_ns
+        )
+
+    # --- Lecturas con resolución por la cadena de padres ---
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        if not self.cache_size:
+            return self._load_tuple(config)
+
+        cached = self._cache_lookup(config)
+        if cached is not None:
+            return cached
+
+        self._count(self._cache_stats, "misses")
+        loaded = self._load_tuple(config)
+        # Solo se cachea "el último" sin writes pendientes (estado de fin de turno)
+        if loaded is not None and not get_checkpoint_id(config) and not loaded.pending_writes:
+            type_, data = self.serde.dumps_typed(loaded.checkpoint)
+            configurable = config["configurable"]
+            self._cache_store(
+                (configurable["thread_id"], configurable.get("checkpoint_ns", "")),
+                _CachedCheckpoint(loaded.config, type_, data, loaded.metadata, loaded.parent_config),
+            )
+        return loaded
+
+    def _load_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        own = super().get_tuple(config)
+        if own is not None:
+            return own
+
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        fork = self.get_fork(thread_id, checkpoint_ns)
+        if not fork:
+            return None
+
+        # Los checkpoints posteriores al punto de fork solo pueden ser del hijo
+        checkpoint_id = get_checkpoint_id(config) or fork["parent_checkpoint_id"]
+        if checkpoint_id > fork["parent_checkpoint_id"]:
+            return None
+
+        inherited = self.get_tuple({
+            "configurable": {
+                "thread_id": fork["parent_thread_id"],
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }
+        })
+        if inherited is None:
+            return None
+        return inherited._replace(
+            config=_with_thread(inherited.config, thread_id),
+            parent_config=_with_thread(inherited.parent_config, thread_id),
+        )
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        yielded = 0
+        for item in super().list(config, filter=filter, before=before, limit=limit):
+            yield item
+            yielded += 1
+
+        if config is None or "thread_id" not in config["configurable"]:
+            return
+        if limit is not None and yielded >= limit:
+            return
+
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        fork = self.get_fork(thread_id, checkpoint_ns)
+        if not fork:
+            return
+
+        # Continuar por el padre: el punto de fork (inclusive) y lo anterior
+        fork_id = fork["parent_checkpoint_id"]
+        before_id = get_checkpoint_id(before) if before else None
+        parent_config = {"configurable": {"thread_id": fork["parent_thread_id"], "checkpoint_ns": checkpoint_ns}}
+
+        if before_id is None or fork_id < before_id:
+            fork_point = self.get_tuple({"configurable": {**parent_config["configurable"], "checkpoint_id": fork_id}})
+            if fork_point and all(fork_point.metadata.get(k) == v for k, v in (filter or {}).items()):
+                yield fork_point._replace(
+                    config=_with_thread(fork_point.config, thread_id),
+                    parent_config=_with_thread(fork_point.parent_config, thread_id),
+                )
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+            before_id = fork_id
+
+        remaining = None if limit is None else limit - yielded
+        for item in self.list(
+            parent_config,
+            filter=filter,
+            before={"configurable": {"checkpoint_id": before_id}},
+            limit=remaining,
+        ):
+            yield item._replace(
+                config=_with_thread(item.config, thread_id),
+                parent_config=_with_thread(item.parent_config, thread_id),
+            )
+
+    # --- Escrituras (write-through sobre la caché) ---
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        self._count(self.write_stats, "checkpoints")
+        _count_write("checkpoints")
+        if self.cache_size:
+            configurable = next_config["configurable"]
+            parent_id = config["configurable"].get("checkpoint_id")
+            parent_config = {"configurable": {**configurable, "checkpoint_id": parent_id}} if parent_id else None
+            type_, data = self.serde.dumps_typed(checkpoint)
+            self._cache_store(
+                (configurable["thread_id"], configurable["checkpoint_ns"]),
+                _CachedCheckpoint(
+                    copy.deepcopy(next_config), type_, data,
+                    get_checkpoint_metadata(config, metadata), parent_config,
+                ),
+            )
+        return next_config
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        super().put_writes(config, writes, task_id, task_path)
+        self._count(self.write_stats, "writes")
+        _count_write("writes")
+        # La entrada cacheada no lleva pending_writes: deja de ser fiel
+        configurable = config["configurable"]
+        key = (configurable["thread_id"], configurable.get("checkpoint_ns", ""))
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry and entry.checkpoint_id == configurable.get("checkpoint_id"):
+                del self._cache[key]
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        self.invalidate(thread_id)
+
+    # --- Wrappers async (mismo patrón que MongoDBSaver: executor) ---
+
+    async def aregister_fork(
+        self,
+        thread_id: str,
+        parent_thread_id: str,
+        parent_checkpoint_id: str,
+        checkpoint_ns: str = "",
+    ) -> dict:
+        return await run_in_executor(
+            None, self.register_fork, thread_id, parent_thread_id, parent_checkpoint_id, checkpoint_ns
+        )
+
+    async def aresolve_checkpoint_id(
+        self,
+        thread_id: str,
+        checkpoint_id: Optional[str] = None,
+        checkpoint_ns: str = "",
+    ) -> Optional[str]:
+        return await run_in_executor(None, self.resolve_checkpoint_id, thread_id, checkpoint_id, checkpoint_ns)
+
+    async def ahas_forks(self, thread_id: str) -> bool:
+        return await run_in_executor(None, self.has_forks, thread_id)
+
+    async def adelete_fork(self, thread_id: str) -> None:
+        return await run_in_executor(None, self.delete_fork, thread_id)
+
+    async def aget_fork(self, thread_id: str, checkpoint_ns: str = "") -> Optional[dict]:
+        return await run_in_executor(None, self.get_fork, thread_id, checkpoint_ns)
+
+    async def arelease_thread(
+        self,
+        thread_id: str,
+        has_session: Callable[[str], Awaitable[bool]],
+    ) -> List[str]:
+        """
+        Borra los checkpoints de un thread cuya sesión se eliminó.
+
+        Si algún fork depende de ellos se conservan, junto con su propio
+        registro de fork (sus hijos siguen resolviendo la cadena a través de
+        él). Al borrar un fork se sube por la cadena: un padre sin sesión
+        (`has_session` False) del que ya no cuelga ningún fork se borra también.
+        Devuelve los threads borrados.
+        """
+        released = []
+        while thread_id and not await self.ahas_forks(thread_id):
+            fork = await self.aget_fork(thread_id)
+            await self.adelete_thread(thread_id)
+            await self.adelete_fork(thread_id)
+            released.append(thread_id)
+            parent = fork["parent_thread_id"] if fork else None
+            if not parent or await has_session(parent):
+                break
+            thread_id = parent
+        return released
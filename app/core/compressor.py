@@ -0,0 +1,207 @@
+"""
+Compresión extractiva de los pasajes recuperados.
+
+Un chunk relevante ocupa ~512 tokens, pero a menudo solo dos o tres frases
+responden a la pregunta. Antes de llenar el presupuesto del contexto, cada
+pasaje se reduce a sus frases mejor puntuadas contra la query más
+RAG_COMPRESSION_WINDOW frases vecinas a cada lado (para no perder el hilo).
+
+Puntuación de cada frase (local, en CPU, unos milisegundos): BM25 de la
+query sobre las frases de todos los pasajes del turno (el IDF sale de ese
+mismo conjunto), mezclado con el coseno entre trigramas de caracteres de la
+query y de la frase, que tolera flexiones ("margen"/"márgenes") que BM25
+trata como términos distintos.
+
+Opcional (RAG_COMPRESSION_SEMANTIC_WEIGHT > 0, desactivada por defecto):
+coseno entre el embedding de la query y el de cada frase candidata
+(candidate_sentences), vectorizadas por rag.sentence_similarities en un
+lote a OpenAI antes de la llamada al experto. Añade hasta
+RAG_COMPRESSION_SEMANTIC_TIMEOUT_MS al primer token por cada chunk que no
+esté en la caché en proceso; con fallo o timeout la puntuación es solo
+léxica.
+
+Un pasaje sin ningún término de la query ni señal semántica se deja entero:
+lo trajo la búsqueda vectorial por motivos que aquí no se ven.
+"""
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from itertools import chain
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.core.lexical import BM25Index, tokenize
+
+RAG_COMPRESSION = os.getenv("RAG_COMPRESSION", "true").lower() == "true"
+RAG_COMPRESSION_RATIO = float(os.getenv("RAG_COMPRESSION_RATIO", "0.4"))  # fracción del pasaje que se conserva
+RAG_COMPRESSION_WINDOW = int(os.getenv("RAG_COMPRESSION_WINDOW", "1"))   # frases vecinas por cada frase elegida
+# Peso de la señal semántica (llamada a OpenAI en el camino del turno); 0 = solo léxica
+RAG_COMPRESSION_SEMANTIC_WEIGHT = float(os.getenv("RAG_COMPRESSION_SEMANTIC_WEIGHT", "0"))
+RAG_COMPRESSION_MAX_SENTENCES = int(os.getenv("RAG_COMPRESSION_MAX_SENTENCES", "128"))  # frases vectorizadas por turno
+# Pasajes más cortos no compensan la compresión
+MIN_COMPRESS_CHARS = 600
+BM25_WEIGHT = 0.6  # dentro de la parte léxica; el resto va al coseno de trigramas
+GAP_MARKER = " […] "
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """Spans (inicio, fin) de las frases/líneas de un texto."""
+    spans: List[Tuple[int, int]] = []
+    start = 0
+    for match in _SENTENCE_SPLIT.finditer(text):
+        if text[start:match.start()].strip():
+            spans.append((start, match.start()))
+        start = match.end()
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+@lru_cache(maxsize=8192)
+def _word_trigrams(word: str) -> Tuple[str, ...]:
+    padded = f" {word} "
+    return tuple(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def _trigrams(text: str) -> Counter:
+    return Counter(chain.from_iterable(_word_trigrams(word) for word in tokenize(text)))
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    if not a or not b:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    return dot / (math.hypot(*a.values()) * math.hypot(*b.values())) if dot else 0.0
+
+
+def _sentence_key(sentence: str) -> str:
+    return " ".join(sentence.split())
+
+
+def candidate_sentences(passages: Sequence[dict], limit: Optional[int] = None) -> List[str]:
+    """
+    Frases de los pasajes comprimibles, en orden de pasaje (los mejores
+    primero) y sin repetir, hasta `limit` (RAG_COMPRESSION_MAX_SENTENCES).
+    Son las que se vectorizan para la señal semántica.
+    """
+    limit = RAG_COMPRESSION_MAX_SENTENCES if limit is None else limit
+    seen: Dict[str, None] = {}
+    for doc in passages:
+        text = doc.get("content_markdown") or ""
+        if len(text) < MIN_COMPRESS_CHARS:
+            continue
+        for start, end in split_sentences(text):
+            seen.setdefault(_sentence_key(text[start:end]))
+            if len(seen) >= limit:
+                return list(seen)
+    return list(seen)
+
+
+def _semantic_scale(semantic: Dict[str, float]) -> Tuple[float, float]:
+    """(mínimo, rango) de los cosenos del turno: se reescalan a [0, 1] como el BM25."""
+    if not semantic:
+        return 0.0, 1.0
+    low, high = min(semantic.values()), max(semantic.values())
+    return low, (high - low) or 1.0
+
+
+def _select(spans: List[Tuple[int, int]], scores: List[float], ratio: float, window: int) -> List[int]:
+    """Índices de las frases a conservar (mejores hasta ratio + vecinas)."""
+    target = ratio * sum(end - start for start, end in spans)
+    chosen, kept = set(), 0
+    for i in sorted(range(len(spans)), key=lambda i: -scores[i]):
+        if scores[i] <= 0 or (chosen and kept >= target):
+            break
+        chosen.add(i)
+        kept += spans[i][1] - spans[i][0]
+    expanded = set()
+    for i in chosen:
+        expanded.update(range(max(0, i - window), min(len(spans), i + window + 1)))
+    return sorted(expanded)
+
+
+def _join(text: str, spans: List[Tuple[int, int]], keep: List[int]) -> str:
+    """Une las frases conservadas; los huecos se marcan con GAP_MARKER."""
+    parts: List[str] = []
+    run_start = prev = None
+    for i in keep:
+        if prev is not None and i == prev + 1:
+            prev = i
+            continue
+        if run_start is not None:
+            parts.append(text[spans[run_start][0]:spans[prev][1]])
+        run_start = prev = i
+    parts.append(text[spans[run_start][0]:spans[prev][1]])
+    prefix = GAP_MARKER.lstrip() if keep[0] > 0 else ""
+    suffix = GAP_MARKER.rstrip() if keep[-1] < len(spans) - 1 else ""
+    return prefix + GAP_MARKER.join(parts) + suffix
+
+
+def compress_passages(
+    query: str,
+    passages: Sequence[dict],
+    ratio: Optional[float] = None,
+    window: Optional[int] = None,
+    semantic: Optional[Dict[str, float]] = None,
+) -> List[dict]:
+    """
+    Devuelve los pasajes con content_markdown reducido a las frases que
+    responden a la query. Los que no se comprimen se devuelven tal cual.
+    `semantic`: coseno query–frase por frase (rag.sentence_similarities);
+    las frases que no aparecen puntúan solo por la parte léxica.
+    """
+    ratio = RAG_COMPRESSION_RATIO if ratio is None else ratio
+    window = RAG_COMPRESSION_WINDOW if window is None else window
+    if not query or ratio >= 1:
+        return list(passages)
+    semantic = semantic or {}
+    semantic_weight = RAG_COMPRESSION_SEMANTIC_WEIGHT if semantic else 0.0
+
+    index = BM25Index()
+    sentences: Dict[int, List[Tuple[int, int]]] = {}
+    for p, doc in enumerate(passages):
+        text = doc.get("content_markdown") or ""
+        if len(text) < MIN_COMPRESS_CHARS:
+            continue
+        sentences[p] = split_sentences(text)
+        for s, (start, end) in enumerate(sentences[p]):
+            index.add((p, s), text[start:end])
+    if not sentences:
+        return list(passages)
+
+    lexical = dict(index.search(query, len(index)))
+    max_lexical = max(lexical.values(), default=0.0) or 1.0
+    query_grams = _trigrams(query)
+    low, spread = _semantic_scale(semantic)
+
+    result: List[dict] = []
+    for p, doc in enumerate(passages):
+        spans = sentences.get(p)
+        if not spans:
+            result.append(doc)
+            continue
+        text = doc["content_markdown"]
+        keys = [_sentence_key(text[start:end]) for start, end in spans]
+        if not any((p, s) in lexical for s in range(len(spans))) and not any(key in semantic for key in keys):
+            result.append(doc)
+            continue
+        scores = []
+        for s, (start, end) in enumerate(spans):
+            score = (
+                BM25_WEIGHT * lexical.get((p, s), 0.0) / max_lexical
+                + (1 - BM25_WEIGHT) * _cosine(query_grams, _trigrams(text[start:end]))
+            )
+            if keys[s] in semantic:
+                score = (1 - semantic_weight) * score + semantic_weight * (semantic[keys[s]] - low) / spread
+            scores.append(score)
+        keep = _select(spans, scores, ratio, window)
+        if len(keep) == len(spans):
+            result.append(doc)
+            continue
+        result.append({**doc, "content_markdown": _join(text, spans, keep)})
+    return result
@@ -0,0 +1,187 @@
+"""
+Ensamblado del bloque CONTEXTO del prompt con presupuesto en tokens.
+
+Sustituye el recorte fijo por caracteres (content_markdown[:2000]):
+1. Une los chunks contiguos de un mismo archivo (source_file_id +
+   chunk_index consecutivo) en un solo pasaje, quitando el solape que
+   chunk_text repite entre chunks vecinos.
+2. Si hay query (y RAG_COMPRESSION), reduce cada pasaje a las frases que
+   la responden (compresión extractiva, ver app.core.compressor).
+3. Ordena los pasajes por score (mejor primero).
+4. Llena el presupuesto del turno (RAG_CONTEXT_TOKENS) pasaje a pasaje; el
+   último que no cabe entero se corta en frontera de frase.
+
+El ContextPlan resultante informa de los tokens de contexto inyectados y
+de los que ahorró la compresión.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from app.core import compressor
+from app.core.token_budget import count_tokens, get_encoding
+
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+# Por debajo de esto no merece la pena cortar un pasaje para que quepa
+MIN_PASSAGE_TOKENS = 48
+# El solape de chunk_text son 64 tokens (~300-400 caracteres)
+MAX_OVERLAP_CHARS = 1200
+MIN_OVERLAP_CHARS = 16
+
+_SENTENCE_END = re.compile(r"[.!?…:;](?=\s)|\n\s*\n")
+_CHUNK_TITLE = re.compile(r"\(chunk (\d+)\)$")
+
+
+def render_passage(doc: dict) -> str:
+    """Formato de un pasaje dentro del bloque CONTEXTO."""
+    return f"---\nFUENTE: {doc.get('title')}\nCONTENIDO: {doc.get('content_markdown', '')}\n\n"
+
+
+def merge_overlap(first: str, second: str) -> str:
+    """Concatena dos chunks consecutivos quitando el texto repetido al inicio del segundo."""
+    head = second[:MIN_OVERLAP_CHARS]
+    if len(head) == MIN_OVERLAP_CHARS:
+        start = max(0, len(first) - MAX_OVERLAP_CHARS)
+        pos = first.find(head, start)
+        while pos != -1:
+            tail = first[pos:]
+            if second.startswith(tail):
+                return first + second[len(tail):]
+            pos = first.find(head, pos + 1)
+    return f"{first}\n{second}"
+
+
+def cut_at_sentence(text: str, max_tokens: int, model: str = "deepseek-chat") -> str:
+    """Recorta a max_tokens terminando en el último final de frase (o de palabra)."""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    prefix = encoding.decode(tokens[:max_tokens])
+    ends = [m.end() for m in _SENTENCE_END.finditer(prefix)]
+    if ends and ends[-1] >= len(prefix) // 2:
+        return prefix[:ends[-1]].rstrip()
+    space = prefix.rfind(" ")
+    return (prefix[:space] if space > 0 else prefix).rstrip() + " …"
+
+
+@dataclass
+class ContextPlan:
+    """Pasajes que entran en el prompt + contabilidad del contexto."""
+    passages: List[dict]
+    budget: int
+    tokens: int = 0
+    merged: int = 0        # chunks unidos a un vecino
+    truncated: int = 0     # pasajes cortados en frontera de frase
+    dropped: int = 0       # pasajes que no cupieron
+    compressed: int = 0    # pasajes reducidos a sus frases relevantes
+    saved: int = 0         # tokens ahorrados por la compresión
+
+    def summary(self) -> str:
+        return (
+            f"{self.tokens}/{self.budget} tokens en {len(self.passages)} fuentes "
+            f"(unidos={self.merged} recortados={self.truncated} descartados={self.dropped} "
+            f"comprimidos={self.compressed} ahorro={self.saved} tokens)"
+        )
+
+
+def _chunks(doc: dict) -> List[dict]:
+    """El snippet más los vecinos que el colapso de contiguos le adjuntó."""
+    return [doc, *doc.get("adjacent", [])]
+
+
+def _group_passages(snippets: Sequence[dict]) -> List[dict]:
+    """Une en pasajes los chunks contiguos del mismo archivo."""
+    by_file: Dict[str, Dict[int, dict]] = {}
+    passages: List[dict] = []
+    for rank, doc in enumerate(snippets):
+        file_id = doc.get("source_file_id")
+        for chunk in _chunks(doc):
+            index = chunk.get("chunk_index")
+            if file_id is None or index is None:
+                passages.append({"docs": [doc], "score": doc.get("score"), "rank": rank})
+                break
+            by_file.setdefault(file_id, {}).setdefault(index, {**chunk, "_rank": rank, "_doc": doc})
+
+    for chunks in by_file.values():
+        run: List[dict] = []
+        for index in sorted(chunks):
+            if run and index != run[-1]["chunk_index"] + 1:
+                passages.append(_run_passage(run))
+                run = []
+            run.append(chunks[index])
+        if run:
+            passages.append(_run_passage(run))
+    return passages
+
+
+def _run_passage(run: List[dict]) -> dict:
+    owners = {id(c["_doc"]): c["_doc"] for c in run}.values()
+    scores = [d.get("score") for d in owners if d.get("score") is not None]
+    return {
+        "docs": run,
+        "score": max(scores) if scores else None,
+        "rank": min(c["_rank"] for c in run),
+    }
+
+
+def _passage_doc(passage: dict) -> dict:
+    docs = passage["docs"]
+    content = docs[0].get("content_markdown", "") or ""
+    for doc in docs[1:]:
+        content = merge_overlap(content, doc.get("content_markdown", "") or "")
+    title = docs[0].get("title") or docs[0].get("_doc", {}).get("title")
+    if len(docs) > 1 and title:
+        title = _CHUNK_TITLE.sub(f"(chunks {docs[0]['chunk_index']}-{docs[-1]['chunk_index']})", title)
+    return {"title": title, "content_markdown": content}
+
+
+def assemble_context(
+    snippets: Sequence[dict],
+    budget: Optional[int] = None,
+    model: str = "deepseek-chat",
+    query: Optional[str] = None,
+    semantic: Optional[Dict[str, float]] = None,
+) -> ContextPlan:
+    """
+    Pasajes listos para el prompt dentro de `budget` tokens (default
+    RAG_CONTEXT_TOKENS), mejor primero. Con `query` se comprimen antes de
+    repartir el presupuesto; `semantic` (rag.sentence_similarities) añade la
+    señal de embeddings a la puntuación de cada frase.
+    """
+    budget = RAG_CONTEXT_TOKENS if budget is None else budget
+    passages = _group_passages(snippets)
+    if all(p["score"] is not None for p in passages):
+        passages.sort(key=lambda p: (-p["score"], p["rank"]))
+    else:
+        passages.sort(key=lambda p: p["rank"])
+
+    plan = ContextPlan(passages=[], budget=budget)
+    plan.merged = sum(len(p["docs"]) - 1 for p in passages)
+    docs = [_passage_doc(p) for p in passages]
+    if query and compressor.RAG_COMPRESSION:
+        compressed = compressor.compress_passages(query, docs, semantic=semantic)
+        for original, doc in zip(docs, compressed):
+            if doc is not original:
+                plan.compressed += 1
+                plan.saved += (
+                    count_tokens(original["content_markdown"], model)
+                    - count_tokens(doc["content_markdown"], model)
+                )
+        docs = compressed
+
+    for doc in docs:
+        remaining = budget - plan.tokens
+        tokens = count_tokens(render_passage(doc), model)
+        if tokens > remaining:
+            overhead = tokens - count_tokens(doc["content_markdown"], model)
+            if remaining - overhead < MIN_PASSAGE_TOKENS:
+                plan.dropped += 1
+                continue
+            doc["content_markdown"] = cut_at_sentence(doc["content_markdown"], remaining - overhead, model)
+            tokens = count_tokens(render_passage(doc), model)
+            plan.truncated += 1
+        plan.passages.append(doc)
+        plan.tokens += tokens
+    return plan
@@ -0,0 +1,110 @@
+"""
+Diversificación post-retrieval de los chunks recuperados.
+
+chunk_text solapa 64 tokens entre chunks consecutivos, así que el top-k de
+la búsqueda suele traer vecinos del mismo archivo que repiten texto en el
+prompt. Sobre los candidatos (sobre-recuperados con su embedding):
+
+1. collapse_adjacent: de cada racha de chunks contiguos del mismo archivo
+   (source_file_id igual, chunk_index consecutivo) queda el mejor situado;
+   los vecinos viajan en su campo "adjacent" para que el ensamblador de
+   contexto los una sin solape si el presupuesto lo permite.
+2. mmr_select: maximal marginal relevance vectorizado con NumPy. La
+   relevancia es la posición en el ranking previo (vectorial o fusionado),
+   la redundancia el coseno con lo ya elegido.
+
+Para ~10-20 candidatos la selección cuesta unas decenas de microsegundos.
+"""
+from typing import Dict, List
+
+# Campos que no se guardan en el estado del grafo (snippet_refs)
+_NOT_STORED = {"embedding", "embedding_short", "adjacent", "title", "content_markdown"}
+
+
+def collapse_adjacent(candidates: List[dict]) -> List[dict]:
+    """
+    Pliega los chunks contiguos (mismo archivo, índice ±1) en el mejor
+    situado de su racha, que los guarda en "adjacent".
+    """
+    kept: List[dict] = []
+    owner: Dict[tuple, dict] = {}
+    for doc in candidates:
+        file_id, index = doc.get("source_file_id"), doc.get("chunk_index")
+        if file_id is None or index is None:
+            kept.append(doc)
+            continue
+        head = owner.get((file_id, index - 1)) or owner.get((file_id, index + 1))
+        if head is not None:
+            # La racha entera cuelga del primer chunk
+            head.setdefault("adjacent", []).append({k: v for k, v in doc.items() if k != "embedding"})
+            owner[(file_id, index)] = head
+            continue
+        doc = dict(doc)
+        owner[(file_id, index)] = doc
+        kept.append(doc)
+    return kept
+
+
+def mmr_select(candidates: List[dict], k: int, lambda_mult: float = 0.7) -> List[dict]:
+    """
+    Elige k candidatos maximizando λ·relevancia − (1−λ)·máx. similitud con
+    los ya elegidos. Sin embeddings (o con k >= n) respeta el orden recibido.
+    """
+    import numpy as np
+
+    n = len(candidates)
+    if n <= k or k <= 0:
+        return candidates[:max(k, 0)]
+    embeddings = [doc.get("embedding") for doc in candidates]
+    if any(e is None or len(e) == 0 for e in embeddings):
+        return candidates[:k]
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    similarity = matrix @ matrix.T
+    relevance = 1.0 - np.arange(n, dtype=np.float32) / n
+
+    selected = [0]
+    max_sim = similarity[0].copy()
+    available = np.ones(n, dtype=bool)
+    available[0] = False
+    for _ in range(k - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_sim
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_sim, similarity[best], out=max_sim)
+    return [candidates[i] for i in selected]
+
+
+def strip_vectors(docs: List[dict]) -> List[dict]:
+    """Quita el embedding antes de que los snippets lleguen al estado del grafo."""
+    return [{key: value for key, value in doc.items() if key != "embedding"} for doc in docs]
+
+
+def snippet_refs(docs: List[dict]) -> List[dict]:
+    """
+    Snippets tal como se guardan en el estado del grafo (y en cada checkpoint):
+    sin embeddings ni texto, solo chunk_id, score y posición (también de sus
+    vecinos "adjacent"). rag.rehydrate_snippets recupera el texto de
+    knowledge_base al reutilizarlos (loop ReAct, regeneración), de modo que
+    se ensambla el mismo contexto que en la respuesta original. Un snippet
+    sin chunk_id (búsqueda síncrona de scripts) conserva su texto.
+    """
+    refs = []
+    for doc in docs:
+        ref = {key: value for key, value in doc.items() if key not in _NOT_STORED}
+        if not doc.get("chunk_id"):
+            ref.update(title=doc.get("title"), content_markdown=doc.get("content_markdown"))
+        elif doc.get("adjacent"):
+            ref["adjacent"] = snippet_refs(doc["adjacent"])
+        refs.append(ref)
+    return refs
+
+
+def diversify(candidates: List[dict], k: int, lambda_mult: float = 0.7) -> List[dict]:
+    """Colapso de contiguos + MMR; devuelve k snippets sin embedding."""
+    return strip_vectors(mmr_select(collapse_adjacent(candidates), k, lambda_mult))
@@ -6,7 +6,7 @@ import os
 import asyncio
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import List, Set
 from datetime import datetime, timezone
 
 from app.core.logger import api_logger as logger
@@ -190,14 +190,17 @@ async def store_document_vectors(
     chunks: List[DocumentChunk],
     embeddings: List[List[float]],
 ) -> int:
-    """Guarda chunks embebidos en knowledge_base con agent_target = agent_id."""
+    """Guarda chunks embebidos en knowledge_base con agent_target = agent_id (vectores según EMBED_STORAGE)."""
     from app.core.database import db
     collection = db.get_async_db()["knowledge_base"]
 
+    from app.core.vector_codec import encode_vector
+    from app.core.vector_store import EMBED_SHORT_DIMS, SHORT_FIELD, shorten
+
     docs = []
     for chunk, embedding in zip(chunks, embeddings):
         docs.append({
-            "embedding": embedding,
+            "embedding": encode_vector(embedding),
             "agent_target": agent_id,
             "source_file_id": file_id,
             "source_filename": filename,
@@ -207,13 +210,54 @@ async def store_document_vectors(
             "token_count": chunk.token_count,
             "created_at": datetime.now(timezone.utc)
         })
+        if EMBED_SHORT_DIMS:
+            # Vector corto para la 1ª etapa de la búsqueda (equivale a dimensions=EMBED_SHORT_DIMS)
+            docs[-1][SHORT_FIELD] = encode_vector(shorten(embedding, EMBED_SHORT_DIMS))
 
     if docs:
         await collection.insert_many(docs)
+        # insert_many añade _id a cada doc: el vector store local los indexa ya
+        from app.core.vector_store import get_vector_store, knowledge_stats
+        await get_vector_store().add(docs)
+        await knowledge_stats.record(agent_id, len(docs))
 
     return len(docs)
 
 
+# --- REFRESCO TRAS CAMBIOS EN LA KB ---
+
+# Referencias a las tareas en curso (asyncio solo guarda referencias débiles)
+_background: Set[asyncio.Task] = set()
+
+
+async def refresh_agent_knowledge(agent_id: str) -> None:
+    """
+    Recalcula lo que depende de la KB de un agente: su perfil vectorial
+    (router de sesiones GROUP) y sus respuestas precalentadas. Un fallo en un
+    paso se registra y no impide el siguiente.
+    """
+    from app.core.agent_profiles import refresh_agent_profile
+    from app.core.answer_warming import rewarm_agent
+
+    for step in (refresh_agent_profile, rewarm_agent):
+        try:
+            await step(agent_id)
+        except Exception as e:
+            logger.error(f"Error en {step.__name__} para el agente {agent_id}: {e}", exc_info=True)
+
+
+def schedule_agent_refresh(agent_id: str) -> asyncio.Task:
+    """
+    Lanza refresh_agent_knowledge sin esperarlo: la ingesta no bloquea en las
+    llamadas al LLM del precalentado, y un fallo ahí no puede marcar como
+    fallido un documento cuyos vectores ya están almacenados.
+    """
+    task = asyncio.create_task(refresh_agent_knowledge(agent_id))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
 # --- PIPELINE COMPLETO ---
 
 async def process_document(
@@ -262,6 +306,10 @@ async def process_document(
             {"$inc": {"documents_count": 1}}
         )
 
+        # 7. Perfil vectorial y respuestas precalentadas, en background: el
+        # documento ya está almacenado y contado
+        schedule_agent_refresh(agent_id)
+
         logger.info(f"Documento {filename} procesado: {stored} chunks almacenados")
         return {"status": "completed", "chunks_stored": stored}
 
@@ -293,6 +341,9 @@ async def delete_document_vectors(agent_id: str, file_id: str) -> int:
         "agent_target": agent_id,
         "source_file_id": file_id
     })
+    from app.core.vector_store import get_vector_store, knowledge_stats
+    await get_vector_store().delete(agent_id, source_file_id=file_id)
+    await knowledge_stats.record(agent_id, -result.deleted_count)
     return result.deleted_count
 
 
@@ -301,4 +352,7 @@ async def delete_agent_vectors(agent_id: str) -> int:
     from app.core.database import db
     collection = db.get_async_db()["knowledge_base"]
     result = await collection.delete_many({"agent_target": agent_id})
+    from app.core.vector_store import get_vector_store, knowledge_stats
+    await get_vector_store().delete(agent_id)
+    await knowledge_stats.reset(agent_id)
     return result.deleted_count
@@ -0,0 +1,97 @@
+"""
+Micro-batching de embeddings de queries entre turnos concurrentes.
+
+Cada turno pide el vector de su query con submit(). Las peticiones que
+llegan dentro de una ventana corta (EMBED_BATCH_WINDOW_MS) se envían en una
+única llamada `embeddings.create(input=[...])`; si se juntan
+EMBED_BATCH_MAX antes de que acabe la ventana, el lote sale en ese momento.
+Cada llamante recibe su vector (o la excepción del lote).
+
+Con tráfico bajo el coste es como mucho la ventana (pocos ms); con tráfico
+alto ahorra overhead HTTP y presión sobre el rate limit de OpenAI.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from app.core.logger import rag_logger as logger
+
+EMBED_BATCHING = os.getenv("EMBED_BATCHING", "true").lower() == "true"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "64"))
+
+
+class EmbeddingBatcher:
+    """Agrupa peticiones de embedding concurrentes en llamadas por lotes."""
+
+    def __init__(
+        self,
+        embed_many: Callable[[List[str]], Awaitable[List[List[float]]]],
+        window_ms: float = EMBED_BATCH_WINDOW_MS,
+        max_batch: int = EMBED_BATCH_MAX,
+    ):
+        self.embed_many = embed_many
+        self.window_ms = window_ms
+        self.max_batch = max(1, max_batch)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running: Set[asyncio.Task] = set()
+        self._stats = {"requests": 0, "batches": 0, "max_batch_size": 0, "errors": 0}
+
+    async def submit(self, text: str) -> List[float]:
+        """Vector de `text`, calculado en el próximo lote."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self._stats["requests"] += 1
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Los llamantes cancelados durante la ventana no entran en el lote
+        batch = [(text, fut) for text, fut in self._pending if not fut.done()]
+        self._pending = []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # Textos repetidos dentro del lote se envían una sola vez
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self._stats["batches"] += 1
+        self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(texts))
+        try:
+            vectors = dict(zip(texts, await self.embed_many(texts)))
+        except asyncio.CancelledError:
+            for _, fut in batch:
+                fut.cancel()
+            raise
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Lote de {len(texts)} embeddings falló: {e}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for text, fut in batch:
+            if not fut.done():
+                fut.set_result(vectors[text])
+
+    def stats(self) -> dict:
+        """Métricas de batching (expuestas en /health)."""
+        batches = self._stats["batches"]
+        return {
+            **self._stats,
+            "window_ms": self.window_ms,
+            "avg_batch_size": round(self._stats["requests"] / batches, 2) if batches else None,
+        }
@@ -0,0 +1,142 @@
+"""
+Caché de embeddings de queries en dos niveles.
+
+- L1: LRU en proceso (EMBED_CACHE_SIZE entradas).
+- L2: colección `embedding_cache` en Mongo con índice TTL, compartida entre
+  workers y reinicios.
+
+La clave es sha256(modelo + texto normalizado): cambiar de modelo nunca
+devuelve vectores del anterior. Las peticiones concurrentes de la misma
+query esperan a una única llamada en vuelo (protección contra estampidas),
+y cancelar a uno de los que esperan no cancela la llamada compartida.
+"""
+import asyncio
+import hashlib
+import os
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Set
+
+from app.core.database import db
+from app.core.logger import rag_logger as logger
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))           # 0 = sin L1
+EMBED_CACHE_TTL_DAYS = int(os.getenv("EMBED_CACHE_TTL_DAYS", "30"))
+EMBED_CACHE_PERSIST = os.getenv("EMBED_CACHE_PERSIST", "true").lower() == "true"
+
+
+def get_embedding_cache_collection():
+    return db.get_async_db()["embedding_cache"]
+
+
+def normalize_text(text: str) -> str:
+    """Forma canónica de una query: NFC, minúsculas y espacios colapsados."""
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """LRU en proceso + Mongo TTL con coalescencia de peticiones en vuelo."""
+
+    def __init__(self, size: int = EMBED_CACHE_SIZE, persist: bool = EMBED_CACHE_PERSIST):
+        self.size = size
+        self.persist = persist
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self._stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+    async def get_or_compute(
+        self,
+        model: str,
+        text: str,
+        compute: Callable[[str], Awaitable[List[float]]],
+    ) -> List[float]:
+        """Vector de `text` desde L1, L2 o `compute` (una sola llamada por clave)."""
+        key = cache_key(model, text)
+
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+            self._stats["l1_hits"] += 1
+            return vector
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self._load(key, model, text, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield: si este llamante se cancela, la llamada compartida sigue
+        return await asyncio.shield(task)
+
+    async def _load(
+        self,
+        key: str,
+        model: str,
+        text: str,
+        compute: Callable[[str], Awaitable[List[float]]],
+    ) -> List[float]:
+        if self.persist:
+            try:
+                doc = await get_embedding_cache_collection().find_one({"_id": key}, {"vector": 1})
+                if doc:
+                    self._stats["l2_hits"] += 1
+                    self._remember(key, doc["vector"])
+                    return doc["vector"]
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Caché de embeddings (Mongo) no disponible: {e}")
+
+        self._stats["misses"] += 1
+        vector = await compute(text)
+        self._remember(key, vector)
+        if self.persist:
+            persist_task = asyncio.create_task(self._persist(key, model, vector))
+            self._background.add(persist_task)
+            persist_task.add_done_callback(self._background.discard)
+        return vector
+
+    async def _persist(self, key: str, model: str, vector: List[float]) -> None:
+        try:
+            await get_embedding_cache_collection().update_one(
+                {"_id": key},
+                {"$set": {"model": model, "vector": vector, "created_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"No se pudo persistir el embedding en caché: {e}")
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        if self.size <= 0:
+            return
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def clear(self) -> None:
+        self._lru.clear()
+
+    def stats(self) -> dict:
+        """Métricas de la caché (expuestas en /health)."""
+        hits = self._stats["l1_hits"] + self._stats["l2_hits"]
+        lookups = hits + self._stats["misses"] + self._stats["coalesced"]
+        return {
+            **self._stats,
+            "size": len(self._lru),
+            "capacity": self.size,
+            "persist": self.persist,
+            "hit_rate": round((hits + self._stats["coalesced"]) / lookups, 3) if lookups else None,
+        }
+
+
+embedding_cache = EmbeddingCache()
+
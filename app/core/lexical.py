@@ -0,0 +1,120 @@
+"""
+Recuperación léxica (BM25) y fusión de rankings para el RAG híbrido.
+
+La búsqueda vectorial falla con términos exactos (tickers, nombres de
+producto, números de cláusula, siglas). El índice BM25 sobre
+content_markdown los recupera, y reciprocal_rank_fusion combina ambos
+rankings sin tener que calibrar sus scores (que no son comparables).
+"""
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, Hashable, Iterable, List, Sequence
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+# Palabras vacías frecuentes (ES/EN): no aportan a BM25 y alargan las posting lists
+STOPWORDS = frozenset("""
+a al algo como con de del el en es esta este la las lo los mas me mi no o para pero por que se si sin
+su sus un una uno y ya the of and or to in is it for on with as by be at this that are
+""".split())
+
+_TOKEN_RE = re.compile(r"[\w][\w.\-/]*[\w]|\w")
+# Bloques Unicode de marcas combinantes (tildes, diéresis...) tras NFKD
+_COMBINING_RE = re.compile("[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tokens en minúsculas y sin tildes. Conserva juntos los términos con
+    puntos, guiones o barras ("AAPL", "v2.1", "cláusula 4.3", "ISO-27001").
+    """
+    text = _COMBINING_RE.sub("", unicodedata.normalize("NFKD", (text or "").lower()))
+    return [tok for tok in _TOKEN_RE.findall(text) if tok not in STOPWORDS]
+
+
+class BM25Index:
+    """Índice invertido BM25 en memoria con altas y bajas incrementales."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[Hashable, int]] = defaultdict(dict)
+        self._lengths: Dict[Hashable, int] = {}
+        self._doc_terms: Dict[Hashable, List[str]] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, doc_id: Hashable, text: str) -> None:
+        if doc_id in self._lengths:
+            self.remove([doc_id])
+        tokens = tokenize(text)
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            self._postings[term][doc_id] = tf
+        self._doc_terms[doc_id] = list(counts)
+        self._lengths[doc_id] = len(tokens)
+        self._total_length += len(tokens)
+
+    def remove(self, doc_ids: Iterable[Hashable]) -> None:
+        for doc_id in doc_ids:
+            if doc_id not in self._lengths:
+                continue
+            for term in self._doc_terms.pop(doc_id):
+                postings = self._postings[term]
+                del postings[doc_id]
+                if not postings:
+                    del self._postings[term]
+            self._total_length -= self._lengths.pop(doc_id)
+
+    def search(self, query: str, limit: int) -> List[tuple]:
+        """[(doc_id, score)] por score BM25 descendente."""
+        n = len(self._lengths)
+        if not n or limit <= 0:
+            return []
+        avg_length = self._total_length / n or 1.0
+        scores: Dict[Hashable, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+def term_overlap(query: str, text: str) -> float:
+    """Fracción de los términos distintos de la query (sin palabras vacías) que aparecen en el texto."""
+    terms = set(tokenize(query))
+    if not terms:
+        return 0.0
+    return len(terms & set(tokenize(text))) / len(terms)
+
+
+def result_key(doc: dict) -> tuple:
+    """Identidad de un resultado entre rankings (las búsquedas no devuelven _id)."""
+    return (doc.get("title"), doc.get("content_markdown"))
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[dict]], limit: int, k: int = RRF_K) -> List[dict]:
+    """
+    Fusiona rankings con RRF: score = Σ 1 / (k + posición). Un documento que
+    aparece en ambas listas sube; el 'score' resultante es el de la fusión.
+    """
+    fused: Dict[tuple, float] = defaultdict(float)
+    docs: Dict[tuple, dict] = {}
+    for ranking in rankings:
+        for position, doc in enumerate(ranking, start=1):
+            key = result_key(doc)
+            fused[key] += 1.0 / (k + position)
+            docs.setdefault(key, doc)
+    ordered = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{**docs[key], "score": round(score, 6)} for key, score in ordered]
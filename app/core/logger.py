@@ -99,3 +99,4 @@ db_logger = get_logger("sphere.database")
 api_logger = get_logger("sphere.api")
 stream_logger = get_logger("sphere.stream")
 checkpoint_logger = get_logger("sphere.checkpoint")
+rag_logger = get_logger("sphere.rag")
@@ -1,18 +1,32 @@
 import os
+import re
+import time
 from pathlib import Path
 from typing import TypedDict, Literal, List, Optional, Annotated
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, BaseMessage
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 from dotenv import load_dotenv
 
 # Importar RAG, DB y Logger
-from app.core.rag import retrieve_context
+from app.core.rag import (
+    RetrievalFailed, empty_context_message, format_context, format_snippet, embed_query, rehydrate_snippets,
+    sentence_similarities,
+)
+from app.core.session_retrieval import retrieve_for_session
+from app.core.agent_profiles import core_role_for_member, route_to_member
+from app.core.token_budget import count_tool_tokens, fit_prompt
+from app.core.context_assembler import assemble_context
+from app.core.compressor import RAG_COMPRESSION_SEMANTIC_WEIGHT
+from app.core.diversify import snippet_refs
 from app.core.database import db, get_custom_agents_collection
 from app.core.logger import checkpoint_logger as logger
-from langgraph.checkpoint.mongodb import MongoDBSaver
+from app.core.checkpointing import ForkAwareMongoDBSaver
+from app.core.turn_context import get_turn_context
+from app.core.reasoning import is_reasoning_model, build_reasoning_llm, pop_reasoning, strip_reasoning, store_reasoning
 
 # Tool Registry
 from app.tools.registry import get_tools_for_role
@@ -31,7 +45,8 @@ llm_router = ChatOpenAI(
     openai_api_key=DEEPSEEK_API_KEY,
     openai_api_base=DEEPSEEK_BASE_URL,
     temperature=0,
-    streaming=True  # Habilitar streaming de tokens
+    streaming=True,  # Habilitar streaming de tokens
+    stream_usage=True  # Incluir uso de tokens también en streaming
 )
 
 # Modelo Inteligente (Agente Experto)
@@ -40,7 +55,8 @@ llm_expert = ChatOpenAI(
     openai_api_key=DEEPSEEK_API_KEY,
     openai_api_base=DEEPSEEK_BASE_URL,
     temperature=0.3,
-    streaming=True  # Habilitar streaming de tokens
+    streaming=True,  # Habilitar streaming de tokens
+    stream_usage=True  # Incluir uso de tokens también en streaming
 )
 
 class AgentState(TypedDict):
@@ -52,6 +68,12 @@ class AgentState(TypedDict):
     system_prompt: Optional[str] # Nuevo campo para prompts dinámicos
     model_config: Optional[dict] # Modelo/temp del agente custom
     tool_calls_remaining: int    # Anti-loop: máximo iteraciones de tool-calling
+    rag_query: Optional[str]     # Query de la última recuperación RAG
+    rag_role: Optional[str]      # agent_target de la última recuperación RAG
+    rag_refs: Optional[List[dict]]  # Ids y scores del RAG reutilizables (loops ReAct / regenerar); None si falló
+    rag_files: Optional[List[str]]  # context_files de la sesión: el RAG busca solo en esos archivos
+    rag_scope: Optional[List[str]]  # rag_files con los que se obtuvo rag_refs
+    members: Optional[List[str]]  # Miembros de la sesión GROUP (core roles o agent_ids)
 
 # --- PROMPTS ---
 ROUTER_PROMPT = """
@@ -71,6 +93,27 @@ Consulta: {query}
 Responde con el rol apropiado:
 """
 
+MEMBER_ROUTER_PROMPT = """
+Eres el Gatekeeper de SPHERE, una startup de IA. Tu ÚNICA función es elegir qué miembro de la Junta Directiva responde.
+
+REGLAS ESTRICTAS:
+1. SIEMPRE debes responder con UN SOLO NÚMERO: el de un miembro de la lista.
+2. NO expliques tu decisión, solo di el número.
+
+MIEMBROS:
+{options}
+
+Consulta: {query}
+Responde con el número del miembro apropiado:
+"""
+
+CORE_ROLE_SUMMARIES = {
+    "CTO": "Código, arquitectura, tecnología.",
+    "CEO": "Estrategia, visión, liderazgo.",
+    "CMO": "Marketing, ventas, growth.",
+    "CFO": "Finanzas, presupuestos, runway.",
+}
+
 CORE_ROLES = ["CEO", "CTO", "CFO", "CMO", "system"]
 
 AGENT_PROMPT_TEMPLATE = """
@@ -226,27 +269,102 @@ Si la consulta es más adecuada para un miembro específico de la Junta Directiv
 
 # --- NODOS ---
 
-async def router_node(state: AgentState):
+def _custom_agent_route(agent: dict) -> dict:
+    """Actualización de estado para enrutar a un agente custom."""
+    brain = agent["brain_config"]
+    return {
+        "next_agent": agent["identity"]["name"],
+        "system_prompt": brain["system_prompt"],
+        "model_config": {
+            "model": brain.get("model", "deepseek-chat"),
+            "temperature": brain.get("temperature", 0.3),
+        }
+    }
+
+
+def _core_route(role: str) -> dict:
+    """
+    Actualización de estado para enrutar a un rol core en una sesión GROUP.
+    Sustituye el prompt/modelo/target_role que un turno anterior enrutado a
+    un miembro custom dejó en el estado (si no, respondería con su persona,
+    su modelo y su KB). target_role pasa a ser el rol elegido, como en el
+    enrutado a miembros custom.
+    """
+    return {"next_agent": role, "system_prompt": None, "model_config": None, "target_role": role}
+
+
+async def _route_members_with_llm(query: str, members: List[str], ctx) -> dict:
+    """
+    LLM router cuando el routing por perfil no decide: elige solo entre los
+    miembros de la sesión (numerados). Si la respuesta no es un número
+    válido, responde el primer miembro de la sesión.
+    """
+    options = []
+    custom_ids = [m for m in members if not core_role_for_member(m)]
+    agents = {}
+    if custom_ids:
+        cursor = get_custom_agents_collection().find(
+            {"agent_id": {"$in": custom_ids}}, {"profile_embedding": 0}
+        )
+        agents = {agent["agent_id"]: agent async for agent in cursor}
+    for member_id in dict.fromkeys(members):
+        role = core_role_for_member(member_id)
+        if role:
+            options.append((member_id, role, f"{role}: {CORE_ROLE_SUMMARIES[role]}"))
+        elif member_id in agents:
+            identity = agents[member_id].get("identity", {})
+            summary = identity.get("description") or identity.get("role", "")
+            options.append((member_id, None, f"{identity.get('name', member_id)}: {summary[:200]}"))
+        else:
+            logger.warning(f"Miembro {member_id} no encontrado, excluido del router")
+    if not options:
+        logger.warning("Ningún miembro de la sesión disponible, fallback a CEO")
+        return _core_route("CEO")
+
+    choice = options[0]
+    if len(options) > 1:
+        listing = "\n".join(f"{i}. {label}" for i, (_, _, label) in enumerate(options, 1))
+        t0 = time.perf_counter()
+        response = await llm_router.ainvoke(
+            [HumanMessage(content=MEMBER_ROUTER_PROMPT.format(options=listing, query=query))]
+        )
+        if ctx:
+            ctx.mark("llm_router", t0)
+        number = re.search(r"\d+", response.content)
+        if number and 1 <= int(number.group()) <= len(options):
+            choice = options[int(number.group()) - 1]
+        else:
+            logger.warning(f"Respuesta del router no válida ({response.content!r}), primer miembro")
+
+    member_id, role, _ = choice
+    if role:
+        return _core_route(role)
+    return {**_custom_agent_route(agents[member_id]), "target_role": member_id}
+
+
+async def router_node(state: AgentState, config: RunnableConfig):
     """Clasifica la intención o carga prompts dinámicos."""
     custom_agents_collection = get_custom_agents_collection()
     
     query = state["query"]
     target_role = state.get("target_role")
+
+    # Prefetch del turno (agente custom / embedding lanzados antes del grafo)
+    ctx = get_turn_context(config)
+    if ctx and ctx.query == query:
+        ctx.mark("checkpoint_load", ctx.started)
+    else:
+        ctx = None
     
     # 1. CASO: Chat Privado con Agente Custom (UUID)
     if target_role and target_role not in CORE_ROLES:
         logger.info(f"Cargando Agente Custom: {target_role}")
-        agent = await custom_agents_collection.find_one({"agent_id": target_role})
+        if ctx and ctx.has("agent") and ctx.target_role == target_role:
+            agent = await ctx.get("agent")
+        else:
+            agent = await custom_agents_collection.find_one({"agent_id": target_role})
         if agent:
-            brain = agent["brain_config"]
-            return {
-                "next_agent": agent["identity"]["name"],
-                "system_prompt": brain["system_prompt"],
-                "model_config": {
-                    "model": brain.get("model", "deepseek-chat"),
-                    "temperature": brain.get("temperature", 0.3),
-                }
-            }
+            return _custom_agent_route(agent)
         logger.warning(f"Agente {target_role} no encontrado, fallback a CEO")
         target_role = "CEO"
 
@@ -254,23 +372,64 @@ async def router_node(state: AgentState):
     if target_role and target_role in CORE_ROLES:
         print(f"🔒 Chat Privado: {target_role}")
         return {"next_agent": target_role}
-    
-    # 3. CASO: Junta Directiva (Router)
+
+    # 3. CASO: Junta Directiva con miembros definidos: similitud vectorial
+    # contra los perfiles precomputados de los miembros (core y custom)
+    members = state.get("members") or []
+    if members:
+        try:
+            t0 = time.perf_counter()
+            if ctx and ctx.has("embedding"):
+                query_vector = await ctx.get("embedding")
+            else:
+                query_vector = await embed_query(query)
+            match = await route_to_member(query_vector, members, DEFAULT_CORE_PROMPTS)
+            if ctx:
+                ctx.mark("member_routing", t0)
+        except Exception as e:
+            logger.error(f"Error en routing por perfil, fallback a LLM router de miembros: {e}")
+            match = None
+        if match and match["core_role"]:
+            return _core_route(match["core_role"])
+        if match:
+            # target_role del turno = agente elegido (RAG y tools de ese agente)
+            return {**_custom_agent_route(match["agent"]), "target_role": match["member_id"]}
+        # Sin match: decide el LLM, pero solo entre los miembros de la sesión
+        print(f"🚦 Router (miembros): '{query}'")
+        return await _route_members_with_llm(query, members, ctx)
+
+    # 4. CASO: Junta Directiva sin miembros definidos (LLM router sobre los roles core)
     print(f"🚦 Router: '{query}'")
     prompt = ROUTER_PROMPT.format(query=query)
+    t0 = time.perf_counter()
     response = await llm_router.ainvoke([HumanMessage(content=prompt)])
+    if ctx:
+        ctx.mark("llm_router", t0)
     decision = response.content.strip().upper()
     
     # Búsqueda de rol
     for role in CORE_ROLES:
         if role.upper() in decision: 
-            return {"next_agent": role}
+            return _core_route(role)
     
-    return {"next_agent": "CEO"}
+    return _core_route("CEO")
 
 
-async def agent_node(state: AgentState):
+def prepare_core_tools(role: str, model: str = "deepseek-chat") -> tuple:
+    """
+    Tools de un rol core ya medidas en tokens y bindeadas a llm_expert
+    (schemas JSON + conteo). El prefetch del turno lo ejecuta en un thread
+    mientras espera a Mongo/OpenAI; agent_node lo hace en serie si no aplica.
+    """
+    tools = get_tools_for_role(role)
+    for tool in tools:
+        count_tool_tokens(tool, model)
+    return tools, (llm_expert.bind_tools(tools) if tools else llm_expert)
+
+
+async def agent_node(state: AgentState, config: RunnableConfig):
     """El Experto (Core o Custom) responde."""
+    ctx = get_turn_context(config)
     role = state["next_agent"]
     query = state["query"]
     target_role = state.get("target_role")
@@ -280,51 +439,162 @@ async def agent_node(state: AgentState):
     # 1. Determinar el prompt base
     system_instruction = custom_system_prompt or DEFAULT_CORE_PROMPTS.get(target_role or role, DEFAULT_CORE_PROMPTS["system"])
 
-    # 2. Recuperar Contexto RAG — custom agents usan su propio agent_target (UUID)
+    # 2. Recuperar Contexto RAG — custom agents usan su propio agent_target (UUID).
+    # Si el estado ya trae la recuperación de esta misma query (iteración del
+    # loop ReAct o regeneración desde checkpoint), se reutiliza sin re-buscar:
+    # el estado guarda ids y scores y el texto se rehidrata de knowledge_base.
+    # Si no, se recoge la búsqueda lanzada en paralelo al inicio del turno; en
+    # una repregunta, la recuperación del turno anterior (memoria de sesión).
     rag_role = target_role if target_role in CORE_ROLES else target_role
-    context = await retrieve_context(query, rag_role)
+    rag_files = state.get("rag_files") or []
+    if ctx and ctx.query != query:
+        ctx = None
+    t0 = time.perf_counter()
+    query_vector = None
+    snippets = None
+    if (
+        state.get("rag_refs") is not None
+        and state.get("rag_query") == query
+        and state.get("rag_role") == rag_role
+        and (state.get("rag_scope") or []) == rag_files
+    ):
+        try:
+            snippets = await rehydrate_snippets(state["rag_refs"])
+            logger.debug("♻️ Reutilizando contexto RAG almacenado en el estado")
+        except Exception as e:
+            logger.warning(f"No se pudo rehidratar el contexto RAG del estado, recuperando de nuevo: {e}")
+    if snippets is None:
+        if ctx and ctx.has("snippets") and ctx.rag_role == rag_role:
+            try:
+                snippets = await ctx.get("snippets")
+            except Exception as e:
+                logger.warning(f"Prefetch RAG falló, recuperando en serie: {e}")
+        if snippets is None:
+            if ctx and ctx.has("embedding"):
+                try:
+                    query_vector = await ctx.get("embedding")
+                except Exception:
+                    pass
+            snippets, mode = await retrieve_for_session(
+                config.get("configurable", {}).get("thread_id"), query, rag_role,
+                query_vector=query_vector, file_ids=rag_files,
+            )
+            if ctx:
+                ctx.note("rag", mode)
+    # Recuperación fallida: el prompt lo dice (no "sin información") y el estado no la guarda
+    failed = isinstance(snippets, RetrievalFailed)
+    if failed:
+        logger.warning(f"⚠️ RAG no disponible para {rag_role}: el experto responde sin contexto")
+    if ctx:
+        ctx.mark("retrieval_wait", t0)
+        if failed:
+            ctx.note("rag", "failed")
 
     # 3. Preparar historial: solo Human/AI, sin SystemMessages viejos que contaminen
+    # ni razonamientos de modelos r1 (no se reenvían al LLM)
     raw_history = state.get("messages", [])[:-1]
-    history = [msg for msg in raw_history if not isinstance(msg, SystemMessage)]
+    history = strip_reasoning([msg for msg in raw_history if not isinstance(msg, SystemMessage)])
+
+    # 4. Seleccionar LLM: dinámico para custom agents, default para core
+    model_name = (model_config or {}).get("model", "deepseek-chat")
+    reasoning_model = is_reasoning_model(model_name)
+    if reasoning_model:
+        llm = build_reasoning_llm(model_name, DEEPSEEK_API_KEY, DEEPSEEK_BASE_URL)
+    elif model_config:
+        llm = ChatOpenAI(
+            model=model_name,
+            openai_api_key=DEEPSEEK_API_KEY,
+            openai_api_base=DEEPSEEK_BASE_URL,
+            temperature=model_config.get("temperature", 0.3),
+            streaming=True,
+            stream_usage=True
+        )
+    else:
+        llm = llm_expert
+
+    # 5. Tools disponibles para el rol (ordenadas por prioridad); para un rol
+    # core con el modelo por defecto llegan ya medidas y bindeadas del prefetch
+    effective_role = target_role if target_role in CORE_ROLES else (target_role or role)
+    prebound = None
+    # (los modelos de razonamiento no admiten tool calling)
+    if reasoning_model:
+        tools = []
+    elif llm is llm_expert and ctx and ctx.has("tools") and ctx.target_role == effective_role:
+        try:
+            tools, prebound = await ctx.get("tools")
+        except Exception as e:
+            logger.warning(f"Prefetch de tools falló, preparando en serie: {e}")
+            tools = get_tools_for_role(effective_role)
+    else:
+        tools = get_tools_for_role(effective_role)
+
+    # 6. Contexto RAG en tokens: unir chunks contiguos sin solape, quedarse con
+    # las frases que responden a la query, ordenar por score y llenar el presupuesto del turno cortando en frontera de frase.
+    # Después, contabilidad pre-vuelo de todo el prompt: medir cada sección y
+    # recortar si se excede la ventana del modelo (historial -> contexto -> tools)
+    semantic = None
+    if RAG_COMPRESSION_SEMANTIC_WEIGHT > 0:
+        t0 = time.perf_counter()
+        semantic = await sentence_similarities(query, snippets or [], query_vector)
+        if ctx:
+            ctx.mark("sentence_embeddings", t0)
+    t0 = time.perf_counter()
+    context_plan = assemble_context(snippets or [], model=model_name, query=query, semantic=semantic)
+    plan = fit_prompt(
+        model=model_name,
+        system_prompt=AGENT_PROMPT_TEMPLATE.format(
+            system_instruction=system_instruction, context="", query=query
+        ),
+        history=history,
+        snippets=context_plan.passages,
+        tools=tools,
+        query=query,
+        render_snippet=format_snippet,
+        empty_context=empty_context_message(snippets),
+    )
+    logger.info(
+        f"📚 Contexto inyectado: {plan.sections['context']} tokens "
+        f"en {len(plan.snippets)} fuentes ({context_plan.summary()})"
+    )
+    if plan.over_budget:
+        logger.warning(f"🧮 Prompt excede el presupuesto tras recortar: {plan.summary()}")
+    else:
+        logger.info(f"🧮 Tokens {plan.summary()}")
 
-    # 4. Construir el prompt rico (Instrucciones + Contexto + Protocolo Artefactos)
+    # 7. Construir el prompt rico (Instrucciones + Contexto + Protocolo Artefactos)
     rich_system_prompt = AGENT_PROMPT_TEMPLATE.format(
         system_instruction=system_instruction,
-        context=context,
+        context=format_context(plan.snippets, empty_context_message(snippets)),
         query=query
     )
 
-    # 5. Formatear la entrada final para el LLM
     final_messages = [
         SystemMessage(content=rich_system_prompt),
-        *history,
+        *plan.history,
         HumanMessage(content=query)
     ]
 
-    # 6. Seleccionar LLM: dinámico para custom agents, default para core
-    if model_config:
-        llm = ChatOpenAI(
-            model=model_config.get("model", "deepseek-chat"),
-            openai_api_key=DEEPSEEK_API_KEY,
-            openai_api_base=DEEPSEEK_BASE_URL,
-            temperature=model_config.get("temperature", 0.3),
-            streaming=True
-        )
-    else:
-        llm = llm_expert
-
-    # 7. Bind tools si el rol tiene herramientas disponibles
-    effective_role = target_role if target_role in CORE_ROLES else (target_role or role)
-    tools = get_tools_for_role(effective_role)
-    if tools:
-        llm = llm.bind_tools(tools)
+    if plan.tools:
+        # Sin recortes de tools se usa el binding del prefetch
+        llm = prebound if prebound is not None and plan.tools == tools else llm.bind_tools(plan.tools)
+    if ctx:
+        ctx.mark("prompt_build", t0)
 
     # 8. Llamada al experto
+    t0 = time.perf_counter()
     response = await llm.ainvoke(final_messages)
+    if ctx:
+        ctx.mark("llm_expert", t0)
 
-    # 9. Enriquecer con metadata del agente para recuperación de historial
+    # 9. Enriquecer con metadata del agente para recuperación de historial.
+    # El razonamiento sale del mensaje antes de llegar al checkpoint.
     response.additional_kwargs["agent_role"] = role
+    reasoning = pop_reasoning(response)
+    if reasoning:
+        response.additional_kwargs["has_reasoning"] = True
+        await store_reasoning(
+            config.get("configurable", {}).get("thread_id"), response.id, role, model_name, reasoning
+        )
 
     # 10. Decrementar contador de tool calls si se usaron tools
     remaining = state.get("tool_calls_remaining", 3)
@@ -335,6 +605,10 @@ async def agent_node(state: AgentState):
         "final_response": response.content,
         "messages": [response],
         "tool_calls_remaining": remaining,
+        "rag_query": query,
+        "rag_role": rag_role,
+        "rag_refs": None if failed else snippet_refs(snippets or []),
+        "rag_scope": rag_files,
     }
 
 def final_node(state: AgentState):
@@ -411,13 +685,31 @@ sync_client = db.get_sync_client()
 logger.info("Cliente síncrono obtenido para LangGraph Checkpointer")
 
 # Inicializamos el Checkpointer usando el cliente SÍNCRONO
-checkpointer = MongoDBSaver(sync_client)
-logger.debug("MongoDBSaver inicializado")
+# (MongoDBSaver + resolución de forks copy-on-write entre sesiones)
+checkpointer = ForkAwareMongoDBSaver(sync_client)
+logger.debug("ForkAwareMongoDBSaver inicializado")
+
+# Durabilidad de checkpoints (se pasa como durability= al ejecutar `app`):
+# - "sync":  checkpoint tras cada nodo, esperando a Mongo antes del siguiente
+#            paso. Un crash pierde como mucho el nodo en curso. Más latencia.
+# - "async": (default) checkpoint tras cada nodo, escrito en background
+#            mientras corre el siguiente. Un crash puede perder el último paso.
+# - "exit":  un solo checkpoint al terminar el turno. Mínimas escrituras; un
+#            crash a mitad de turno pierde el turno entero (mensaje del usuario
+#            incluido) y no hay checkpoints intermedios (regenerar/fork usan
+#            el estado final del turno).
+CHECKPOINT_DURABILITY = os.getenv("CHECKPOINT_DURABILITY", "async").lower()
+if CHECKPOINT_DURABILITY not in ("sync", "async", "exit"):
+    logger.warning(f"CHECKPOINT_DURABILITY='{CHECKPOINT_DURABILITY}' no válido, usando 'async'")
+    CHECKPOINT_DURABILITY = "async"
 
 # Compilamos el grafo CON memoria
 app = workflow.compile(checkpointer=checkpointer)
 logger.info("Grafo LangGraph compilado con checkpointer MongoDB")
 
+# Grafo sin memoria para ejecuciones offline (batch): no escribe checkpoints
+stateless_app = workflow.compile()
+
 # --- TEST ---
 if __name__ == "__main__":
     # Prueba real
@@ -1,93 +1,527 @@
+"""
+RAG: embeddings de OpenAI + búsqueda vectorial en MongoDB Atlas.
+
+La ruta del servidor es 100% async: AsyncOpenAI y el cliente Motor de
+app.core.database, sin saltos al thread pool. Ambos clientes comparten su
+pool de conexiones entre peticiones, y cancelar la tarea (p.ej. cliente
+desconectado) cancela la llamada de red en curso.
+
+La versión síncrona (retrieve_context_sync) se mantiene solo para scripts.
+"""
 import asyncio
+import math
 import os
 from pathlib import Path
-from pymongo import MongoClient
-from openai import OpenAI
-import certifi
+from typing import Dict, List, Optional, Sequence, Tuple
+
 from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from app.core.database import db
+from app.core import compressor
+from app.core.context_assembler import assemble_context, render_passage
+from app.core.diversify import diversify
+from app.core.embedding_batcher import EMBED_BATCHING, EmbeddingBatcher
+from app.core.embedding_cache import EmbeddingCache
+from app.core.lexical import reciprocal_rank_fusion, result_key, term_overlap
+from app.core.retrieval_cache import RAG_RESULT_CACHE_VERIFY, retrieval_cache, retrieval_key
+from app.core.vector_store import (
+    AgentTarget,
+    atlas_search_pipeline,
+    get_knowledge_collection,
+    get_vector_store,
+    knowledge_stats,
+)
+from app.core.logger import rag_logger as logger
 
 # Cargar variables (ruta absoluta desde este archivo)
 env_path = Path(__file__).resolve().parents[3] / ".env"
 load_dotenv(dotenv_path=env_path)
 
-MONGO_URI = os.getenv("MONGODB_URL")
-DB_NAME = os.getenv("DB_NAME", "sphere_db")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Conexiones Globales (para no reconectar en cada petición)
-# Usamos certifi para evitar el error de SSL
-client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
-db = client[DB_NAME]
-collection = db["knowledge_base"]
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# RAG híbrido: ranking vectorial + BM25 fusionados con RRF
+RAG_HYBRID = os.getenv("RAG_HYBRID", "true").lower() == "true"
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "4"))  # candidatos por ranking = limit * N
+# Un hit que solo trae BM25 (no supera RAG_MIN_SCORE en el vectorial) debe contener
+# esta fracción de los términos de la query: el score BM25 no es comparable entre consultas
+RAG_LEXICAL_MIN_OVERLAP = float(os.getenv("RAG_LEXICAL_MIN_OVERLAP", "0.5"))
 
+# Diversificación: sin chunks contiguos del mismo archivo + MMR
+RAG_MMR = os.getenv("RAG_MMR", "true").lower() == "true"
+RAG_MMR_FETCH = int(os.getenv("RAG_MMR_FETCH", "4"))         # candidatos = limit * N
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))   # 1 = solo relevancia
 
-def _retrieve_context_sync(query: str, role: str, limit: int = 3) -> str:
+# Búsqueda dimensionada por el tamaño de la KB (knowledge_stats)
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.6"))            # vectorSearchScore mínimo, (1 + cos) / 2
+RAG_EXACT_MAX_CHUNKS = int(os.getenv("RAG_EXACT_MAX_CHUNKS", "2000"))  # KBs pequeñas: búsqueda exacta
+RAG_CANDIDATES_PER_RESULT = int(os.getenv("RAG_CANDIDATES_PER_RESULT", "20"))
+RAG_MAX_LIMIT = int(os.getenv("RAG_MAX_LIMIT", "6"))
+ATLAS_MAX_CANDIDATES = 10000
+
+# Custom agents: una sola búsqueda sobre [agente, "all"] con boost a lo propio
+RAG_OWN_BOOST = float(os.getenv("RAG_OWN_BOOST", "1.5"))
+
+# Señal semántica de la compresión: frases vectorizadas por turno (ver compressor)
+RAG_COMPRESSION_SEMANTIC_TIMEOUT_MS = float(os.getenv("RAG_COMPRESSION_SEMANTIC_TIMEOUT_MS", "800"))
+SENTENCE_CACHE_SIZE = int(os.getenv("SENTENCE_CACHE_SIZE", "8192"))  # embeddings de frases en proceso
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+CORE_KB_ROLES = ("CEO", "CTO", "CFO", "CMO", "system", "all")
+
+# Agente dueño de cada archivo de contexto ({source_file_id: agent_target}); no cambia
+_file_owners: Dict[str, str] = {}
+
+# Clientes OpenAI perezosos. El async se recrea si cambia el event loop
+# (igual que el cliente Motor en Database.connect).
+_async_openai: Optional[AsyncOpenAI] = None
+_async_openai_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_openai: Optional[OpenAI] = None
+
+
+def get_async_openai() -> AsyncOpenAI:
+    """Cliente AsyncOpenAI compartido (un pool HTTP por proceso)."""
+    global _async_openai, _async_openai_loop
+    loop = asyncio.get_running_loop()
+    if _async_openai is None or _async_openai_loop is not loop:
+        _async_openai = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        _async_openai_loop = loop
+    return _async_openai
+
+
+def get_sync_openai() -> OpenAI:
+    global _sync_openai
+    if _sync_openai is None:
+        _sync_openai = OpenAI(api_key=OPENAI_API_KEY)
+    return _sync_openai
+
+
+async def close_clients() -> None:
+    """Cierra el pool HTTP de OpenAI (shutdown de la app)."""
+    global _async_openai, _async_openai_loop
+    if _async_openai is not None:
+        await _async_openai.close()
+        _async_openai = None
+        _async_openai_loop = None
+
+
+# --- Embeddings ---
+
+def _embed_texts_sync(texts: List[str]) -> List[List[float]]:
+    """Vectoriza un lote de textos (OpenAI Small). Síncrono, solo para scripts."""
+    response = get_sync_openai().embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [item.embedding for item in response.data]
+
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Vectoriza un lote de textos (OpenAI Small)."""
+    response = await get_async_openai().embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [item.embedding for item in response.data]
+
+
+async def _embed_one(text: str) -> List[float]:
+    """Fallo de caché: el vector sale en el próximo micro-lote (o en solitario)."""
+    if EMBED_BATCHING:
+        return await query_batcher.submit(text)
+    return (await embed_texts([text]))[0]
+
+
+async def embed_query(query: str) -> List[float]:
+    """Vectoriza una sola consulta (con caché L1/L2, ver embedding_cache)."""
+    from app.core.embedding_cache import embedding_cache
+    return await embedding_cache.get_or_compute(EMBEDDING_MODEL, query, _embed_one)
+
+
+# Micro-lotes de queries compartidos por todos los turnos en vuelo
+query_batcher = EmbeddingBatcher(lambda texts: embed_texts(texts))
+
+# Frases de los pasajes (compresión): solo en proceso, los mismos chunks vuelven
+# turno a turno; el lote admite todas las frases de un turno en una llamada
+sentence_cache = EmbeddingCache(size=SENTENCE_CACHE_SIZE, persist=False)
+sentence_batcher = EmbeddingBatcher(
+    lambda texts: embed_texts(texts), max_batch=max(1, compressor.RAG_COMPRESSION_MAX_SENTENCES)
+)
+
+
+async def sentence_similarities(
+    query: str, passages: Sequence[dict], query_vector: Optional[List[float]] = None
+) -> Dict[str, float]:
     """
-    Versión síncrona interna:
-    1. Vectoriza la pregunta (OpenAI).
-    2. Busca en MongoDB filtrando por Rol.
-    3. Devuelve un string con el conocimiento encontrado.
+    Coseno entre la query y cada frase candidata a la compresión
+    (compressor.candidate_sentences), vectorizadas en un solo lote. {} si la
+    señal está desactivada, no hay nada que comprimir o OpenAI no responde
+    en RAG_COMPRESSION_SEMANTIC_TIMEOUT_MS (la compresión sigue siendo léxica).
     """
+    import numpy as np
+
+    if not (compressor.RAG_COMPRESSION and compressor.RAG_COMPRESSION_SEMANTIC_WEIGHT > 0):
+        return {}
+    sentences = compressor.candidate_sentences(passages)
+    if not sentences:
+        return {}
+
+    async def embed_all():
+        vectors = await asyncio.gather(
+            embed_query(query) if query_vector is None else asyncio.sleep(0, query_vector),
+            *(sentence_cache.get_or_compute(EMBEDDING_MODEL, text, sentence_batcher.submit) for text in sentences),
+        )
+        return vectors[0], vectors[1:]
+
     try:
-        # 1. Vectorizar pregunta (OpenAI Small)
-        query_vector = openai_client.embeddings.create(
-            input=[query],
-            model="text-embedding-3-small"
-        ).data[0].embedding
+        # Un timeout no tira el trabajo: las llamadas compartidas siguen y llenan la caché
+        query_vector, vectors = await asyncio.wait_for(embed_all(), RAG_COMPRESSION_SEMANTIC_TIMEOUT_MS / 1000)
+    except Exception as e:
+        logger.warning(f"Señal semántica de la compresión no disponible, solo léxica: {e!r}")
+        return {}
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query_unit = np.asarray(query_vector, dtype=np.float32)
+    query_unit /= max(float(np.linalg.norm(query_unit)), 1e-12)
+    return dict(zip(sentences, (matrix @ query_unit).tolist()))
+
+
+# --- Formato ---
+
+NO_CONTEXT_MESSAGE = "No encontré información específica en mi base de conocimientos sobre este tema."
+RETRIEVAL_FAILED_MESSAGE = (
+    "La búsqueda en la base de conocimientos falló en este turno (error técnico): no hay contexto "
+    "disponible. Si la respuesta depende de los documentos, indícalo al usuario."
+)
+
+
+class RetrievalFailed(list):
+    """
+    Resultado vacío de una recuperación que falló. Se comporta como [] pero
+    el llamante lo distingue de una búsqueda sin coincidencias (no se cachea,
+    no se guarda en el estado y el prompt avisa del fallo).
+    """
+
+
+def format_snippet(doc: dict) -> str:
+    """Formatea un pasaje tal como se inyecta en el prompt (ya ajustado por assemble_context)."""
+    return render_passage(doc)
+
+
+def empty_context_message(snippets: List[dict]) -> str:
+    """Texto del bloque CONTEXTO sin pasajes: sin coincidencias o recuperación fallida."""
+    return RETRIEVAL_FAILED_MESSAGE if isinstance(snippets, RetrievalFailed) else NO_CONTEXT_MESSAGE
+
+
+def format_context(passages: List[dict], empty: str = NO_CONTEXT_MESSAGE) -> str:
+    """Concatena los pasajes en el bloque CONTEXTO del prompt."""
+    if not passages:
+        return empty
+    return "".join(format_snippet(doc) for doc in passages)
+
 
-        # 2. Pipeline de búsqueda (Con filtro por Rol para que el CTO no lea cosas de Marketing)
+# --- Búsqueda ---
+
+def search_targets(role: str) -> AgentTarget:
+    """agent_target(s) de la búsqueda: el rol core, o [agente, "all"] para custom agents."""
+    return role if role in CORE_KB_ROLES else [role, "all"]
+
+
+def boost_own(results: List[dict], role: str, boost: Optional[float] = None) -> List[dict]:
+    """
+    Multiplica el score de los documentos propios del agente y reordena.
+    Fallback en proceso: lo propio va primero y "all" rellena los huecos
+    (o lo ocupa todo si el agente no tiene nada relevante).
+    """
+    boost = RAG_OWN_BOOST if boost is None else boost
+    boosted = [
+        {**doc, "score": (doc.get("score") or 0.0) * boost} if doc.get("agent_target") == role else doc
+        for doc in results
+    ]
+    boosted.sort(key=lambda doc: doc.get("score") or 0.0, reverse=True)
+    return boosted
+
+
+def adaptive_limit(chunks: int, limit: int) -> int:
+    """
+    Resultados a devolver según el tamaño de la KB: nunca más que chunks, y
+    uno más por orden de magnitud por encima de 10k chunks (hasta
+    RAG_MAX_LIMIT; el umbral de score y el presupuesto de contexto recortan).
+    """
+    if chunks <= 0:
+        return 0
+    if chunks > 10_000:
+        extra = int(math.log10(chunks / 10_000)) + 1
+        limit = max(limit, min(RAG_MAX_LIMIT, limit + extra))
+    return min(limit, chunks)
+
+
+def num_candidates_for(chunks: int, k: int) -> Optional[int]:
+    """
+    numCandidates del ANN para pedir k resultados: None (búsqueda exacta)
+    en KBs de hasta RAG_EXACT_MAX_CHUNKS; por encima, k * RAG_CANDIDATES_PER_RESULT
+    escalado con sqrt(chunks / 10k) para no perder recall en KBs grandes.
+    """
+    if chunks <= RAG_EXACT_MAX_CHUNKS:
+        return None
+    scale = max(1.0, math.sqrt(chunks / 10_000))
+    return min(ATLAS_MAX_CANDIDATES, int(k * RAG_CANDIDATES_PER_RESULT * scale))
+
+
+# (targets, chunks que cubre la búsqueda, versión del conocimiento de cada target)
+ResolvedTargets = Tuple[AgentTarget, int, Tuple[int, ...]]
+
+
+async def file_owners(file_ids: Sequence[str]) -> List[str]:
+    """agent_targets dueños de los archivos (caché en proceso: un archivo no cambia de agente)."""
+    missing = [f for f in file_ids if f not in _file_owners]
+    if missing:
         pipeline = [
-            {
-                "$vectorSearch": {
-                    "index": "vector_index",
-                    "path": "embedding",
-                    "queryVector": query_vector,
-                    "numCandidates": 100,
-                    "limit": limit,
-                    # IMPORTANTE: Aquí filtramos para que cada experto use SU conocimiento
-                    "filter": {"agent_target": role}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "title": 1,
-                    "content_markdown": 1
-                }
-            }
+            {"$match": {"source_file_id": {"$in": missing}}},
+            {"$group": {"_id": "$source_file_id", "agent_target": {"$first": "$agent_target"}}},
         ]
+        async for doc in get_knowledge_collection().aggregate(pipeline):
+            _file_owners[doc["_id"]] = doc["agent_target"]
+    return sorted({_file_owners[f] for f in file_ids if f in _file_owners})
+
+
+async def resolve_targets(
+    role: str, fresh: Optional[bool] = None, file_ids: Optional[Sequence[str]] = None
+) -> ResolvedTargets:
+    """
+    Como search_targets, pero sin filtrar por agentes que no tienen
+    documentos (caché negativa), con el nº de chunks que cubre la búsqueda y
+    la versión del conocimiento de cada target. Sale de la caché en proceso
+    de knowledge_stats; fresh=True (o RAG_RESULT_CACHE_VERIFY) la relee en Mongo.
+    Con file_ids (context_files de la sesión) los targets son los dueños de
+    esos archivos, sea cual sea el miembro que responde.
+    """
+    fresh = RAG_RESULT_CACHE_VERIFY if fresh is None else fresh
+    if file_ids:
+        owners = await file_owners(file_ids)
+        snapshots = await asyncio.gather(*(knowledge_stats.snapshot(o, fresh) for o in owners))
+        targets = owners[0] if len(owners) == 1 else owners
+        return targets, sum(c for c, _ in snapshots), tuple(v for _, v in snapshots)
+    targets = search_targets(role)
+    if isinstance(targets, str):
+        chunks, version = await knowledge_stats.snapshot(targets, fresh)
+        return targets, chunks, (version,)
+    (own, own_version), (shared, shared_version) = await asyncio.gather(
+        knowledge_stats.snapshot(role, fresh), knowledge_stats.snapshot("all", fresh)
+    )
+    if not own:
+        return "all", shared, (shared_version,)
+    return targets, own + shared, (own_version, shared_version)
+
+
+def _lexical_floor(query: str, vector_hits: List[dict], lexical_hits: List[dict]) -> List[dict]:
+    """Hits BM25 que entran en la fusión: los que también trae el vectorial, o con solape suficiente."""
+    in_vector = {result_key(doc) for doc in vector_hits}
+    kept = [
+        doc for doc in lexical_hits
+        if result_key(doc) in in_vector
+        or term_overlap(query, doc.get("content_markdown") or "") >= RAG_LEXICAL_MIN_OVERLAP
+    ]
+    if len(kept) < len(lexical_hits):
+        logger.debug(f"BM25: {len(lexical_hits) - len(kept)} hits por debajo del solape mínimo con la query")
+    return kept
+
 
-        results = list(collection.aggregate(pipeline))
+async def _search(
+    query: str,
+    query_vector: List[float],
+    role: str,
+    targets: AgentTarget,
+    limit: int,
+    chunks: int,
+    file_ids: Optional[Sequence[str]] = None,
+) -> List[dict]:
+    """
+    Candidatos (vectorial, o híbrida vectorial + BM25 con RRF si RAG_HYBRID)
+    y, con RAG_MMR, colapso de chunks contiguos + MMR sobre limit * RAG_MMR_FETCH.
+    Los custom agents buscan a la vez en lo suyo y en "all" (una sola consulta).
+    Los resultados vectoriales por debajo de RAG_MIN_SCORE no llegan al prompt;
+    los que solo trae BM25 tampoco si no contienen RAG_LEXICAL_MIN_OVERLAP de
+    los términos de la query.
+    Con file_ids (context_files de la sesión) la búsqueda se limita a esos
+    archivos, en la KB de sus dueños (targets), y es exacta: el pre-filtro
+    deja pocos chunks.
+    """
+    store = get_vector_store()
+    shared = not isinstance(targets, str)
+    fetch = limit * max(1, RAG_MMR_FETCH) if RAG_MMR else limit
+    # Con [agente, "all"] se pide el doble para que lo propio no quede fuera del corte antes del boost
+    widen = 2 if shared else 1
+
+    if RAG_HYBRID:
+        per_ranking = max(fetch, limit * max(1, RAG_HYBRID_CANDIDATES)) * widen
+        vector_hits, lexical_hits = await asyncio.gather(
+            store.search(
+                query_vector, targets, per_ranking,
+                num_candidates=None if file_ids else num_candidates_for(chunks, per_ranking),
+                with_vectors=RAG_MMR, min_score=RAG_MIN_SCORE, file_ids=file_ids,
+            ),
+            store.lexical_search(query, targets, per_ranking, with_vectors=RAG_MMR, file_ids=file_ids),
+            return_exceptions=True,
+        )
+        if isinstance(vector_hits, BaseException):
+            raise vector_hits
+        if isinstance(lexical_hits, BaseException):
+            logger.warning(f"Búsqueda léxica falló, RAG solo vectorial: {lexical_hits}")
+            lexical_hits = []
+        lexical_hits = _lexical_floor(query, vector_hits, lexical_hits)
+        if shared:
+            vector_hits, lexical_hits = boost_own(vector_hits, role), boost_own(lexical_hits, role)
+        ranked = reciprocal_rank_fusion([vector_hits, lexical_hits], fetch) if lexical_hits else vector_hits[:fetch]
+    else:
+        ranked = await store.search(
+            query_vector, targets, fetch * widen,
+            num_candidates=None if file_ids else num_candidates_for(chunks, fetch * widen),
+            with_vectors=RAG_MMR, min_score=RAG_MIN_SCORE, file_ids=file_ids,
+        )
+        if shared:
+            ranked = boost_own(ranked, role)[:fetch]
 
-        # Fallback: si custom agent no tiene docs propios, buscar en "all"
-        if not results and role not in ("CEO", "CTO", "CFO", "CMO", "system", "all"):
-            pipeline[0]["$vectorSearch"]["filter"] = {"agent_target": "all"}
-            results = list(collection.aggregate(pipeline))
+    if RAG_MMR:
+        return diversify(ranked, limit, RAG_MMR_LAMBDA)
+    return ranked[:limit]
 
-        if not results:
-            return "No encontré información específica en mi base de conocimientos sobre este tema."
 
-        # 3. Formatear contexto para el Prompt
-        context_str = ""
-        for doc in results:
-            snippet = doc.get('content_markdown', '')[:2000]
-            context_str += f"---\nFUENTE: {doc.get('title')}\nCONTENIDO: {snippet}\n\n"
+async def retrieve_snippets(
+    query: str,
+    role: str,
+    limit: int = 3,
+    query_vector: Optional[List[float]] = None,
+    file_ids: Optional[Sequence[str]] = None,
+    resolved: Optional[ResolvedTargets] = None,
+) -> List[dict]:
+    """
+    1. Vectoriza la pregunta (OpenAI), salvo que ya venga vectorizada.
+    2. Busca en el vector store (VECTOR_STORE) filtrando por Rol; con
+       RAG_HYBRID fusiona además el ranking BM25 (términos exactos). Un
+       custom agent busca en sus documentos y en "all" a la vez, con boost
+       a los propios (los que no tienen documentos, solo en "all").
+       El tamaño de la KB (knowledge_stats) fija limit y numCandidates; una
+       KB vacía no llega a vectorizar ni a buscar. Si la misma pregunta ya
+       se respondió con la misma versión de la KB, se reutiliza el resultado
+       (retrieval_cache) sin buscar. file_ids limita la búsqueda a los
+       archivos de contexto de la sesión, en la KB de sus dueños (no del
+       miembro que responde). `resolved` (resolve_targets) evita volver a
+       leer knowledge_stats si el llamante ya lo hizo.
+    3. Diversifica los candidatos (RAG_MMR).
+    4. Devuelve los documentos encontrados (mejor primero), o
+       RetrievalFailed (vacío) si la recuperación falla.
+    """
+    try:
+        targets, chunks, versions = resolved or await resolve_targets(role, file_ids=file_ids)
+        limit = adaptive_limit(chunks, limit)
+        if not limit:
+            return []
+        if query_vector is None:
+            query_vector = await embed_query(query)
 
-        return context_str
+        key = retrieval_key(
+            [targets] if isinstance(targets, str) else targets, versions, query_vector,
+            query if RAG_HYBRID else None,
+            (role, limit, RAG_HYBRID, RAG_MMR, RAG_MIN_SCORE, tuple(sorted(file_ids or ()))),
+        )
+        cached = retrieval_cache.get(key)
+        if cached is not None:
+            return cached
+        hits = await _search(query, query_vector, role, targets, limit, chunks, file_ids)
+        retrieval_cache.put(key, hits)
+        return hits
 
     except Exception as e:
-        print(f"🔥 Error en RAG: {e}")
-        return "Error recuperando contexto de la base de datos."
+        logger.error(f"🔥 Error en RAG: {e}", exc_info=True)
+        return RetrievalFailed()
 
 
-async def retrieve_context(query: str, role: str, limit: int = 3) -> str:
+async def rehydrate_snippets(refs: List[dict]) -> List[dict]:
     """
-    Versión async: ejecuta la búsqueda síncrona (OpenAI + PyMongo) en un
-    thread del executor para no bloquear el event loop de FastAPI.
+    Reconstruye snippets guardados con snippet_refs: una lectura por _id en
+    knowledge_base devuelve el texto de cada chunk y de sus vecinos. Los
+    chunks borrados desde entonces se descartan.
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _retrieve_context_sync, query, role, limit)
+    from bson import ObjectId
+
+    ids = {
+        ref["chunk_id"]
+        for doc in refs if doc.get("chunk_id")
+        for ref in (doc, *doc.get("adjacent", []))
+    }
+    if not ids:
+        return list(refs)
+    keys = [ObjectId(i) if ObjectId.is_valid(i) else i for i in ids]
+    cursor = get_knowledge_collection().find({"_id": {"$in": keys}}, {"title": 1, "content_markdown": 1})
+    texts = {str(doc["_id"]): doc async for doc in cursor}
+
+    def fill(ref: dict) -> Optional[dict]:
+        if not ref.get("chunk_id"):
+            return dict(ref)
+        doc = texts.get(ref["chunk_id"])
+        if doc is None:
+            return None
+        return {**ref, "title": doc.get("title"), "content_markdown": doc.get("content_markdown")}
+
+    snippets = []
+    for ref in refs:
+        snippet = fill(ref)
+        if snippet is None:
+            continue
+        if ref.get("adjacent"):
+            snippet["adjacent"] = [n for n in map(fill, ref["adjacent"]) if n is not None]
+        snippets.append(snippet)
+    if len(snippets) < len(refs):
+        logger.info(f"♻️ {len(refs) - len(snippets)} snippets guardados ya no están en la KB")
+    return snippets
+
+
+async def retrieve_context(query: str, role: str, limit: int = 3) -> str:
+    """Devuelve el contexto ya formateado para el prompt (presupuesto RAG_CONTEXT_TOKENS)."""
+    snippets = await retrieve_snippets(query, role, limit)
+    semantic = await sentence_similarities(query, snippets)
+    return format_context(
+        assemble_context(snippets, query=query, semantic=semantic).passages, empty_context_message(snippets)
+    )
+
+
+def _chunks_sync(database, agent_target: str) -> int:
+    """Nº de chunks de un agent_target (knowledge_stats, o conteo directo si no hay estadísticas)."""
+    doc = database["knowledge_stats"].find_one({"_id": agent_target})
+    if doc is not None:
+        return max(0, int(doc.get("chunks", 0)))
+    return database["knowledge_base"].count_documents({"agent_target": agent_target})
+
+
+def _retrieve_snippets_sync(
+    query: str, role: str, limit: int = 3, query_vector: Optional[List[float]] = None
+) -> List[dict]:
+    """Versión síncrona de retrieve_snippets (OpenAI + PyMongo, siempre Atlas) para scripts."""
+    try:
+        database = db.get_sync_client()[db.db_name]
+        targets = search_targets(role)
+        if isinstance(targets, str):
+            chunks = _chunks_sync(database, targets)
+        else:
+            own, shared = _chunks_sync(database, role), _chunks_sync(database, "all")
+            targets, chunks = (targets, own + shared) if own else ("all", shared)
+        limit = adaptive_limit(chunks, limit)
+        if not limit:
+            return []
+        if query_vector is None:
+            query_vector = _embed_texts_sync([query])[0]
+
+        k = limit if isinstance(targets, str) else limit * 2
+        pipeline = atlas_search_pipeline(
+            query_vector, targets, k, num_candidates_for(chunks, k), min_score=RAG_MIN_SCORE
+        )
+        results = list(database["knowledge_base"].aggregate(pipeline))
+        return results if isinstance(targets, str) else boost_own(results, role)[:limit]
+
+    except Exception as e:
+        logger.error(f"🔥 Error en RAG: {e}", exc_info=True)
+        return RetrievalFailed()
+
+
+def _retrieve_context_sync(query: str, role: str, limit: int = 3) -> str:
+    """Versión síncrona que devuelve el contexto ya formateado para el prompt."""
+    snippets = _retrieve_snippets_sync(query, role, limit)
+    return format_context(assemble_context(snippets, query=query).passages, empty_context_message(snippets))
 
 
 # Alias síncrono mantenido para compatibilidad con scripts standalone (ej: __main__)
@@ -0,0 +1,92 @@
+"""
+Soporte de modelos de razonamiento (deepseek-r1 / deepseek-reasoner).
+
+El razonamiento llega en `additional_kwargs["reasoning_content"]`, separado
+de la respuesta. Nunca se guarda en `messages` (checkpoint): se extrae antes
+de devolver el AIMessage, de modo que los turnos siguientes pesan lo mismo
+que con un modelo de chat. Según REASONING_STORAGE se persiste aparte en
+`reasoning_traces` ("separate") o se descarta ("none").
+"""
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage
+
+from app.core.database import db
+from app.core.logger import checkpoint_logger as logger
+
+# Nombre en ALLOWED_MODELS -> nombre en la API de DeepSeek
+REASONING_MODELS = {"deepseek-r1": "deepseek-reasoner", "deepseek-reasoner": "deepseek-reasoner"}
+
+REASONING_KEY = "reasoning_content"
+REASONING_STORAGE = os.getenv("REASONING_STORAGE", "separate").lower()  # separate | none
+REASONING_MAX_CHARS = int(os.getenv("REASONING_MAX_CHARS", "50000"))
+
+
+def is_reasoning_model(model: Optional[str]) -> bool:
+    return model in REASONING_MODELS
+
+
+def build_reasoning_llm(model: str, api_key: Optional[str], base_url: str):
+    """
+    ChatDeepSeek expone el razonamiento (ChatOpenAI lo descarta). El reasoner
+    ignora temperature y no admite tool calling, así que no se configuran.
+    max_tokens es la reserva de salida del presupuesto (razonamiento incluido).
+    """
+    from langchain_deepseek import ChatDeepSeek
+
+    from app.core.token_budget import get_output_reserve
+
+    return ChatDeepSeek(
+        model=REASONING_MODELS[model],
+        api_key=api_key,
+        api_base=base_url,
+        max_tokens=get_output_reserve(model),
+        streaming=True,
+        stream_usage=True,
+    )
+
+
+def pop_reasoning(message: BaseMessage) -> str:
+    """Extrae (y elimina) el razonamiento de un mensaje. '' si no tiene."""
+    return message.additional_kwargs.pop(REASONING_KEY, None) or ""
+
+
+def strip_reasoning(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Copias de los mensajes sin razonamiento (historial antiguo que aún lo traiga)."""
+    cleaned = []
+    for msg in messages:
+        if isinstance(msg, AIMessage) and REASONING_KEY in msg.additional_kwargs:
+            kwargs = {k: v for k, v in msg.additional_kwargs.items() if k != REASONING_KEY}
+            msg = msg.model_copy(update={"additional_kwargs": kwargs})
+        cleaned.append(msg)
+    return cleaned
+
+
+def get_reasoning_collection():
+    return db.get_async_db()["reasoning_traces"]
+
+
+async def store_reasoning(
+    session_id: Optional[str],
+    message_id: Optional[str],
+    role: str,
+    model: str,
+    reasoning: str,
+) -> None:
+    """Persiste el razonamiento fuera del checkpoint según la política configurada."""
+    if not reasoning or REASONING_STORAGE != "separate" or not session_id:
+        return
+    try:
+        await get_reasoning_collection().insert_one({
+            "session_id": session_id,
+            "message_id": message_id,
+            "agent_role": role,
+            "model": model,
+            "reasoning": reasoning[:REASONING_MAX_CHARS],
+            "truncated": len(reasoning) > REASONING_MAX_CHARS,
+            "created_at": datetime.now(timezone.utc),
+        })
+    except Exception as e:
+        logger.error(f"Error guardando razonamiento de {session_id}: {e}")
@@ -0,0 +1,100 @@
+"""
+Caché de resultados del RAG versionada por el conocimiento de cada agente.
+
+La clave es (agent_targets, versión de cada uno en knowledge_stats, embedding
+de la query cuantizado, parámetros de la búsqueda). La versión sube con cada
+ingesta o borrado (KnowledgeStats.record/reset), así que una entrada nunca
+sobrevive a un cambio de la KB: deja de ser alcanzable y sale por LRU.
+
+El embedding se cuantiza a int8 con escala por vector (como EMBED_STORAGE=int8)
+antes de hashearlo: una huella compacta que suele absorber el ruido de redondeo en
+los últimos decimales. No agrupa preguntas parecidas (basta que una de las
+1536 dimensiones cruce un escalón int8 para cambiar la clave); las
+repeticiones aciertan porque el mismo texto normalizado da el mismo embedding
+(embedding_cache). Con RAG_HYBRID la clave incluye además el texto
+normalizado, porque el ranking BM25 depende de los términos literales.
+
+La versión sale de la caché en proceso de knowledge_stats: las repeticiones
+no hacen ninguna consulta a Mongo. Las ingestas de este worker la invalidan
+al momento y las de otros llegan por el change stream de knowledge_stats
+(sin change streams, al caducar KNOWLEDGE_STATS_TTL).
+RAG_RESULT_CACHE_VERIFY=true relee además la versión en Mongo en cada
+consulta (un find_one por _id), para despliegues que no pueden esperar ese
+margen.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Sequence, Tuple
+
+from app.core.embedding_cache import normalize_text
+
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "1024"))  # entradas; 0 desactiva
+RAG_RESULT_CACHE_VERIFY = os.getenv("RAG_RESULT_CACHE_VERIFY", "false").lower() == "true"
+
+
+def quantize_vector(vector: Sequence[float]) -> bytes:
+    """Huella del embedding: int8 con escala por vector (no agrupa paráfrasis)."""
+    import numpy as np
+
+    array = np.asarray(vector, dtype=np.float32)
+    peak = float(np.abs(array).max()) if array.size else 0.0
+    quantized = np.rint(array * (127.0 / (peak or 1.0))).astype(np.int8)
+    return hashlib.sha1(quantized.tobytes()).digest()
+
+
+def retrieval_key(
+    targets: Sequence[str],
+    versions: Sequence[int],
+    query_vector: Sequence[float],
+    query: Optional[str] = None,
+    params: Tuple[Hashable, ...] = (),
+) -> tuple:
+    """Clave de la caché; `query` solo si el ranking depende del texto (BM25)."""
+    text = normalize_text(query) if query is not None else None
+    return tuple(targets), tuple(versions), quantize_vector(query_vector), text, params
+
+
+class RetrievalCache:
+    """LRU en proceso de resultados de retrieve_snippets."""
+
+    def __init__(self, size: int = RAG_RESULT_CACHE_SIZE):
+        self.size = size
+        self._lru: "OrderedDict[tuple, List[dict]]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: tuple) -> Optional[List[dict]]:
+        hits = self._lru.get(key)
+        if hits is None:
+            self._stats["misses"] += 1
+            return None
+        self._lru.move_to_end(key)
+        self._stats["hits"] += 1
+        # Copias: los llamantes pueden anotar los documentos
+        return [dict(doc) for doc in hits]
+
+    def put(self, key: tuple, hits: List[dict]) -> None:
+        if self.size <= 0:
+            return
+        self._lru[key] = [dict(doc) for doc in hits]
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def clear(self) -> None:
+        self._lru.clear()
+
+    def stats(self) -> dict:
+        """Métricas de la caché (expuestas en /health)."""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "size": len(self._lru),
+            "capacity": self.size,
+            "verified": RAG_RESULT_CACHE_VERIFY,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+
+retrieval_cache = RetrievalCache()
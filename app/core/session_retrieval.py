@@ -0,0 +1,229 @@
+"""
+Memoria de recuperación por sesión para los turnos de seguimiento.
+
+En una conversación, las repreguntas ("¿y en euros?", "explícalo más
+simple") suelen necesitar el mismo contexto que el turno anterior. Por cada
+sesión (thread_id) se recuerda la última recuperación completa: rol RAG,
+query, embedding, snippets y versión de la KB (knowledge_stats). En el turno
+siguiente, con el embedding de la nueva query:
+
+- reuse: coseno >= RAG_FOLLOWUP_REUSE_SIMILARITY → los mismos snippets, sin
+  buscar;
+- top_up: repregunta detectada (corta y con conector/anáfora) o coseno >=
+  RAG_FOLLOWUP_TOPUP_SIMILARITY → los snippets guardados más
+  RAG_FOLLOWUP_TOPUP nuevos, buscados con query y vector combinados
+  (anterior + actual) para que "¿y en euros?" herede el tema;
+- fresh: búsqueda normal, que pasa a ser la nueva referencia.
+
+Nunca se reutiliza si cambió el rol RAG, los archivos de contexto de la
+sesión (context_files) o la versión de la KB, ni más de
+RAG_FOLLOWUP_MAX_REUSE turnos seguidos (para que el contexto no derive).
+La memoria vive en proceso (LRU con TTL): con varios workers, un turno que
+cae en otro proceso simplemente hace una búsqueda normal. El modo de cada
+turno queda en el TurnContext (resumen de etapas) y en /health.
+"""
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+from app.core.logger import rag_logger as logger
+
+RAG_FOLLOWUP = os.getenv("RAG_FOLLOWUP", "true").lower() == "true"
+RAG_FOLLOWUP_REUSE_SIMILARITY = float(os.getenv("RAG_FOLLOWUP_REUSE_SIMILARITY", "0.9"))
+RAG_FOLLOWUP_TOPUP_SIMILARITY = float(os.getenv("RAG_FOLLOWUP_TOPUP_SIMILARITY", "0.75"))
+RAG_FOLLOWUP_TOPUP = int(os.getenv("RAG_FOLLOWUP_TOPUP", "2"))        # snippets nuevos en un top_up
+RAG_FOLLOWUP_MAX_REUSE = int(os.getenv("RAG_FOLLOWUP_MAX_REUSE", "3"))  # turnos seguidos sin búsqueda completa
+RAG_SESSION_MEMORY_SIZE = int(os.getenv("RAG_SESSION_MEMORY_SIZE", "1024"))  # sesiones
+RAG_SESSION_MEMORY_TTL = float(os.getenv("RAG_SESSION_MEMORY_TTL", "1800"))  # segundos
+
+# Repreguntas: cortas y que empiezan por conector o se apoyan en el turno anterior
+FOLLOW_UP_MAX_WORDS = 8
+FOLLOW_UP_OPENERS = frozenset("y e pero entonces vale ok and".split())
+FOLLOW_UP_MARKERS = frozenset("""
+eso esto ello anterior mismo misma dicho
+explicalo explicamelo resumelo resumemelo detallalo amplialo traducelo repitelo dimelo hazlo
+comparalo simplificalo desarrollalo
+""".split())
+
+FRESH, REUSE, TOP_UP = "fresh", "reuse", "top_up"
+
+
+def _words(text: str) -> List[str]:
+    """Palabras en minúsculas y sin tildes (sin filtrar palabras vacías: "y" importa)."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(char if char.isalnum() else " " for char in text if not unicodedata.combining(char))
+    return text.split()
+
+
+def is_follow_up(query: str) -> bool:
+    """Repregunta que depende del turno anterior ("¿y en euros?", "explícalo más simple")."""
+    words = _words(query)
+    if not words or len(words) > FOLLOW_UP_MAX_WORDS:
+        return False
+    return words[0] in FOLLOW_UP_OPENERS or any(word in FOLLOW_UP_MARKERS for word in words)
+
+
+def _unit(vector: Sequence[float]):
+    import numpy as np
+
+    array = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(array))
+    return array / norm if norm else array
+
+
+def _snippet_key(doc: dict) -> tuple:
+    return doc.get("title"), doc.get("content_markdown")
+
+
+@dataclass
+class _SessionRetrieval:
+    rag_role: str
+    query: str
+    vector: "object"  # np.ndarray float32 normalizado
+    snippets: List[dict]
+    versions: Tuple[int, ...]
+    files: Tuple[str, ...]
+    reuses: int
+    expires: float
+
+
+class SessionRetrievalMemory:
+    """Última recuperación por sesión (LRU con TTL) + contadores por modo."""
+
+    def __init__(self, size: int = RAG_SESSION_MEMORY_SIZE, ttl: float = RAG_SESSION_MEMORY_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, _SessionRetrieval]" = OrderedDict()
+        self._stats = {FRESH: 0, REUSE: 0, TOP_UP: 0, "stale": 0}
+
+    def decide(
+        self,
+        session_id: str,
+        rag_role: str,
+        query: str,
+        vector,
+        versions: Tuple[int, ...],
+        files: Tuple[str, ...] = (),
+    ) -> Tuple[str, Optional[_SessionRetrieval]]:
+        """Modo del turno (fresh | reuse | top_up) y la recuperación guardada en la que se apoya."""
+        entry = self._sessions.get(session_id)
+        if entry is None or entry.expires < time.monotonic():
+            return FRESH, None
+        if entry.rag_role != rag_role or entry.files != files:
+            return FRESH, None
+        if entry.versions != versions:
+            self._stats["stale"] += 1
+            return FRESH, None
+        if entry.reuses >= RAG_FOLLOWUP_MAX_REUSE:
+            return FRESH, None
+        similarity = float(entry.vector @ vector)
+        if similarity >= RAG_FOLLOWUP_REUSE_SIMILARITY:
+            return REUSE, entry
+        if similarity >= RAG_FOLLOWUP_TOPUP_SIMILARITY or is_follow_up(query):
+            return TOP_UP, entry
+        return FRESH, None
+
+    def remember(
+        self,
+        session_id: str,
+        rag_role: str,
+        query: str,
+        vector,
+        snippets: List[dict],
+        versions: Tuple[int, ...],
+        files: Tuple[str, ...] = (),
+    ) -> None:
+        """Guarda una recuperación completa como referencia de la sesión."""
+        if self.size <= 0:
+            return
+        self._sessions[session_id] = _SessionRetrieval(
+            rag_role, query, vector, list(snippets), versions, files, 0, time.monotonic() + self.ttl
+        )
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.size:
+            self._sessions.popitem(last=False)
+
+    def reused(self, session_id: str, entry: _SessionRetrieval, snippets: List[dict]) -> None:
+        """La sesión se apoyó en `entry` (con snippets ampliados si hubo top_up)."""
+        entry.snippets = list(snippets)
+        entry.reuses += 1
+        entry.expires = time.monotonic() + self.ttl
+        self._sessions.move_to_end(session_id)
+
+    def count(self, mode: str) -> None:
+        self._stats[mode] += 1
+
+    def forget(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        """Métricas de reutilización (expuestas en /health)."""
+        turns = self._stats[FRESH] + self._stats[REUSE] + self._stats[TOP_UP]
+        saved = self._stats[REUSE] + self._stats[TOP_UP]
+        return {
+            **self._stats,
+            "sessions": len(self._sessions),
+            "reuse_rate": round(saved / turns, 3) if turns else None,
+        }
+
+
+session_memory = SessionRetrievalMemory()
+
+
+async def retrieve_for_session(
+    session_id: Optional[str],
+    query: str,
+    rag_role: str,
+    query_vector: Optional[List[float]] = None,
+    file_ids: Optional[Sequence[str]] = None,
+) -> Tuple[List[dict], str]:
+    """
+    Snippets del turno y el modo con el que se obtuvieron (fresh | reuse |
+    top_up). Sin sesión o con RAG_FOLLOWUP=false es un retrieve_snippets normal.
+    file_ids: archivos de contexto de la sesión (búsqueda limitada a ellos).
+    """
+    import app.core.rag as rag
+
+    files = tuple(sorted(file_ids or ()))
+    if not RAG_FOLLOWUP or not session_id:
+        return await rag.retrieve_snippets(query, rag_role, query_vector=query_vector, file_ids=files), FRESH
+
+    try:
+        if query_vector is None:
+            query_vector = await rag.embed_query(query)
+        vector = _unit(query_vector)
+        # Una sola lectura de knowledge_stats por turno: la búsqueda reutiliza estos targets
+        resolved = await rag.resolve_targets(rag_role, file_ids=files)
+        versions = resolved[2]
+        mode, entry = session_memory.decide(session_id, rag_role, query, vector, versions, files)
+    except Exception as e:
+        logger.warning(f"Memoria RAG de sesión no disponible, búsqueda normal: {e}")
+        return await rag.retrieve_snippets(query, rag_role, query_vector=query_vector, file_ids=files), FRESH
+
+    if mode == REUSE:
+        snippets = [dict(doc) for doc in entry.snippets]
+    elif mode == TOP_UP:
+        combined = _unit(entry.vector + vector)
+        extra = await rag.retrieve_snippets(
+            f"{entry.query} {query}", rag_role, limit=RAG_FOLLOWUP_TOPUP, query_vector=combined.tolist(),
+            file_ids=files, resolved=resolved,
+        )
+        seen = {_snippet_key(doc) for doc in entry.snippets}
+        snippets = [dict(doc) for doc in entry.snippets]
+        snippets += [doc for doc in extra if _snippet_key(doc) not in seen]
+    else:
+        snippets = await rag.retrieve_snippets(
+            query, rag_role, query_vector=query_vector, file_ids=files, resolved=resolved
+        )
+        # Una recuperación vacía (KB vacía o error) no sirve de referencia
+        if snippets:
+            session_memory.remember(session_id, rag_role, query, vector, snippets, versions, files)
+
+    if mode != FRESH:
+        session_memory.reused(session_id, entry, snippets)
+        logger.info(f"♻️ RAG de sesión ({mode}): {len(snippets)} snippets sin búsqueda completa")
+    session_memory.count(mode)
+    return snippets, mode
@@ -0,0 +1,248 @@
+"""
+Contabilidad de tokens pre-vuelo para los prompts del agente experto.
+
+Mide cada sección del prompt (system, historial, contexto RAG, tools, query)
+con tiktoken y recorta por prioridad cuando se excede la ventana del modelo:
+1. Historial más antiguo
+2. Snippets RAG de menor ranking
+3. Descripciones de tools (las últimas de la lista primero)
+"""
+import json
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from app.core.logger import checkpoint_logger as logger
+
+# --- Ventanas de contexto por modelo (tokens) ---
+MODEL_CONTEXT_WINDOWS = {
+    "deepseek-chat": 64_000,
+    "deepseek-r1": 64_000,
+    "deepseek-reasoner": 64_000,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+}
+DEFAULT_CONTEXT_WINDOW = 64_000
+
+# Encodings por modelo. DeepSeek no publica encoding para tiktoken:
+# cl100k_base es una aproximación razonable (mismo orden de magnitud).
+MODEL_ENCODINGS = {
+    "deepseek-chat": "cl100k_base",
+    "deepseek-r1": "cl100k_base",
+    "deepseek-reasoner": "cl100k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4o-mini": "o200k_base",
+}
+DEFAULT_ENCODING = "cl100k_base"
+
+# Tokens reservados para la respuesta del modelo (modelos sin entrada propia)
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "4096"))
+# Reserva de los modelos de razonamiento (DeepSeek admite hasta 64K de salida)
+REASONING_OUTPUT_TOKENS = int(os.getenv("REASONING_OUTPUT_TOKENS", "32768"))
+# Reserva por modelo. En los de razonamiento la cadena de pensamiento cuenta
+# como salida: la reserva cubre razonamiento + respuesta y se pasa como
+# max_tokens al modelo, así que prompt + salida nunca exceden la ventana.
+MODEL_OUTPUT_TOKENS = {
+    "deepseek-chat": MAX_OUTPUT_TOKENS,
+    "deepseek-r1": REASONING_OUTPUT_TOKENS,
+    "deepseek-reasoner": REASONING_OUTPUT_TOKENS,
+    "gpt-4o": MAX_OUTPUT_TOKENS,
+    "gpt-4o-mini": MAX_OUTPUT_TOKENS,
+}
+# Tope opcional por debajo de la ventana (0 = usar la ventana completa)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "0"))
+# Overhead aproximado del formato chat por mensaje (role, separadores)
+TOKENS_PER_MESSAGE = 4
+# Caracteres por token de la estimación cuando tiktoken no puede cargar el encoding
+CHARS_PER_TOKEN = 4
+
+
+class ApproxEncoding:
+    """
+    Estimación sin tiktoken (~CHARS_PER_TOKEN caracteres por token).
+    tiktoken descarga los encodings la primera vez: sin red (o con la salida
+    bloqueada) el conteo no puede romper el turno.
+    """
+
+    def encode(self, text: str, disallowed_special=()) -> List[str]:
+        return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Devuelve (cacheado) el encoding tiktoken del modelo, o la estimación si no carga."""
+    name = MODEL_ENCODINGS.get(model, DEFAULT_ENCODING)
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"⚠️ Encoding {name} no disponible, tokens estimados (~{CHARS_PER_TOKEN} chars/token): {e}")
+        return ApproxEncoding()
+
+
+def count_tokens(text: str, model: str = "deepseek-chat") -> int:
+    """Cuenta tokens de un texto con el encoding del modelo."""
+    if not text:
+        return 0
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: BaseMessage, model: str = "deepseek-chat") -> int:
+    """Tokens de un mensaje: contenido + tool_calls + overhead de formato."""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+    tokens = count_tokens(content, model) + TOKENS_PER_MESSAGE
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        tokens += count_tokens(json.dumps(tool_calls, ensure_ascii=False, default=str), model)
+    return tokens
+
+
+_tool_tokens_cache: Dict[tuple, int] = {}
+
+
+def count_tool_tokens(tool, model: str = "deepseek-chat") -> int:
+    """Tokens del schema JSON de una tool (cacheado: los schemas son estáticos)."""
+    key = (model, tool.name)
+    if key not in _tool_tokens_cache:
+        from langchain_core.utils.function_calling import convert_to_openai_tool
+        schema = convert_to_openai_tool(tool)
+        _tool_tokens_cache[key] = count_tokens(json.dumps(schema, ensure_ascii=False), model)
+    return _tool_tokens_cache[key]
+
+
+def get_output_reserve(model: str) -> int:
+    """Tokens reservados para la salida del modelo (incluido el razonamiento)."""
+    return MODEL_OUTPUT_TOKENS.get(model, MAX_OUTPUT_TOKENS)
+
+
+def get_prompt_budget(model: str) -> int:
+    """Tokens disponibles para el prompt: ventana - reserva de salida (y tope opcional)."""
+    budget = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - get_output_reserve(model)
+    if PROMPT_TOKEN_BUDGET > 0:
+        budget = min(budget, PROMPT_TOKEN_BUDGET)
+    return budget
+
+
+@dataclass
+class PromptPlan:
+    """Resultado del ajuste: secciones recortadas + desglose de tokens."""
+    model: str
+    budget: int
+    history: List[BaseMessage]
+    snippets: List[dict]
+    tools: list
+    sections: Dict[str, int] = field(default_factory=dict)
+    trimmed: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def total(self) -> int:
+        return sum(self.sections.values())
+
+    @property
+    def over_budget(self) -> bool:
+        return self.total > self.budget
+
+    def summary(self) -> str:
+        parts = " ".join(f"{name}={tokens}" for name, tokens in self.sections.items())
+        trimmed = " ".join(f"{name}=-{n}" for name, n in self.trimmed.items() if n)
+        line = f"[{self.model}] {parts} total={self.total}/{self.budget}"
+        return f"{line} | recortes: {trimmed}" if trimmed else line
+
+
+def fit_prompt(
+    model: str,
+    system_prompt: str,
+    history: Sequence[BaseMessage],
+    snippets: Sequence[dict],
+    tools: Sequence,
+    query: str,
+    render_snippet: Callable[[dict], str],
+    budget: Optional[int] = None,
+    empty_context: str = "",
+) -> PromptPlan:
+    """
+    Mide cada sección del prompt y recorta en orden de prioridad hasta
+    caber en el presupuesto del modelo.
+
+    Args:
+        model: Nombre del modelo (para encoding y ventana)
+        system_prompt: Prompt de sistema renderizado con el bloque CONTEXTO vacío
+        history: Mensajes previos (más antiguo primero)
+        snippets: Resultados RAG ordenados por relevancia (mejor primero)
+        tools: Tools a bindear ordenadas por prioridad (más importante primero)
+        query: Pregunta actual del usuario
+        render_snippet: Función que formatea un snippet tal como entra al prompt
+        budget: Presupuesto explícito (default: get_prompt_budget(model))
+        empty_context: Texto que ocupa el bloque CONTEXTO si no queda ningún snippet
+
+    Returns:
+        PromptPlan con las secciones ajustadas y el desglose por sección
+    """
+    budget = budget if budget is not None else get_prompt_budget(model)
+
+    history = list(history)
+    snippets = list(snippets)
+    tools = list(tools)
+
+    history_tokens = [count_message_tokens(m, model) for m in history]
+    snippet_tokens = [count_tokens(render_snippet(s), model) for s in snippets]
+    tool_tokens = [count_tool_tokens(t, model) for t in tools]
+    empty_tokens = count_tokens(empty_context, model)
+
+    fixed = {
+        "system": count_tokens(system_prompt, model) + TOKENS_PER_MESSAGE,
+        "query": count_message_tokens(HumanMessage(content=query), model),
+    }
+    trimmed = {"history": 0, "context": 0, "tools": 0}
+
+    def context_tokens() -> int:
+        return sum(snippet_tokens) if snippet_tokens else empty_tokens
+
+    def total() -> int:
+        return sum(fixed.values()) + sum(history_tokens) + context_tokens() + sum(tool_tokens)
+
+    # 1. Historial: descartar lo más antiguo. No dejar el historial empezando
+    # por un AIMessage/ToolMessage huérfano (el proveedor lo rechaza).
+    while total() > budget and history:
+        history.pop(0)
+        history_tokens.pop(0)
+        trimmed["history"] += 1
+        while history and not isinstance(history[0], HumanMessage):
+            history.pop(0)
+            history_tokens.pop(0)
+            trimmed["history"] += 1
+
+    # 2. Contexto RAG: descartar los snippets de menor ranking
+    while total() > budget and snippets:
+        snippets.pop()
+        snippet_tokens.pop()
+        trimmed["context"] += 1
+
+    # 3. Tools: descartar las de menor prioridad
+    while total() > budget and tools:
+        tools.pop()
+        tool_tokens.pop()
+        trimmed["tools"] += 1
+
+    sections = {
+        "system": fixed["system"],
+        "history": sum(history_tokens),
+        "context": context_tokens(),
+        "tools": sum(tool_tokens),
+        "query": fixed["query"],
+    }
+    return PromptPlan(
+        model=model,
+        budget=budget,
+        history=history,
+        snippets=snippets,
+        tools=tools,
+        sections=sections,
+        trimmed=trimmed,
+    )
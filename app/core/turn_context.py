@@ -0,0 +1,172 @@
+"""
+Prefetch de I/O independiente dentro de un turno.
+
+Antes de ejecutar el grafo se lanzan en paralelo las lecturas que no
+dependen unas de otras: el agente custom (router), el embedding de la query,
+la búsqueda vectorial y la preparación de tools de un rol core (schemas,
+tokens y binding, en un thread) si el rol ya se conoce. Mientras tanto
+LangGraph carga el checkpoint del thread (la carga arranca en cuanto el
+grafo empieza, solapada con todo lo anterior; sale como checkpoint_load).
+Los nodos recogen los resultados del TurnContext
+(config["configurable"]["turn_context"]) en lugar de hacer la llamada en
+serie; si el prefetch no aplica o falla, hacen la llamada ellos.
+
+El contexto es estructurado: al salir (fin de turno o desconexión del
+cliente) cancela las tareas pendientes. También acumula los tiempos por
+etapa para ver cuánto del TTFT ahorra el paralelismo, y notas del turno
+(p.ej. rag=reuse cuando se reutilizó la recuperación del turno anterior).
+"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Optional
+
+from langchain_core.runnables import RunnableConfig
+
+from app.core.logger import checkpoint_logger as logger
+
+TURN_PREFETCH = os.getenv("TURN_PREFETCH", "true").lower() == "true"
+
+
+class TurnContext:
+    """Tareas de prefetch de un turno + desglose de tiempos por etapa (ms)."""
+
+    def __init__(
+        self,
+        query: str,
+        target_role: Optional[str] = None,
+        rag_role: Optional[str] = None,
+        session_id: Optional[str] = None,
+        file_ids: Optional[List[str]] = None,
+    ):
+        self.query = query
+        self.target_role = target_role
+        self.rag_role = rag_role
+        self.session_id = session_id
+        self.file_ids = file_ids or []
+        self.timings: Dict[str, float] = {}
+        self.notes: Dict[str, str] = {}
+        self.started = time.perf_counter()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._prefetch_stages: List[str] = []
+        self._waited_ms = 0.0
+
+    async def __aenter__(self) -> "TurnContext":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def start(self, name: str, coro: Awaitable[Any], timed: bool = True) -> None:
+        """
+        Lanza una etapa en background. Con timed=False la etapa registra su
+        propio tiempo con mark() (p.ej. para no contar la espera a otra etapa).
+        """
+        async def run():
+            t0 = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                if timed:
+                    self.mark(name, t0, prefetch=True)
+
+        task = asyncio.create_task(run())
+        # Cancelada antes de arrancar: cerrar la corrutina para no dejarla colgando
+        if hasattr(coro, "close"):
+            task.add_done_callback(lambda t: t.cancelled() and coro.close())
+        self._tasks[name] = task
+
+    def has(self, name: str) -> bool:
+        return name in self._tasks
+
+    async def get(self, name: str, count_wait: bool = True) -> Any:
+        """
+        Resultado de una etapa prefetched. Lanza KeyError si no se lanzó y
+        propaga su excepción si falló (el nodo decide el fallback).
+        count_wait=False para etapas que esperan a otra en background (esa
+        espera no bloquea el turno).
+        """
+        task = self._tasks[name]
+        if task.done():
+            return task.result()
+        t0 = time.perf_counter()
+        try:
+            return await task
+        finally:
+            if count_wait:
+                self._waited_ms += (time.perf_counter() - t0) * 1000
+
+    def mark(self, name: str, since: float, prefetch: bool = False) -> None:
+        """Registra la duración de una etapa (desde `since`, perf_counter)."""
+        self.timings[name] = round((time.perf_counter() - since) * 1000, 1)
+        if prefetch:
+            self._prefetch_stages.append(name)
+
+    def note(self, name: str, value: str) -> None:
+        """Anota un dato del turno que no es un tiempo (aparece en summary())."""
+        self.notes[name] = value
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def summary(self) -> str:
+        stages = " ".join(f"{k}={v:.0f}ms" for k, v in self.timings.items())
+        prefetched = sum(self.timings[name] for name in self._prefetch_stages)
+        saved = max(0.0, prefetched - self._waited_ms)
+        notes = "".join(f" | {k}={v}" for k, v in self.notes.items())
+        return f"{stages} | prefetch solapado ~{saved:.0f}ms{notes}"
+
+
+def get_turn_context(config: Optional[RunnableConfig]) -> Optional[TurnContext]:
+    return ((config or {}).get("configurable") or {}).get("turn_context")
+
+
+def prefetch_turn(
+    ctx: TurnContext,
+    members: Optional[list] = None,
+    agent: Optional[dict] = None,
+) -> None:
+    """
+    Lanza el prefetch de un turno nuevo:
+    - agent: documento del agente custom (si el endpoint ya lo leyó, se reutiliza)
+    - embedding: vector de la query (retrieval + routing GROUP)
+    - snippets: búsqueda vectorial, solo si el rol RAG ya se conoce (o la
+      recuperación del turno anterior de la sesión, si es una repregunta)
+    - tools: tools del rol core medidas y bindeadas (CPU, en un thread)
+    """
+    if not TURN_PREFETCH:
+        return
+
+    from app.core.database import get_custom_agents_collection
+    from app.core.orchestrator import CORE_ROLES, prepare_core_tools
+    from app.core.rag import embed_query
+    from app.core.session_retrieval import retrieve_for_session
+
+    if ctx.target_role and ctx.target_role not in CORE_ROLES:
+        if agent is not None:
+            ctx.start("agent", asyncio.sleep(0, result=agent))
+        else:
+            ctx.start("agent", get_custom_agents_collection().find_one({"agent_id": ctx.target_role}))
+
+    ctx.start("embedding", embed_query(ctx.query))
+
+    if ctx.rag_role and not members:
+        async def search():
+            query_vector = await ctx.get("embedding", count_wait=False)
+            t0 = time.perf_counter()
+            snippets, mode = await retrieve_for_session(
+                ctx.session_id, ctx.query, ctx.rag_role, query_vector, file_ids=ctx.file_ids
+            )
+            ctx.mark("vector_search", t0, prefetch=True)
+            ctx.note("rag", mode)
+            return snippets
+        ctx.start("snippets", search(), timed=False)
+
+    if ctx.target_role in CORE_ROLES and not members:
+        ctx.start("tools", asyncio.to_thread(prepare_core_tools, ctx.target_role))
+
+    logger.debug(f"⚡ Prefetch de turno lanzado: {list(ctx._tasks)}")
@@ -0,0 +1,78 @@
+"""
+Codificación de embeddings en knowledge_base.
+
+Un array BSON de doubles cuesta ~14 bytes por componente (tipo + clave
+"0".."1535" + 8 bytes): ~21 KB por chunk de 1536 dimensiones. Como BSON
+binary vector (subtipo 9) son 4 bytes por componente en float32 o 1 en int8
+(cuantización escalar por vector), y Atlas Vector Search indexa ambos
+formatos directamente.
+
+EMBED_STORAGE=float32 (default) | int8 | array (formato legado)
+
+Los lectores (vector store local, reordenado en dos etapas, MMR,
+migraciones) pasan siempre por decode_vector, que acepta los tres formatos:
+los documentos antiguos siguen funcionando hasta migrarlos con
+`python migrate_embeddings.py --pack`.
+"""
+import os
+from typing import List, Optional, Sequence
+
+EMBED_STORAGE = os.getenv("EMBED_STORAGE", "float32").lower()
+STORAGE_FORMATS = ("float32", "int8", "array")
+
+# Cabecera del subtipo 9: byte de dtype + byte de padding (spec BSON binary vector)
+_DTYPE_FLOAT32 = 0x27
+_DTYPE_INT8 = 0x03
+_DTYPE_PACKED_BIT = 0x10
+VECTOR_SUBTYPE = 9
+
+
+def encode_vector(vector: Sequence[float], storage: Optional[str] = None):
+    """Vector en el formato de almacenamiento (Binary subtipo 9, o lista en 'array')."""
+    import numpy as np
+    from bson.binary import Binary
+
+    storage = storage or EMBED_STORAGE
+    if storage == "array":
+        return [float(x) for x in vector]
+    array = np.asarray(vector, dtype=np.float32)
+    if storage == "int8":
+        # Escala por vector: el coseno no depende de ella y se aprovecha todo el rango
+        peak = float(np.abs(array).max()) or 1.0
+        quantized = np.clip(np.rint(array * (127.0 / peak)), -127, 127).astype(np.int8)
+        return Binary(bytes((_DTYPE_INT8, 0)) + quantized.tobytes(), VECTOR_SUBTYPE)
+    if storage != "float32":
+        raise ValueError(f"EMBED_STORAGE desconocido: {storage} (usa {', '.join(STORAGE_FORMATS)})")
+    return Binary(bytes((_DTYPE_FLOAT32, 0)) + array.astype("<f4").tobytes(), VECTOR_SUBTYPE)
+
+
+def decode_vector(value):
+    """np.ndarray float32 desde Binary subtipo 9, lista BSON (legado) o array."""
+    import numpy as np
+
+    if isinstance(value, (bytes, bytearray)) and len(value) >= 2:
+        dtype, data = value[0], memoryview(value)[2:]
+        if dtype == _DTYPE_FLOAT32:
+            return np.frombuffer(data, dtype="<f4")
+        if dtype == _DTYPE_INT8:
+            return np.frombuffer(data, dtype=np.int8).astype(np.float32)
+        if dtype == _DTYPE_PACKED_BIT:
+            raise ValueError("Vectores binarios (packed bit) no soportados")
+        raise ValueError(f"dtype de vector BSON desconocido: {dtype:#x}")
+    return np.asarray(value, dtype=np.float32)
+
+
+def decode_vectors(values: Sequence) -> "object":
+    """Matriz float32 (n, dim) desde una lista de vectores en cualquier formato."""
+    import numpy as np
+
+    if not values:
+        return np.zeros((0, 0), np.float32)
+    return np.vstack([decode_vector(value) for value in values])
+
+
+def storage_bytes(vectors: List) -> int:
+    """Bytes BSON que ocupan los vectores (para métricas y benchmarks)."""
+    import bson
+
+    return sum(len(bson.encode({"v": value})) for value in vectors)
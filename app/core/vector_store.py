@@ -0,0 +1,955 @@
+"""
+Almacén vectorial intercambiable para el RAG.
+
+- AtlasVectorStore: `$vectorSearch` sobre knowledge_base (índice Atlas
+  "vector_index"). El índice se sincroniza solo con la colección.
+- LocalVectorStore: búsqueda en proceso sobre matrices float32 por
+  agent_target. Exacta con NumPy por debajo de LOCAL_HNSW_THRESHOLD vectores
+  y HNSW (hnswlib, opcional) por encima. Cada partición se persiste como
+  snapshot .npy que se abre con memory-map; Mongo sigue siendo la fuente de
+  verdad y el snapshot se reconstruye desde ahí si falta.
+
+Las búsquedas aceptan un agent_target o una lista (p.ej. [agente, "all"]):
+en Atlas es un único $vectorSearch con filtro $in; en local se consultan
+las particiones y se mezclan por score. Los resultados de una búsqueda
+multi-target llevan su agent_target.
+
+Búsqueda en dos etapas (EMBED_SHORT_DIMS > 0): text-embedding-3 es un
+embedding Matryoshka, sus primeras d componentes renormalizadas equivalen a
+pedirlo con `dimensions=d`. La primera etapa busca
+limit * RAG_RESCORE_FACTOR candidatos sobre el vector corto
+(embedding_short en Atlas, índice ATLAS_SHORT_INDEX; en local una matriz
+corta en RAM y la completa en memmap) y la segunda los reordena con el
+coseno a dimensión completa. migrate_embeddings.py rellena embedding_short
+en los documentos existentes.
+
+Ambos ofrecen además búsqueda léxica BM25 sobre content_markdown (Atlas
+Search o un índice invertido en proceso) para el RAG híbrido.
+
+Selección con VECTOR_STORE=atlas|local. El backend local sirve para
+desarrollo, tests, on-prem y agentes con KB pequeñas (sin round trip).
+Con varios workers en la misma máquina los snapshots se comparten por
+disco: cada worker recarga una partición cuando su snapshot cambia.
+"""
+import asyncio
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from app.core.database import db
+from app.core.lexical import BM25Index
+from app.core.vector_codec import decode_vector, decode_vectors, encode_vector
+from app.core.logger import rag_logger as logger
+
+VECTOR_STORE = os.getenv("VECTOR_STORE", "atlas").lower()
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "data/vectors")
+LOCAL_HNSW_THRESHOLD = int(os.getenv("LOCAL_HNSW_THRESHOLD", "20000"))
+# Dimensión del vector corto de la primera etapa (0 = búsqueda a dimensión completa)
+EMBED_SHORT_DIMS = int(os.getenv("EMBED_SHORT_DIMS", "0"))
+RAG_RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))  # candidatos de la 1ª etapa = limit * N
+# Cuánto se recuerda en proceso el nº de chunks de un agent_target (knowledge_stats)
+KNOWLEDGE_STATS_TTL = float(os.getenv("KNOWLEDGE_STATS_TTL", "300"))
+# Change stream sobre knowledge_stats: invalida la caché en proceso en cuanto otro worker ingiere
+KNOWLEDGE_STATS_WATCH = os.getenv("KNOWLEDGE_STATS_WATCH", "true").lower() == "true"
+KNOWLEDGE_STATS_WATCH_RETRY_S = 5.0
+# Códigos de Mongo sin change streams (standalone, no soportado): no se reintenta
+_WATCH_UNSUPPORTED = {40573, 40324, 303}
+
+ATLAS_INDEX_NAME = "vector_index"
+EMBEDDING_DIMS = 1536  # text-embedding-3-small
+# Crear/actualizar los índices Atlas Vector Search al arrancar (ensure_atlas_indexes)
+ATLAS_MANAGE_INDEXES = os.getenv("ATLAS_MANAGE_INDEXES", "true").lower() == "true"
+ATLAS_SHORT_INDEX_NAME = os.getenv("ATLAS_SHORT_INDEX", "vector_index_short")
+SHORT_FIELD = "embedding_short"
+# Índice Atlas Search (BM25) sobre content_markdown, con agent_target mapeado como token
+ATLAS_TEXT_INDEX_NAME = os.getenv("ATLAS_TEXT_INDEX", "text_index")
+# Sin índice de texto consultable, cada cuánto se vuelve a mirar list_search_indexes (segundos)
+ATLAS_TEXT_INDEX_RECHECK_S = float(os.getenv("ATLAS_TEXT_INDEX_RECHECK_S", "60"))
+RESULT_FIELDS = ("title", "content_markdown")
+# Cada resultado lleva además "chunk_id" (_id en knowledge_base, como str): el
+# estado del grafo guarda solo ids y scores y rehidrata el texto al reutilizarlos
+# Con with_vectors=True los resultados traen además su posición y su vector
+# (para MMR / colapso de chunks contiguos; no deben llegar al estado del grafo)
+VECTOR_FIELDS = ("embedding", "source_file_id", "chunk_index")
+
+# Un agent_target o varios (una sola búsqueda sobre todos)
+AgentTarget = Union[str, Sequence[str]]
+
+
+def shorten(vector, dims: int):
+    """Primeras `dims` componentes renormalizadas (vector o matriz float32)."""
+    import numpy as np
+
+    short = np.asarray(vector, dtype=np.float32)[..., :dims]
+    norms = np.linalg.norm(short, axis=-1, keepdims=True)
+    return short / np.where(norms == 0, 1.0, norms)
+
+
+def get_knowledge_collection():
+    """Colección knowledge_base (Motor)."""
+    return db.get_async_db()["knowledge_base"]
+
+
+class VectorStore(ABC):
+    """Interfaz común de búsqueda y sincronización de vectores."""
+
+    name: str = "base"
+
+    @abstractmethod
+    async def search(
+        self,
+        query_vector: List[float],
+        agent_target: AgentTarget,
+        limit: int,
+        num_candidates: Optional[int] = 100,
+        with_vectors: bool = False,
+        min_score: float = 0.0,
+        file_ids: Optional[Sequence[str]] = None,
+    ) -> List[dict]:
+        """
+        Documentos más similares de uno o varios agent_target (mejor primero).
+        'score' en la escala de vectorSearchScore para coseno, (1 + cos) / 2,
+        y solo los que llegan a min_score. num_candidates=None: búsqueda exacta.
+        file_ids: solo chunks de esos archivos (pre-filtro por source_file_id).
+        """
+
+    async def lexical_search(
+        self,
+        query: str,
+        agent_target: AgentTarget,
+        limit: int,
+        with_vectors: bool = False,
+        file_ids: Optional[Sequence[str]] = None,
+    ) -> List[dict]:
+        """Ranking BM25 de uno o varios agent_target ([] si el backend no lo soporta)."""
+        return []
+
+    async def add(self, docs: List[dict]) -> None:
+        """Notifica documentos recién insertados en knowledge_base (con _id y embedding)."""
+
+    async def delete(self, agent_target: str, source_file_id: Optional[str] = None) -> None:
+        """Notifica el borrado de los vectores de un agente (o de uno de sus archivos)."""
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+# --- Atlas ---
+
+def _atlas_projection(score_meta: str, with_vectors: bool, agent_target: AgentTarget) -> dict:
+    projection = {
+        "_id": 0, "chunk_id": {"$toString": "$_id"}, "title": 1, "content_markdown": 1,
+        "score": {"$meta": score_meta},
+    }
+    if with_vectors:
+        projection.update({field: 1 for field in VECTOR_FIELDS})
+    if not isinstance(agent_target, str):
+        projection["agent_target"] = 1
+    return {"$project": projection}
+
+
+def target_filter(agent_target: AgentTarget, file_ids: Optional[Sequence[str]] = None) -> dict:
+    """Filtro MQL por agent_target (igualdad o $in) y, opcionalmente, por archivos de origen."""
+    if isinstance(agent_target, str):
+        query = {"agent_target": agent_target}
+    else:
+        query = {"agent_target": {"$in": list(agent_target)}}
+    if file_ids:
+        query["source_file_id"] = {"$in": list(file_ids)}
+    return query
+
+
+def atlas_search_pipeline(
+    query_vector: List[float],
+    agent_target: AgentTarget,
+    limit: int,
+    num_candidates: Optional[int] = 100,
+    with_vectors: bool = False,
+    short: bool = False,
+    min_score: float = 0.0,
+    file_ids: Optional[Sequence[str]] = None,
+) -> List[dict]:
+    """
+    Pipeline $vectorSearch filtrado por rol (el CTO no lee cosas de Marketing).
+    Con short=True busca sobre embedding_short (query ya recortada); con
+    num_candidates=None hace búsqueda exacta (ENN) y con min_score descarga
+    en el servidor los resultados por debajo del umbral. file_ids restringe
+    la búsqueda a esos archivos (source_file_id es campo filter del índice).
+    """
+    stage = {
+        "index": ATLAS_SHORT_INDEX_NAME if short else ATLAS_INDEX_NAME,
+        "path": SHORT_FIELD if short else "embedding",
+        # Mismo formato que los documentos (binary vector float32/int8 o array)
+        "queryVector": encode_vector(query_vector),
+        "limit": limit,
+        # IMPORTANTE: Aquí filtramos para que cada experto use SU conocimiento
+        "filter": target_filter(agent_target, file_ids)
+    }
+    if num_candidates is None:
+        stage["exact"] = True
+    else:
+        stage["numCandidates"] = max(num_candidates, limit)
+    pipeline = [{"$vectorSearch": stage}, _atlas_projection("vectorSearchScore", with_vectors, agent_target)]
+    if min_score:
+        pipeline.append({"$match": {"score": {"$gte": min_score}}})
+    return pipeline
+
+
+def atlas_text_pipeline(
+    query: str,
+    agent_target: AgentTarget,
+    limit: int,
+    with_vectors: bool = False,
+    file_ids: Optional[Sequence[str]] = None,
+) -> List[dict]:
+    """
+    Pipeline $search (BM25 de Atlas Search) filtrado por rol. Los archivos
+    (file_ids) se filtran con $match tras $search: un índice de texto creado
+    a mano (no por ensure_atlas_indexes) puede no tener source_file_id mapeado.
+    """
+    if isinstance(agent_target, str):
+        role_filter = {"equals": {"path": "agent_target", "value": agent_target}}
+    else:
+        role_filter = {"in": {"path": "agent_target", "value": list(agent_target)}}
+    pipeline = [
+        {
+            "$search": {
+                "index": ATLAS_TEXT_INDEX_NAME,
+                "compound": {
+                    "must": [{"text": {"query": query, "path": "content_markdown"}}],
+                    "filter": [role_filter],
+                },
+            }
+        },
+        {"$limit": limit},
+        _atlas_projection("searchScore", with_vectors, agent_target),
+    ]
+    if file_ids:
+        pipeline.insert(1, {"$match": {"source_file_id": {"$in": list(file_ids)}}})
+    return pipeline
+
+
+def _decode_hits(hits: List[dict]) -> List[dict]:
+    """Embeddings proyectados (binary vector o array legado) como np.ndarray float32."""
+    for hit in hits:
+        if hit.get("embedding") is not None:
+            hit["embedding"] = decode_vector(hit["embedding"])
+    return hits
+
+
+def atlas_vector_indexes(short_dims: int = EMBED_SHORT_DIMS) -> Dict[str, dict]:
+    """Definiciones de los índices Atlas Vector Search de knowledge_base (nombre -> definición)."""
+    def definition(path: str, dims: int) -> dict:
+        return {
+            "fields": [
+                {"type": "vector", "path": path, "numDimensions": dims, "similarity": "cosine"},
+                {"type": "filter", "path": "agent_target"},
+                # Contexto de sesión (context_files): pre-filtro por archivo
+                {"type": "filter", "path": "source_file_id"},
+            ]
+        }
+
+    indexes = {ATLAS_INDEX_NAME: definition("embedding", EMBEDDING_DIMS)}
+    if short_dims:
+        indexes[ATLAS_SHORT_INDEX_NAME] = definition(SHORT_FIELD, short_dims)
+    return indexes
+
+
+def atlas_text_index() -> dict:
+    """Definición del índice Atlas Search (BM25) de knowledge_base."""
+    return {
+        "mappings": {
+            "dynamic": False,
+            "fields": {
+                "content_markdown": {"type": "string"},
+                "agent_target": {"type": "token"},
+                "source_file_id": {"type": "token"},
+            },
+        }
+    }
+
+
+def index_changes(existing: List[dict], wanted: Dict[str, dict]) -> List[tuple]:
+    """[("create"|"update", nombre, definición)] para llevar los índices existentes a `wanted`."""
+    current = {index["name"]: index.get("latestDefinition") for index in existing}
+    changes = []
+    for name, definition in wanted.items():
+        if name not in current:
+            changes.append(("create", name, definition))
+        elif current[name] != definition:
+            changes.append(("update", name, definition))
+    return changes
+
+
+async def ensure_atlas_indexes(update: bool = False) -> List[tuple]:
+    """
+    Crea los índices vectoriales de Atlas que faltan. Los existentes cuya
+    definición difiere solo se actualizan con update=True (migrate_embeddings.py
+    --create-index): actualizar un índice obliga a Atlas a reconstruirlo y la
+    búsqueda vectorial no está disponible mientras tanto, así que al arrancar
+    solo se avisa. El índice Atlas Search de la búsqueda léxica
+    (ATLAS_TEXT_INDEX_NAME) se crea si falta; su estado fija si el RAG
+    híbrido lo consulta. Devuelve los cambios pendientes o aplicados.
+    """
+    from pymongo.operations import SearchIndexModel
+
+    collection = get_knowledge_collection()
+    existing = await collection.list_search_indexes().to_list(length=None)
+    store = get_vector_store()
+    if isinstance(store, AtlasVectorStore):
+        store.note_text_index(existing)
+    changes = index_changes(existing, atlas_vector_indexes())
+    for action, name, definition in changes:
+        if action == "create":
+            await collection.create_search_index(SearchIndexModel(definition=definition, name=name, type="vectorSearch"))
+            logger.info(f"🧮 Índice Atlas '{name}': creación solicitada")
+        elif update:
+            await collection.update_search_index(name, definition)
+            logger.info(f"🧮 Índice Atlas '{name}': actualización solicitada (Atlas lo reconstruye)")
+        else:
+            logger.warning(
+                f"🧮 Índice Atlas '{name}' distinto de la configuración (p.ej. sin el filtro source_file_id "
+                f"de los archivos de sesión); no se toca: `python migrate_embeddings.py --create-index` "
+                f"lo actualiza (reconstrucción completa)"
+            )
+    if not any(index.get("name") == ATLAS_TEXT_INDEX_NAME for index in existing):
+        definition = atlas_text_index()
+        await collection.create_search_index(
+            SearchIndexModel(definition=definition, name=ATLAS_TEXT_INDEX_NAME, type="search")
+        )
+        changes.append(("create", ATLAS_TEXT_INDEX_NAME, definition))
+        logger.info(f"🔎 Índice Atlas Search '{ATLAS_TEXT_INDEX_NAME}': creación solicitada")
+    return changes
+
+
+class AtlasVectorStore(VectorStore):
+    name = "atlas"
+
+    def __init__(self, short_dims: int = EMBED_SHORT_DIMS):
+        self.short_dims = short_dims
+        # Un $search contra un índice inexistente o en construcción devuelve [] sin
+        # error: la búsqueda léxica solo se hace si list_search_indexes lo da por consultable
+        self._text_index_ok = False
+        self._text_index_checked: Optional[float] = None
+
+    async def search(
+        self, query_vector, agent_target, limit, num_candidates=100, with_vectors=False, min_score=0.0, file_ids=None
+    ):
+        # Con archivos de sesión el espacio ya es pequeño: búsqueda directa a dimensión completa
+        if self.short_dims and not file_ids:
+            try:
+                return await self._two_stage_search(
+                    query_vector, agent_target, limit, num_candidates, with_vectors, min_score
+                )
+            except Exception as e:
+                from pymongo.errors import OperationFailure
+                if not isinstance(e, OperationFailure):
+                    raise
+                # Índice corto inexistente: volver a dimensión completa sin repetir el error
+                self.short_dims = 0
+                logger.warning(f"Índice '{ATLAS_SHORT_INDEX_NAME}' no disponible, búsqueda a dimensión completa: {e}")
+        pipeline = atlas_search_pipeline(
+            query_vector, agent_target, limit, num_candidates, with_vectors, min_score=min_score, file_ids=file_ids
+        )
+        return _decode_hits(await get_knowledge_collection().aggregate(pipeline).to_list(length=limit))
+
+    async def _two_stage_search(self, query_vector, agent_target, limit, num_candidates, with_vectors, min_score):
+        """Candidatos sobre embedding_short, reordenados (y filtrados por min_score) con el embedding completo."""
+        import numpy as np
+
+        candidates = limit * max(1, RAG_RESCORE_FACTOR)
+        pipeline = atlas_search_pipeline(
+            shorten(query_vector, self.short_dims), agent_target, candidates,
+            None if num_candidates is None else max(num_candidates, candidates), with_vectors=True, short=True,
+        )
+        hits = await get_knowledge_collection().aggregate(pipeline).to_list(length=candidates)
+        hits = _decode_hits([hit for hit in hits if hit.get("embedding")])
+        if not hits:
+            return []
+        query = shorten(query_vector, len(query_vector))
+        similarities = _normalize(decode_vectors([hit["embedding"] for hit in hits])) @ query
+        order = np.argsort(-similarities)[:limit]
+        results = []
+        for i in order:
+            # Misma escala que vectorSearchScore para coseno: (1 + cos) / 2
+            score = float((1 + similarities[i]) / 2)
+            if score < min_score:
+                break
+            result = {**hits[i], "score": score}
+            if not with_vectors:
+                for field in VECTOR_FIELDS:
+                    result.pop(field, None)
+            results.append(result)
+        return results
+
+    def note_text_index(self, indexes: List[dict]) -> None:
+        """Activa la búsqueda léxica si ATLAS_TEXT_INDEX_NAME aparece como consultable en `indexes`."""
+        ok = any(index.get("name") == ATLAS_TEXT_INDEX_NAME and index.get("queryable") for index in indexes)
+        if ok != self._text_index_ok:
+            logger.info(f"🔎 Índice Atlas Search '{ATLAS_TEXT_INDEX_NAME}' {'disponible' if ok else 'no disponible, RAG solo vectorial'}")
+        self._text_index_ok = ok
+        self._text_index_checked = time.monotonic()
+
+    async def _check_text_index(self) -> bool:
+        """Relee el estado del índice de texto, como mucho cada ATLAS_TEXT_INDEX_RECHECK_S."""
+        if self._text_index_ok:
+            return True
+        if self._text_index_checked is not None and time.monotonic() - self._text_index_checked < ATLAS_TEXT_INDEX_RECHECK_S:
+            return False
+        try:
+            self.note_text_index(await get_knowledge_collection().list_search_indexes().to_list(length=None))
+        except Exception as e:
+            self._text_index_checked = time.monotonic()
+            logger.warning(f"No se pudo comprobar el índice Atlas Search '{ATLAS_TEXT_INDEX_NAME}': {e}")
+        return self._text_index_ok
+
+    async def lexical_search(self, query, agent_target, limit, with_vectors=False, file_ids=None):
+        # El índice de Atlas Search se mantiene solo al insertar/borrar en knowledge_base
+        if not await self._check_text_index():
+            return []
+        try:
+            pipeline = atlas_text_pipeline(query, agent_target, limit, with_vectors, file_ids)
+            return _decode_hits(await get_knowledge_collection().aggregate(pipeline).to_list(length=limit))
+        except Exception as e:
+            from pymongo.errors import OperationFailure
+            if isinstance(e, OperationFailure):
+                # Índice borrado desde la última comprobación: no repetir el error en cada turno
+                self._text_index_ok = False
+                self._text_index_checked = time.monotonic()
+                logger.warning(f"Índice Atlas Search '{ATLAS_TEXT_INDEX_NAME}' no disponible, RAG solo vectorial: {e}")
+                return []
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "text_index": ATLAS_TEXT_INDEX_NAME if self._text_index_ok else None,
+            "short_dims": self.short_dims,
+        }
+
+
+# --- Local (NumPy / HNSW) ---
+
+@dataclass
+class _Partition:
+    """Vectores normalizados de un agent_target + metadatos fila a fila."""
+    vectors: "object"             # np.ndarray float32 (n, dim), posiblemente memmap
+    meta: List[dict]              # {_id, source_file_id, title, content_markdown}
+    mtime: float                  # mtime del snapshot cargado (0 = sin snapshot)
+    index: "object" = None        # hnswlib.Index si n >= LOCAL_HNSW_THRESHOLD
+    short: "object" = None        # vectores cortos en RAM para la 1ª etapa (EMBED_SHORT_DIMS)
+    bm25: Optional[BM25Index] = None  # índice léxico (se construye en la primera búsqueda léxica)
+    by_id: Optional[Dict[str, dict]] = None
+    rows: Optional[Dict[str, int]] = None  # _id -> fila (para devolver vectores de hits léxicos)
+    files: Optional[Dict[str, "object"]] = None  # source_file_id -> filas (np.ndarray), para context_files
+
+
+def _safe_name(agent_target: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", agent_target)
+
+
+class LocalVectorStore(VectorStore):
+    name = "local"
+
+    def __init__(
+        self,
+        directory: str = LOCAL_VECTOR_DIR,
+        hnsw_threshold: int = LOCAL_HNSW_THRESHOLD,
+        short_dims: int = EMBED_SHORT_DIMS,
+    ):
+        self.directory = Path(directory)
+        self.hnsw_threshold = hnsw_threshold
+        self.short_dims = short_dims
+        self._partitions: Dict[str, _Partition] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._stats = {"searches": 0, "exact": 0, "hnsw": 0, "scoped": 0, "lexical": 0, "rebuilds": 0, "reloads": 0}
+
+    # --- Snapshots ---
+
+    def _paths(self, agent_target: str):
+        base = self.directory / _safe_name(agent_target)
+        return base.with_suffix(".npy"), base.with_suffix(".json")
+
+    def _snapshot_mtime(self, agent_target: str) -> float:
+        try:
+            return self._paths(agent_target)[1].stat().st_mtime
+        except OSError:
+            return 0.0
+
+    def _write_snapshot(self, agent_target: str, vectors, meta: List[dict]) -> float:
+        """Escritura atómica (tmp + replace); el .json va último y marca la versión."""
+        import numpy as np
+
+        npy_path, meta_path = self._paths(agent_target)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_npy = npy_path.with_suffix(".npy.tmp")
+        with open(tmp_npy, "wb") as f:
+            np.save(f, np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_npy, npy_path)
+        tmp_meta = meta_path.with_suffix(".json.tmp")
+        tmp_meta.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_meta, meta_path)
+        return meta_path.stat().st_mtime
+
+    def _read_snapshot(self, agent_target: str) -> Optional[_Partition]:
+        import numpy as np
+
+        npy_path, meta_path = self._paths(agent_target)
+        if not (npy_path.exists() and meta_path.exists()):
+            return None
+        mtime = meta_path.stat().st_mtime
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        # Un array vacío no se puede mapear en memoria
+        vectors = np.load(npy_path, mmap_mode="r" if meta else None)
+        if len(meta) != vectors.shape[0]:
+            logger.warning(f"Snapshot vectorial inconsistente para {agent_target}, se reconstruye")
+            return None
+        return _Partition(vectors=vectors, meta=meta, mtime=mtime)
+
+    # --- Carga ---
+
+    async def _build_from_mongo(self, agent_target: str) -> _Partition:
+        import numpy as np
+
+        vectors, meta = [], []
+        cursor = get_knowledge_collection().find(
+            {"agent_target": agent_target},
+            {"embedding": 1, "source_file_id": 1, "chunk_index": 1, "title": 1, "content_markdown": 1},
+        )
+        async for doc in cursor:
+            if doc.get("embedding") is None or not len(doc["embedding"]):
+                continue
+            vectors.append(decode_vector(doc["embedding"]))
+            meta.append(self._meta(doc))
+
+        matrix = _normalize(np.asarray(vectors, dtype=np.float32)) if vectors else np.zeros((0, 0), np.float32)
+        mtime = await asyncio.to_thread(self._write_snapshot, agent_target, matrix, meta)
+        self._stats["rebuilds"] += 1
+        logger.info(f"🧮 Partición vectorial local '{agent_target}' construida desde Mongo ({len(meta)} vectores)")
+        return _Partition(vectors=matrix, meta=meta, mtime=mtime)
+
+    async def _partition(self, agent_target: str) -> _Partition:
+        lock = self._locks.setdefault(agent_target, asyncio.Lock())
+        async with lock:
+            current = self._partitions.get(agent_target)
+            mtime = self._snapshot_mtime(agent_target)
+            if current is not None and current.mtime == mtime and mtime:
+                return current
+
+            partition = await asyncio.to_thread(self._read_snapshot, agent_target)
+            if partition is None:
+                partition = await self._build_from_mongo(agent_target)
+            elif current is not None:
+                self._stats["reloads"] += 1
+            self._index(partition)
+            self._partitions[agent_target] = partition
+            return partition
+
+    def _index(self, partition: _Partition) -> None:
+        """Matriz corta de la 1ª etapa y HNSW para particiones grandes (si hnswlib está instalado)."""
+        n = len(partition.meta)
+        if n and self.short_dims and partition.vectors.shape[1] > self.short_dims:
+            partition.short = shorten(partition.vectors, self.short_dims)
+        if n < self.hnsw_threshold:
+            return
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning(f"hnswlib no instalado: búsqueda exacta sobre {n} vectores")
+            return
+        vectors = partition.short if partition.short is not None else partition.vectors
+        index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+        index.init_index(max_elements=n, ef_construction=200, M=16)
+        index.add_items(vectors, list(range(n)))
+        index.set_ef(100)
+        partition.index = index
+
+    # --- VectorStore ---
+
+    async def _search_many(self, method, query, agent_targets, limit, **kwargs) -> List[dict]:
+        """Misma búsqueda en varias particiones, mezclada por score."""
+        rankings = await asyncio.gather(*(method(query, target, limit, **kwargs) for target in agent_targets))
+        merged = [{**doc, "agent_target": target} for target, ranking in zip(agent_targets, rankings) for doc in ranking]
+        return heapq.nlargest(limit, merged, key=lambda doc: doc["score"])
+
+    @staticmethod
+    def _file_rows(partition: _Partition, file_ids: Sequence[str]):
+        """Filas de la partición que pertenecen a file_ids (índice por archivo perezoso)."""
+        import numpy as np
+
+        if partition.files is None:
+            by_file: Dict[str, List[int]] = {}
+            for row, meta in enumerate(partition.meta):
+                by_file.setdefault(meta.get("source_file_id"), []).append(row)
+            partition.files = {file_id: np.asarray(rows, dtype=np.int64) for file_id, rows in by_file.items()}
+        selected = [partition.files[file_id] for file_id in set(file_ids) if file_id in partition.files]
+        return np.sort(np.concatenate(selected)) if selected else np.zeros(0, dtype=np.int64)
+
+    async def search(
+        self, query_vector, agent_target, limit, num_candidates=100, with_vectors=False, min_score=0.0, file_ids=None
+    ):
+        import numpy as np
+
+        if not isinstance(agent_target, str):
+            return await self._search_many(
+                self.search, query_vector, agent_target, limit,
+                num_candidates=num_candidates, with_vectors=with_vectors, min_score=min_score, file_ids=file_ids,
+            )
+        partition = await self._partition(agent_target)
+        n = len(partition.meta)
+        self._stats["searches"] += 1
+        if n == 0 or limit <= 0:
+            return []
+
+        query = _normalize(np.asarray(query_vector, dtype=np.float32)[None, :])[0]
+        if file_ids:
+            # Pre-filtro por archivo: búsqueda exacta solo sobre sus filas
+            self._stats["scoped"] += 1
+            rows = self._file_rows(partition, file_ids)
+            similarities = np.asarray(partition.vectors[rows]) @ query if len(rows) else np.zeros(0)
+            order = np.argsort(-similarities)[:limit]
+            rows, scores = rows[order], (1.0 + similarities[order]) / 2
+            keep = scores >= min_score
+            return [
+                self._result(partition, row, float(score), with_vectors)
+                for row, score in zip(rows[keep], scores[keep])
+            ]
+        k = min(limit, n)
+        two_stage = partition.short is not None
+        # 1ª etapa: sobre los vectores cortos si los hay (más candidatos que k)
+        matrix = partition.short if two_stage else partition.vectors
+        stage_query = shorten(query, self.short_dims) if two_stage else query
+        stage_k = min(n, k * max(1, RAG_RESCORE_FACTOR)) if two_stage else k
+        # num_candidates=None pide búsqueda exacta aunque haya HNSW
+        if partition.index is not None and num_candidates is not None:
+            self._stats["hnsw"] += 1
+            partition.index.set_ef(max(num_candidates, stage_k))
+            labels, distances = partition.index.knn_query(stage_query, k=stage_k)
+            rows, scores = labels[0], 1.0 - distances[0]
+        else:
+            self._stats["exact"] += 1
+            similarities = matrix @ stage_query
+            rows = np.argpartition(-similarities, stage_k - 1)[:stage_k] if stage_k < n else np.arange(n)
+            rows = rows[np.argsort(-similarities[rows])]
+            scores = similarities[rows]
+
+        if two_stage:
+            # 2ª etapa: coseno completo solo de los candidatos (filas del memmap)
+            rows = np.sort(rows)
+            scores = np.asarray(partition.vectors[rows]) @ query
+            order = np.argsort(-scores)[:k]
+            rows, scores = rows[order], scores[order]
+
+        # Escala de vectorSearchScore (coseno): (1 + cos) / 2
+        scores = (1.0 + np.asarray(scores)) / 2
+        if min_score:
+            keep = scores >= min_score
+            rows, scores = rows[keep], scores[keep]
+        return [self._result(partition, row, float(score), with_vectors) for row, score in zip(rows, scores)]
+
+    async def lexical_search(self, query, agent_target, limit, with_vectors=False, file_ids=None):
+        if not isinstance(agent_target, str):
+            return await self._search_many(
+                self.lexical_search, query, agent_target, limit, with_vectors=with_vectors, file_ids=file_ids
+            )
+        partition = await self._partition(agent_target)
+        self._stats["lexical"] += 1
+        if partition.bm25 is None:
+            self._index_lexical(partition, partition.meta)
+        if file_ids:
+            files = set(file_ids)
+            hits = [
+                hit for hit in partition.bm25.search(query, len(partition.meta))
+                if partition.by_id[hit[0]].get("source_file_id") in files
+            ][:limit]
+        else:
+            hits = partition.bm25.search(query, limit)
+        if with_vectors and partition.rows is None:
+            partition.rows = {m["_id"]: row for row, m in enumerate(partition.meta)}
+        return [
+            self._result(partition, partition.rows[doc_id] if with_vectors else None, score, with_vectors, doc_id)
+            for doc_id, score in hits
+        ]
+
+    @staticmethod
+    def _result(partition: _Partition, row, score: float, with_vectors: bool, doc_id: Optional[str] = None) -> dict:
+        meta = partition.meta[row] if row is not None else partition.by_id[doc_id]
+        result = {"chunk_id": meta.get("_id"), **{field: meta.get(field) for field in RESULT_FIELDS}, "score": score}
+        if with_vectors:
+            result.update(
+                embedding=partition.vectors[row],
+                source_file_id=meta.get("source_file_id"),
+                chunk_index=meta.get("chunk_index"),
+            )
+        return result
+
+    @staticmethod
+    def _index_lexical(partition: _Partition, meta: List[dict]) -> None:
+        """Alta incremental en el BM25 de la partición (lo crea si no existe)."""
+        if partition.bm25 is None:
+            partition.bm25, partition.by_id = BM25Index(), {}
+        for m in meta:
+            partition.bm25.add(m["_id"], m.get("content_markdown") or "")
+            partition.by_id[m["_id"]] = m
+
+    async def add(self, docs: List[dict]) -> None:
+        import numpy as np
+
+        by_target: Dict[str, List[dict]] = {}
+        for doc in docs:
+            if doc.get("embedding") is not None and len(doc["embedding"]):
+                by_target.setdefault(doc["agent_target"], []).append(doc)
+
+        for agent_target, new_docs in by_target.items():
+            async with self._locks.setdefault(agent_target, asyncio.Lock()):
+                current = self._partitions.get(agent_target)
+                if current is None or current.mtime != self._snapshot_mtime(agent_target):
+                    # No cargada aquí: se reconstruye desde Mongo en la próxima búsqueda
+                    self._drop(agent_target)
+                    continue
+                new_vectors = _normalize(decode_vectors([d["embedding"] for d in new_docs]))
+                vectors = np.vstack([current.vectors, new_vectors]) if len(current.meta) else new_vectors
+                new_meta = [self._meta(d) for d in new_docs]
+                meta = current.meta + new_meta
+                mtime = await asyncio.to_thread(self._write_snapshot, agent_target, vectors, meta)
+                partition = _Partition(vectors=vectors, meta=meta, mtime=mtime, bm25=current.bm25, by_id=current.by_id)
+                if partition.bm25 is not None:
+                    self._index_lexical(partition, new_meta)
+                self._index(partition)
+                self._partitions[agent_target] = partition
+
+    async def delete(self, agent_target: str, source_file_id: Optional[str] = None) -> None:
+        import numpy as np
+
+        async with self._locks.setdefault(agent_target, asyncio.Lock()):
+            current = self._partitions.get(agent_target)
+            if source_file_id is None or current is None or current.mtime != self._snapshot_mtime(agent_target):
+                self._drop(agent_target)
+                return
+            keep = [i for i, m in enumerate(current.meta) if m.get("source_file_id") != source_file_id]
+            vectors = np.asarray(current.vectors)[keep] if keep else np.zeros((0, 0), np.float32)
+            meta = [current.meta[i] for i in keep]
+            mtime = await asyncio.to_thread(self._write_snapshot, agent_target, vectors, meta)
+            partition = _Partition(vectors=vectors, meta=meta, mtime=mtime, bm25=current.bm25, by_id=current.by_id)
+            if partition.bm25 is not None:
+                removed = [m["_id"] for m in current.meta if m.get("source_file_id") == source_file_id]
+                partition.bm25.remove(removed)
+                for doc_id in removed:
+                    partition.by_id.pop(doc_id, None)
+            self._index(partition)
+            self._partitions[agent_target] = partition
+
+    def _drop(self, agent_target: str) -> None:
+        """Olvida la partición y su snapshot (se reconstruye desde Mongo)."""
+        self._partitions.pop(agent_target, None)
+        for path in self._paths(agent_target):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _meta(doc: dict) -> dict:
+        return {
+            "_id": str(doc.get("_id")),
+            "source_file_id": doc.get("source_file_id"),
+            "chunk_index": doc.get("chunk_index"),
+            **{field: doc.get(field) for field in RESULT_FIELDS},
+        }
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            **self._stats,
+            "partitions": {t: len(p.meta) for t, p in self._partitions.items()},
+            "hnsw_threshold": self.hnsw_threshold,
+            "short_dims": self.short_dims,
+        }
+
+
+def _normalize(matrix):
+    """Normaliza filas a norma 1 (producto escalar = similitud coseno)."""
+    import numpy as np
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# --- Estadísticas de la KB por agent_target ---
+
+def get_knowledge_stats_collection():
+    """Colección knowledge_stats: {_id: agent_target, chunks, version, updated_at}."""
+    return db.get_async_db()["knowledge_stats"]
+
+
+class KnowledgeStats:
+    """
+    Nº de chunks y versión del conocimiento por agent_target, mantenidos en
+    knowledge_stats al ingerir y borrar (document_processor) y cacheados en
+    proceso. El RAG usa el tamaño para dimensionar la búsqueda
+    (numCandidates, limit) y como caché negativa: un custom agent sin
+    archivos se busca directamente en "all". La versión sube con cada cambio
+    de la KB y forma parte de la clave de la caché de resultados del RAG. Un
+    agent_target sin estadísticas (KB anterior a knowledge_stats, o alta
+    desde otro worker) se cuenta una vez en knowledge_base y se guarda.
+
+    Las ingestas de este proceso descartan su entrada al momento; las de
+    otros workers llegan por un change stream sobre knowledge_stats
+    (start_watch). Mientras el stream está abierto las entradas no caducan:
+    ni las repeticiones ni la caché negativa consultan Mongo. Sin change
+    streams (Mongo standalone) o mientras se reabre, cada entrada vale
+    KNOWLEDGE_STATS_TTL segundos.
+    """
+
+    def __init__(self, ttl: float = KNOWLEDGE_STATS_TTL):
+        self.ttl = ttl
+        self._known: Dict[str, Tuple[int, int, float]] = {}
+        self._stats = {"hits": 0, "lookups": 0, "backfills": 0, "invalidated": 0}
+        # Sube con cada invalidación: una lectura en vuelo que la cruza no se cachea
+        self._epoch = 0
+        self.watching = False
+        self._watch_thread: Optional[threading.Thread] = None
+
+    async def snapshot(self, agent_target: str, fresh: bool = False) -> Tuple[int, int]:
+        """(chunks, versión) del agent_target; fresh=True ignora la caché en proceso."""
+        entry = self._known.get(agent_target)
+        now = time.monotonic()
+        if not fresh and entry is not None and (self.watching or entry[2] > now):
+            self._stats["hits"] += 1
+            return entry[0], entry[1]
+        self._stats["lookups"] += 1
+        epoch = self._epoch
+        doc = await get_knowledge_stats_collection().find_one({"_id": agent_target})
+        if doc is None:
+            self._stats["backfills"] += 1
+            count = await get_knowledge_collection().count_documents({"agent_target": agent_target})
+            result = await get_knowledge_stats_collection().update_one(
+                {"_id": agent_target},
+                {"$setOnInsert": {"chunks": count, "version": 0, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+            version = 0
+            if result.upserted_id is None:
+                # Otra ingesta creó la fila mientras se contaba: manda su contador
+                doc = await get_knowledge_stats_collection().find_one({"_id": agent_target})
+        if doc is not None:
+            count, version = max(0, int(doc.get("chunks", 0))), int(doc.get("version", 0))
+        if epoch == self._epoch:
+            self._known[agent_target] = (count, version, now + self.ttl)
+        return count, version
+
+    def invalidate(self, agent_target: Optional[str] = None) -> None:
+        """Descarta la entrada de un agent_target (todas si es None)."""
+        self._epoch += 1
+        if agent_target is None:
+            self._known.clear()
+        elif self._known.pop(agent_target, None) is not None:
+            self._stats["invalidated"] += 1
+
+    def start_watch(self) -> None:
+        """Abre el change stream de knowledge_stats en un thread daemon (una vez por proceso)."""
+        if KNOWLEDGE_STATS_WATCH and self._watch_thread is None:
+            self._watch_thread = threading.Thread(
+                target=self._watch, name="knowledge-stats-watch", daemon=True
+            )
+            self._watch_thread.start()
+
+    def _watch(self) -> None:
+        """Change stream de knowledge_stats (cliente síncrono, se reabre si cae)."""
+        from pymongo.errors import OperationFailure
+
+        pipeline = [{"$project": {"operationType": 1, "documentKey": 1}}]
+        while True:
+            try:
+                collection = db.get_sync_client()[db.db_name]["knowledge_stats"]
+                with collection.watch(pipeline) as stream:
+                    # Lo cacheado antes de abrir el stream pudo cambiar sin aviso
+                    self.invalidate()
+                    self.watching = True
+                    logger.info("👀 knowledge_stats invalidada por change stream")
+                    for event in stream:
+                        if event["operationType"] in ("drop", "invalidate"):
+                            self.invalidate()
+                        else:
+                            self.invalidate((event.get("documentKey") or {}).get("_id"))
+            except (NotImplementedError, OperationFailure) as e:
+                if isinstance(e, NotImplementedError) or getattr(e, "code", None) in _WATCH_UNSUPPORTED:
+                    self.watching = False
+                    logger.info(f"Change streams no disponibles, knowledge_stats caduca a los {self.ttl:.0f}s: {e}")
+                    return
+                logger.warning(f"⚠️ Change stream de knowledge_stats caído, reabriendo: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Change stream de knowledge_stats caído, reabriendo: {e}")
+            self.watching = False
+            time.sleep(KNOWLEDGE_STATS_WATCH_RETRY_S)
+
+    async def chunks(self, agent_target: str) -> int:
+        return (await self.snapshot(agent_target))[0]
+
+    async def has_documents(self, agent_target: str) -> bool:
+        return await self.chunks(agent_target) > 0
+
+    async def record(self, agent_target: str, delta: int) -> None:
+        """Suma/resta chunks tras una ingesta o un borrado de archivo (y sube la versión)."""
+        # Con upsert: el cambio nunca se pierde aunque llegue antes que el backfill de
+        # snapshot, que solo inserta ($setOnInsert) y no pisa contadores ya vivos
+        result = await get_knowledge_stats_collection().update_one(
+            {"_id": agent_target},
+            {"$inc": {"chunks": delta, "version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        if result.upserted_id is not None:
+            # Primera fila del agent_target: la KB puede ser anterior a knowledge_stats,
+            # así que los chunks se cuentan (la ingesta/borrado ya está aplicada)
+            self._stats["backfills"] += 1
+            count = await get_knowledge_collection().count_documents({"agent_target": agent_target})
+            await get_knowledge_stats_collection().update_one(
+                {"_id": agent_target}, {"$set": {"chunks": count}}
+            )
+        self.invalidate(agent_target)
+
+    async def reset(self, agent_target: str) -> None:
+        """El agente se quedó sin documentos."""
+        # La fila se conserva: la versión nunca retrocede (no resucita resultados cacheados)
+        await get_knowledge_stats_collection().update_one(
+            {"_id": agent_target},
+            {"$set": {"chunks": 0, "updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}},
+            upsert=True,
+        )
+        self.invalidate(agent_target)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "known": len(self._known),
+            "empty": sum(1 for chunks, _, _ in self._known.values() if not chunks),
+            "mode": "watch" if self.watching else "ttl",
+        }
+
+
+knowledge_stats = KnowledgeStats()
+
+_store: Optional[VectorStore] = None
+
+
+def get_vector_store() -> VectorStore:
+    """Backend configurado en VECTOR_STORE (instancia única por proceso)."""
+    global _store
+    if _store is None:
+        if VECTOR_STORE == "local":
+            _store = LocalVectorStore()
+        else:
+            if VECTOR_STORE != "atlas":
+                logger.warning(f"VECTOR_STORE='{VECTOR_STORE}' desconocido, usando atlas")
+            _store = AtlasVectorStore()
+        logger.info(f"🧮 Vector store: {_store.name}")
+    return _store
@@ -1,7 +1,8 @@
 """Pydantic models para SPHERE Backend."""
 from app.models.session import (
     SessionType, VisualConfig, ContextFile, SessionBase,
-    CreateSessionRequest, UpdateSessionRequest, PinRequest, RatingRequest
+    CreateSessionRequest, UpdateSessionRequest, ForkSessionRequest,
+    AttachContextFileRequest, PinRequest, RatingRequest
 )
 from app.models.agent import (
     AgentIdentity, BrainConfig, CustomAgentCreate,
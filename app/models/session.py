@@ -40,6 +40,8 @@ class SessionBase(BaseModel):
     folder: Optional[str] = None
     tags: List[str] = []
     pinned_messages: List[str] = []
+    parent_session_id: Optional[str] = None
+    forked_from_checkpoint_id: Optional[str] = None
     created_at: datetime
 
 
@@ -63,6 +65,15 @@ class UpdateSessionRequest(BaseModel):
     tags: Optional[List[str]] = None
 
 
+class ForkSessionRequest(BaseModel):
+    checkpoint_id: Optional[str] = None  # Default: último checkpoint de la sesión
+    title: Optional[str] = None
+
+
+class AttachContextFileRequest(BaseModel):
+    file_id: str
+
+
 class PinRequest(BaseModel):
     message_id: str
 
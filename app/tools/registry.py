@@ -31,12 +31,13 @@ def register_role_tool(role: str, tool: BaseTool):
 def get_tools_for_role(role: str) -> list[BaseTool]:
     """
     Retorna todas las herramientas disponibles para un rol:
-    shared tools + role-specific tools.
+    role-specific tools + shared tools (ordenadas por prioridad: si el
+    prompt excede el presupuesto de tokens se descartan desde el final).
 
     Retorna lista vacía para roles sin tools (custom agents, etc.)
     """
     role_specific = ROLE_TOOLS.get(role, [])
-    return SHARED_TOOLS + role_specific
+    return role_specific + SHARED_TOOLS
 
 
 def load_all_tools():
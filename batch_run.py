@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Ejecuta un fichero JSONL de consultas contra el grafo de agentes (offline).
+
+Cada línea de entrada: {"id": "q1", "query": "...", "role": "CTO"} (o "agent_id").
+Los resultados se añaden al fichero de salida a medida que terminan; si la
+ejecución se interrumpe, relanzar el mismo comando salta los ids ya hechos.
+
+Uso:
+    python batch_run.py consultas.jsonl
+    python batch_run.py consultas.jsonl -o resultados.jsonl --concurrency 8 --rpm 120
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+from pathlib import Path
+
+# Añadir el directorio actual al path para imports
+sys.path.insert(0, str(Path(__file__).parent))
+
+# Cargar variables de entorno ANTES de importar otros módulos
+from dotenv import load_dotenv
+env_path = Path(__file__).parent.parent / ".env"
+load_dotenv(dotenv_path=env_path)
+
+if not os.getenv("MONGODB_URL"):
+    print("❌ ERROR: MONGODB_URL no está definida en .env")
+    sys.exit(1)
+
+
+async def run(args):
+    from app.core.batch_runner import BatchInputError, load_items, read_done_ids, run_batch
+    from app.core.database import db
+
+    try:
+        with open(args.input, encoding="utf-8") as f:
+            items = load_items(f)
+    except (OSError, BatchInputError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    output = args.output or str(Path(args.input).with_suffix(".results.jsonl"))
+    done_ids = read_done_ids(output)
+
+    db.connect()
+    with open(output, "a", encoding="utf-8") as out:
+        async def sink(result: dict):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()  # Cada resultado es durable: permite reanudar tras un corte
+
+        summary = await run_batch(
+            items,
+            sink,
+            concurrency=args.concurrency,
+            requests_per_minute=args.rpm,
+            done_ids=done_ids,
+        )
+
+    print(f"\n✅ {summary['ok']} ok, {summary['error']} con error, {summary['skipped']} ya hechos "
+          f"en {summary['elapsed_s']}s -> {output}")
+
+
+def main():
+    from app.core.batch_runner import DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE
+
+    parser = argparse.ArgumentParser(description="Inferencia batch offline contra el grafo SPHERE")
+    parser.add_argument("input", help="Fichero JSONL de consultas")
+    parser.add_argument("--output", "-o", help="Fichero JSONL de resultados (default: <input>.results.jsonl)")
+    parser.add_argument("--concurrency", "-c", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Items en vuelo (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help=f"Máximo de items por minuto, 0 = sin límite (default: {DEFAULT_REQUESTS_PER_MINUTE})")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
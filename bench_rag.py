@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Benchmark del RAG: solo vectorial vs híbrido (vectorial + BM25 con RRF).
+
+Modo sintético (por defecto, sin red): corpus en memoria sobre el vector
+store local. Cada documento contiene un código único (tipo ticker/SKU) y
+las queries preguntan por ese código con un embedding ruidoso, el caso en
+el que la búsqueda vectorial sola falla.
+
+Modo --dims: búsqueda en dos etapas (vector corto + reordenado a dimensión
+completa) en el store local. Para cada dimensión mide recall@limit frente a
+la búsqueda exacta a dimensión completa, latencia y memoria de la 1ª etapa.
+El corpus sintético imita un embedding Matryoshka (la varianza se concentra
+en las primeras componentes), como text-embedding-3.
+
+Modo live: queries reales contra el backend configurado (VECTOR_STORE).
+Cada línea: {"query": "...", "role": "CTO", "expected_title": "..."}
+(expected_title es opcional; sin él solo se mide latencia).
+
+Uso:
+    python bench_rag.py
+    python bench_rag.py --docs 20000 --queries 300 --limit 3 --min-score 0
+    python bench_rag.py --live queries.jsonl --limit 3
+    python bench_rag.py --dims 128,256,512,0 --docs 50000 --dim 1536
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+
+# Añadir el directorio actual al path para imports
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dotenv import load_dotenv
+load_dotenv(dotenv_path=Path(__file__).parent.parent / ".env")
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+async def measure(cases, limit, hybrid, warm=False):
+    """Latencias (ms) y hit@limit de una configuración (warm=True: con la caché de resultados llena)."""
+    import app.core.rag as rag
+
+    rag.RAG_HYBRID = hybrid
+    if not warm:
+        rag.retrieval_cache.clear()
+    latencies, hits, judged = [], 0, 0
+    for case in cases:
+        t0 = time.perf_counter()
+        results = await rag.retrieve_snippets(case["query"], case["role"], limit, query_vector=case["vector"])
+        latencies.append((time.perf_counter() - t0) * 1000)
+        if case.get("expected_title"):
+            judged += 1
+            hits += any(r.get("title") == case["expected_title"] for r in results)
+    return {
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "hit_rate": round(hits / judged, 3) if judged else None,
+    }
+
+
+def synthetic_cases(n_docs, n_queries, dim, noise, seed):
+    """Corpus + queries sintéticas; parchea la knowledge_base del store local."""
+    import numpy as np
+    import app.core.vector_store as vector_store
+
+    rng = np.random.default_rng(seed)
+    words = ["ventas", "margen", "cliente", "contrato", "producto", "mercado", "equipo", "coste", "plan", "riesgo"]
+    docs = []
+    for i in range(n_docs):
+        body = " ".join(rng.choice(words, size=40))
+        docs.append({
+            "_id": f"d{i}",
+            "agent_target": "CFO",
+            "title": f"doc {i}",
+            "content_markdown": f"Ficha del SKU-{i:06d}. {body}",
+            "embedding": rng.normal(size=dim).astype("float32").tolist(),
+            "source_file_id": "bench",
+        })
+
+    class Cursor:
+        def __init__(self, items):
+            self.items = items
+
+        def __aiter__(self):
+            async def gen():
+                for item in self.items:
+                    yield item
+            return gen()
+
+    class Knowledge:
+        def find(self, query, projection=None):
+            return Cursor([d for d in docs if d["agent_target"] == query["agent_target"]])
+
+    class Stats:
+        async def find_one(self, query):
+            return {"_id": query["_id"], "chunks": sum(d["agent_target"] == query["_id"] for d in docs)}
+
+    vector_store.get_knowledge_collection = lambda: Knowledge()
+    vector_store.get_knowledge_stats_collection = lambda: Stats()
+    vector_store._store = vector_store.LocalVectorStore(directory=tempfile.mkdtemp(prefix="bench_rag_"))
+
+    cases = []
+    for i in rng.choice(n_docs, size=min(n_queries, n_docs), replace=False):
+        target = np.asarray(docs[i]["embedding"])
+        vector = target + rng.normal(scale=noise, size=dim) * np.linalg.norm(target) / np.sqrt(dim)
+        cases.append({
+            "query": f"¿cuál es el margen del SKU-{i:06d}?",
+            "role": "CFO",
+            "vector": vector.tolist(),
+            "expected_title": docs[i]["title"],
+        })
+    return cases
+
+
+async def live_cases(path):
+    from app.core.database import db
+    from app.core.rag import embed_query
+
+    db.connect()
+    cases = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                case = json.loads(line)
+                case["vector"] = await embed_query(case["query"])
+                cases.append(case)
+    return cases
+
+
+def matryoshka_corpus(n_docs, n_queries, dim, seed):
+    """Vectores con varianza decreciente por componente + queries cercanas a un documento."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    scale = 1.0 / np.sqrt(1.0 + np.arange(dim) / 32.0)
+    docs = (rng.normal(size=(n_docs, dim)) * scale).astype(np.float32)
+    targets = rng.choice(n_docs, size=min(n_queries, n_docs), replace=False)
+    queries = docs[targets] + (rng.normal(size=(len(targets), dim)) * scale * 0.8).astype(np.float32)
+    return docs, queries
+
+
+async def measure_dims(args):
+    """recall@limit / latencia / memoria de la 1ª etapa para cada EMBED_SHORT_DIMS."""
+    import numpy as np
+    import app.core.vector_store as vector_store
+
+    docs, queries = matryoshka_corpus(args.docs, args.queries, args.dim, args.seed)
+    normalized = docs / np.linalg.norm(docs, axis=1, keepdims=True)
+    truth = []
+    for query in queries:
+        similarities = normalized @ (query / np.linalg.norm(query))
+        truth.append(set(np.argsort(-similarities)[:args.limit].tolist()))
+
+    meta = [{"_id": str(i), "title": str(i), "content_markdown": ""} for i in range(len(docs))]
+    directory = tempfile.mkdtemp(prefix="bench_dims_")
+    print(f"📊 {len(queries)} queries sobre {len(docs)} vectores de {args.dim} dims, limit={args.limit}")
+    for dims in [int(d) for d in args.dims.split(",")]:
+        store = vector_store.LocalVectorStore(directory=directory, hnsw_threshold=args.hnsw, short_dims=dims)
+        partition = vector_store._Partition(vectors=normalized, meta=meta, mtime=0.0)
+        store._index(partition)
+        store._partitions["bench"] = partition
+        store._partition = lambda agent_target, p=partition: asyncio.sleep(0, result=p)
+
+        latencies, recall = [], 0.0
+        for query, expected in zip(queries, truth):
+            t0 = time.perf_counter()
+            results = await store.search(query.tolist(), "bench", args.limit)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            recall += len(expected & {int(r["title"]) for r in results}) / args.limit
+        stage_matrix = partition.short if partition.short is not None else partition.vectors
+        print(f"  dims={dims or args.dim:5d} {{'recall': {recall / len(queries):.3f}, "
+              f"'p50_ms': {percentile(latencies, 0.5):.2f}, 'p95_ms': {percentile(latencies, 0.95):.2f}, "
+              f"'stage1_mb': {stage_matrix.nbytes / 2**20:.1f}, 'hnsw': {partition.index is not None}}}")
+
+
+async def run(args):
+    if args.dims:
+        await measure_dims(args)
+        return
+    import app.core.rag as rag
+
+    if args.min_score is not None:
+        rag.RAG_MIN_SCORE = args.min_score
+    if args.live:
+        cases = await live_cases(args.live)
+    else:
+        cases = synthetic_cases(args.docs, args.queries, args.dim, args.noise, args.seed)
+
+    # Calentar particiones / índices antes de medir
+    await measure(cases[:5], args.limit, hybrid=True)
+
+    print(f"📊 {len(cases)} queries, limit={args.limit}")
+    for label, hybrid in (("vectorial", False), ("híbrido", True)):
+        print(f"  {label:10s} {await measure(cases, args.limit, hybrid)}")
+    print(f"  {'repetidas':10s} {await measure(cases, args.limit, True, warm=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RAG vectorial vs híbrido")
+    parser.add_argument("--live", help="JSONL de queries reales (usa el backend configurado)")
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--noise", type=float, default=6.0, help="Ruido del embedding de la query (sintético)")
+    parser.add_argument("--limit", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--min-score", type=float, help="RAG_MIN_SCORE (en sintético conviene 0: los cosenos no son reales)")
+    parser.add_argument("--dims", help="Dimensiones de la 1ª etapa a comparar, p.ej. 128,256,512,0 (0 = completa)")
+    parser.add_argument("--hnsw", type=int, default=10**9, help="Con --dims: umbral de HNSW (por defecto exacta)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 SPHERE Backend - FastAPI Application
 Orquestador de agentes IA para startups.
 """
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,7 +10,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.core.database import db
 from app.core.logger import api_logger as logger
-from app.api.v1 import health, chat, stream, sessions, agents, documents
+from app.api.v1 import health, chat, stream, sessions, agents, documents, batch
 from app.tools.n8n_client import N8NClient
 import app.tools.n8n_client as n8n_module
 
@@ -22,6 +23,8 @@ async def _ensure_indexes():
     sessions_col = get_sessions_collection()
     await sessions_col.create_index([("session_id", ASCENDING)], unique=True, background=True)
     await sessions_col.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)], background=True)
+    # Borrar un documento lo retira de las sesiones que lo tienen como contexto
+    await sessions_col.create_index([("context_files.file_id", ASCENDING)], sparse=True, background=True)
 
     agents_col = get_custom_agents_collection()
     await agents_col.create_index([("agent_id", ASCENDING)], unique=True, background=True)
@@ -46,6 +49,39 @@ async def _ensure_indexes():
     audit_col = db.get_async_db()["tool_audit_log"]
     await audit_col.create_index([("session_id", ASCENDING), ("timestamp", DESCENDING)], background=True)
 
+    # Índices para razonamientos de modelos r1 (fuera del checkpoint)
+    reasoning_col = db.get_async_db()["reasoning_traces"]
+    await reasoning_col.create_index([("session_id", ASCENDING), ("message_id", ASCENDING)], background=True)
+
+    # Índices para respuestas precalentadas
+    warm_col = db.get_async_db()["warm_answers"]
+    await warm_col.create_index([("agent_key", ASCENDING), ("query_norm", ASCENDING)], unique=True, background=True)
+    stats_col = db.get_async_db()["query_stats"]
+    await stats_col.create_index([("agent_key", ASCENDING), ("query_norm", ASCENDING)], unique=True, background=True)
+    await stats_col.create_index([("agent_key", ASCENDING), ("count", DESCENDING)], background=True)
+
+    # Caché de embeddings de queries (TTL)
+    from app.core.embedding_cache import EMBED_CACHE_TTL_DAYS
+    embed_cache_col = db.get_async_db()["embedding_cache"]
+    await embed_cache_col.create_index(
+        [("created_at", ASCENDING)], expireAfterSeconds=EMBED_CACHE_TTL_DAYS * 86400, background=True
+    )
+
+    # Índices para jobs batch
+    batch_jobs_col = db.get_async_db()["batch_jobs"]
+    await batch_jobs_col.create_index([("job_id", ASCENDING)], unique=True, background=True)
+    batch_results_col = db.get_async_db()["batch_results"]
+    await batch_results_col.create_index([("job_id", ASCENDING), ("item_id", ASCENDING)], unique=True, background=True)
+
+    # Índices Atlas Vector Search de knowledge_base (definición según EMBED_SHORT_DIMS)
+    from app.core.vector_store import ATLAS_MANAGE_INDEXES, VECTOR_STORE, ensure_atlas_indexes
+    if VECTOR_STORE == "atlas" and ATLAS_MANAGE_INDEXES:
+        try:
+            await ensure_atlas_indexes()
+        except Exception as e:
+            # Mongo sin Atlas Search (local/CI): el RAG sigue funcionando sin gestionar índices
+            logger.warning(f"No se pudieron gestionar los índices Atlas Vector Search: {e}")
+
     logger.info("Índices de MongoDB verificados/creados")
 
 
@@ -66,6 +102,10 @@ async def lifespan(app: FastAPI):
         logger.critical(f"No se pudo conectar a MongoDB: {e}")
         raise
 
+    # Versión de la KB en proceso, invalidada por change stream (caché de resultados del RAG)
+    from app.core.vector_store import knowledge_stats
+    knowledge_stats.start_watch()
+
     # Inicializar N8N Client
     client = N8NClient(
         base_url=settings.N8N_BASE_URL,
@@ -80,11 +120,27 @@ async def lifespan(app: FastAPI):
     load_all_tools()
     logger.info("Tool registry cargado")
 
+    # Precalentado periódico de respuestas frecuentes (opcional)
+    from app.core.answer_warming import WARM_INTERVAL_HOURS, warming_loop
+    warming_task = None
+    if WARM_INTERVAL_HOURS > 0:
+        warming_task = asyncio.create_task(warming_loop(WARM_INTERVAL_HOURS))
+        logger.info(f"Precalentado de respuestas cada {WARM_INTERVAL_HOURS}h")
+
+    # Perfiles vectoriales de agentes custom anteriores al routing por perfil
+    from app.core.agent_profiles import backfill_agent_profiles
+    backfill_task = asyncio.create_task(backfill_agent_profiles())
+
     yield  # La aplicación corre aquí
 
     # Shutdown
     logger.info("Cerrando SPHERE Backend...")
+    if warming_task:
+        warming_task.cancel()
+    backfill_task.cancel()
     await client.close()
+    from app.core.rag import close_clients
+    await close_clients()
     db.close()
 
 
@@ -110,6 +166,7 @@ app.include_router(stream.router, prefix=f"{settings.API_V1_STR}/stream", tags=[
 app.include_router(sessions.router, prefix=f"{settings.API_V1_STR}/sessions", tags=["Sessions"])
 app.include_router(agents.router, prefix=f"{settings.API_V1_STR}/agents", tags=["Agents"])
 app.include_router(documents.router, prefix=f"{settings.API_V1_STR}/agents", tags=["Documents"])
+app.include_router(batch.router, prefix=f"{settings.API_V1_STR}/batch", tags=["Batch"])
 
 
 @app.get("/")
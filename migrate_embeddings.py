@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Migraciones de los embeddings de knowledge_base (sin llamar a OpenAI).
+
+--dims N: rellena embedding_short (vector corto de la 1ª etapa del RAG).
+    text-embedding-3-small es un embedding Matryoshka: las primeras N
+    componentes del vector completo, renormalizadas, equivalen a pedirlo
+    con `dimensions=N`, así que se recorta el `embedding` ya guardado.
+
+--pack: convierte los vectores guardados como array BSON de doubles
+    (formato legado) al formato de EMBED_STORAGE (binary vector float32 o
+    int8). Los lectores aceptan ambos formatos mientras dura la migración.
+
+Ambas son idempotentes y reanudables: solo tocan los documentos que aún no
+están en el formato pedido. Con --create-index se crean/actualizan además
+los índices Atlas Vector Search según la configuración.
+
+Uso:
+    python migrate_embeddings.py --pack
+    python migrate_embeddings.py --dims 256 --create-index
+    python migrate_embeddings.py --drop          # elimina embedding_short
+"""
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+# Añadir el directorio actual al path para imports
+sys.path.insert(0, str(Path(__file__).parent))
+
+# Cargar variables de entorno ANTES de importar otros módulos
+from dotenv import load_dotenv
+env_path = Path(__file__).parent.parent / ".env"
+load_dotenv(dotenv_path=env_path)
+
+if not os.getenv("MONGODB_URL"):
+    print("❌ ERROR: MONGODB_URL no está definida en .env")
+    sys.exit(1)
+
+
+def encoded_size(dims: int, storage: str) -> int:
+    """Tamaño que reporta $size (array) o $binarySize (binary vector) para `dims` componentes."""
+    return {"array": dims, "int8": dims + 2}.get(storage, dims * 4 + 2)
+
+
+def short_pending_filter(dims: int, storage: str) -> dict:
+    """Documentos con embedding cuyo embedding_short falta o no tiene el tamaño/formato pedido."""
+    from app.core.vector_store import SHORT_FIELD
+
+    field = f"${SHORT_FIELD}"
+    size = {"$cond": [{"$isArray": field}, {"$size": field}, {"$binarySize": field}]}
+    return {
+        "embedding": {"$exists": True},
+        "$or": [
+            {SHORT_FIELD: {"$exists": False}},
+            {"$expr": {"$ne": [size, encoded_size(dims, storage)]}},
+        ],
+    }
+
+
+def pack_pending_filter() -> dict:
+    from app.core.vector_store import SHORT_FIELD
+
+    return {"$or": [{"embedding": {"$type": "array"}}, {SHORT_FIELD: {"$type": "array"}}]}
+
+
+def run_batches(collection, query: dict, projection: dict, update, batch_size: int) -> int:
+    """Recorre `query` por _id en lotes y aplica `update(doc) -> dict $set` con bulk_write."""
+    from pymongo import UpdateOne
+
+    total = collection.count_documents(query)
+    print(f"🧮 {total} documentos pendientes")
+    done, last_id, t0 = 0, None, time.perf_counter()
+    while True:
+        page = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        batch = list(collection.find(page, projection).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        operations = [UpdateOne({"_id": doc["_id"]}, {"$set": changes}) for doc in batch if (changes := update(doc))]
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        done += len(operations)
+        last_id = batch[-1]["_id"]
+        print(f"  {done}/{total} ({done / (time.perf_counter() - t0):.0f} docs/s)")
+    return done
+
+
+def migrate_short(collection, dims: int, batch_size: int) -> int:
+    from app.core.vector_codec import EMBED_STORAGE, decode_vector, encode_vector
+    from app.core.vector_store import SHORT_FIELD, shorten
+
+    def update(doc):
+        full = decode_vector(doc["embedding"])
+        if len(full) <= dims:
+            return None
+        return {SHORT_FIELD: encode_vector(shorten(full, dims))}
+
+    return run_batches(collection, short_pending_filter(dims, EMBED_STORAGE), {"embedding": 1}, update, batch_size)
+
+
+def pack(collection, batch_size: int) -> int:
+    from app.core.vector_codec import EMBED_STORAGE, encode_vector
+    from app.core.vector_store import SHORT_FIELD
+
+    if EMBED_STORAGE == "array":
+        print("❌ EMBED_STORAGE=array: no hay nada que empaquetar")
+        sys.exit(1)
+
+    def update(doc):
+        return {
+            field: encode_vector(doc[field])
+            for field in ("embedding", SHORT_FIELD)
+            if isinstance(doc.get(field), list)
+        }
+
+    return run_batches(collection, pack_pending_filter(), {"embedding": 1, SHORT_FIELD: 1}, update, batch_size)
+
+
+def create_indexes(collection, dims: int) -> None:
+    from pymongo.operations import SearchIndexModel
+    from app.core.vector_store import ATLAS_TEXT_INDEX_NAME, atlas_text_index, atlas_vector_indexes, index_changes
+
+    existing = list(collection.list_search_indexes())
+    changes = index_changes(existing, atlas_vector_indexes(dims))
+    for action, name, definition in changes:
+        if action == "create":
+            collection.create_search_index(SearchIndexModel(definition=definition, name=name, type="vectorSearch"))
+        else:
+            collection.update_search_index(name, definition)
+        print(f"✅ Índice '{name}': {action} solicitado (Atlas lo construye en segundo plano)")
+    if not any(index.get("name") == ATLAS_TEXT_INDEX_NAME for index in existing):
+        collection.create_search_index(
+            SearchIndexModel(definition=atlas_text_index(), name=ATLAS_TEXT_INDEX_NAME, type="search")
+        )
+        changes.append(("create", ATLAS_TEXT_INDEX_NAME, atlas_text_index()))
+        print(f"✅ Índice Atlas Search '{ATLAS_TEXT_INDEX_NAME}': create solicitado")
+    if not changes:
+        print("✅ Índices Atlas Search y Vector Search al día")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migraciones de embeddings de knowledge_base")
+    parser.add_argument("--dims", type=int, default=int(os.getenv("EMBED_SHORT_DIMS", "0")),
+                        help="Dimensiones de embedding_short (0 = no migrar)")
+    parser.add_argument("--pack", action="store_true", help="Convierte arrays legados al formato de EMBED_STORAGE")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--create-index", action="store_true", help="Crea/actualiza los índices Atlas Vector Search (y crea el de Atlas Search si falta)")
+    parser.add_argument("--drop", action="store_true", help="Elimina embedding_short de todos los documentos")
+    args = parser.parse_args()
+
+    from app.core.database import db
+    from app.core.vector_store import EMBEDDING_DIMS, SHORT_FIELD
+
+    collection = db.get_sync_client()[db.db_name]["knowledge_base"]
+    if args.drop:
+        result = collection.update_many({SHORT_FIELD: {"$exists": True}}, {"$unset": {SHORT_FIELD: ""}})
+        print(f"🗑️ embedding_short eliminado de {result.modified_count} documentos")
+        return
+    if not (args.pack or args.dims or args.create_index):
+        parser.error("indica --pack, --dims N y/o --create-index")
+    if args.dims and not 0 < args.dims < EMBEDDING_DIMS:
+        parser.error(f"--dims debe estar entre 1 y {EMBEDDING_DIMS - 1}")
+
+    if args.pack:
+        print(f"✅ {pack(collection, args.batch_size)} documentos empaquetados")
+    if args.dims:
+        print(f"✅ {migrate_short(collection, args.dims, args.batch_size)} documentos migrados "
+              f"(activar con EMBED_SHORT_DIMS={args.dims})")
+    if args.create_index:
+        create_indexes(collection, args.dims)
+
+
+if __name__ == "__main__":
+    main()
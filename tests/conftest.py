@@ -16,6 +16,31 @@ env_path = Path(__file__).resolve().parents[2] / ".env"
 load_dotenv(dotenv_path=env_path)
 
 
+class FakeCursor:
+    """Cursor async de Motor en memoria (find/aggregate/list_search_indexes de los fakes de colección)."""
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda doc: doc.get(key, 0), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
 @pytest.fixture(scope="session")
 def event_loop():
     """Manual event loop fixture for session scope to match MongoDB connection scope."""
@@ -34,6 +59,64 @@ def mongo_uri():
     return uri
 
 
+def _patch_mongomock_bulk(monkeypatch):
+    """pymongo >= 4.11 pasa sort= a UpdateOne en bulk_write; mongomock aún no lo admite."""
+    import mongomock
+
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    monkeypatch.setattr(
+        mongomock.collection.BulkOperationBuilder, "add_update",
+        lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs),
+    )
+
+
+@pytest.fixture(scope="function")
+def mongo_client_mock(monkeypatch):
+    """Cliente mongomock en memoria (checkpointer sin servidor Mongo)."""
+    import mongomock
+
+    _patch_mongomock_bulk(monkeypatch)
+    return mongomock.MongoClient()
+
+
+@pytest.fixture(scope="session")
+def orchestrator():
+    """
+    app.core.orchestrator importado sin servidor Mongo ni claves: el import
+    hace db.connect() y crea el checkpointer, así que se conecta a mongomock
+    (sin esto cada import espera el timeout de 30s). Si otro test ya lo
+    importó contra un Mongo real, se reutiliza tal cual.
+    """
+    import importlib
+    import os
+
+    import mongomock
+
+    from app.core.database import Database, db
+
+    if "app.core.orchestrator" in sys.modules:
+        yield sys.modules["app.core.orchestrator"]
+        return
+
+    def connect_mock(self):
+        if self.sync_client is None:
+            self.sync_client = mongomock.MongoClient()
+        return True
+
+    patch = pytest.MonkeyPatch()
+    _patch_mongomock_bulk(patch)
+    for key in ("DEEPSEEK_API_KEY", "OPENAI_API_KEY"):
+        if not os.getenv(key):
+            patch.setenv(key, "test")
+    with pytest.MonkeyPatch.context() as connection:
+        connection.setattr(Database, "connect", connect_mock)
+        module = importlib.import_module("app.core.orchestrator")
+    yield module
+    patch.undo()
+    if not db._connected:
+        db.sync_client = None  # un test posterior con Mongo real reconecta de cero
+
+
 @pytest.fixture(scope="function")
 def db_instance():
     """Instancia de Database conectada para tests."""
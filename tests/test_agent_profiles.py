@@ -0,0 +1,231 @@
+"""
+Tests para el routing de sesiones GROUP por perfiles vectoriales.
+Verifica el umbral de similitud, las queries fuera de tema, el cálculo del
+perfil de los miembros que no lo tienen, los empates, que el LLM router de
+respaldo solo elige miembros de la sesión y que volver a un rol core limpia
+la persona de un miembro custom anterior.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import app.core.agent_profiles as agent_profiles
+from tests.conftest import FakeCursor
+
+CORE_PROMPTS = {"CEO": "ceo", "CTO": "cto", "CFO": "cfo", "CMO": "cmo"}
+
+
+class FakeAgents:
+    """custom_agents con find() async por agent_id o por perfil ausente."""
+
+    def __init__(self, agents):
+        self.agents = agents
+
+    def find(self, query, projection=None):
+        if "agent_id" in query:
+            docs = [a for a in self.agents if a["agent_id"] in query["agent_id"]["$in"]]
+        else:
+            docs = [a for a in self.agents if not a.get("profile_embedding")]
+        return FakeCursor([dict(a) for a in docs])
+
+    async def find_one(self, query):
+        return next((dict(a) for a in self.agents if a["agent_id"] == query["agent_id"]), None)
+
+    async def update_one(self, query, update):
+        for agent in self.agents:
+            if agent["agent_id"] == query["agent_id"]:
+                agent.update(update["$set"])
+
+
+def _embedding(text):
+    # Ejes: CTO / abogado = [1,0,0], resto de perfiles = [0,1,0], frases fuera de tema = [0,0,1]
+    if text in agent_profiles.OFF_TOPIC_ANCHORS:
+        return [0.0, 0.0, 1.0]
+    if text == "cto" or "abogado" in text.lower():
+        return [1.0, 0.0, 0.0]
+    return [0.0, 1.0, 0.0]
+
+
+@pytest.fixture
+def profiles(monkeypatch):
+    """Perfiles core en ejes distintos; embed_texts cuenta los textos embebidos."""
+    embedded = []
+
+    async def fake_embed(texts):
+        embedded.extend(texts)
+        return [_embedding(text) for text in texts]
+
+    agents = FakeAgents([])
+    agents.embedded = embedded
+    kb = {"knowledge_base": SimpleNamespace(find=lambda query, projection=None: FakeCursor([]))}
+    monkeypatch.setattr(agent_profiles, "embed_texts", fake_embed)
+    monkeypatch.setattr(agent_profiles, "_core_profiles", {})
+    monkeypatch.setattr(agent_profiles, "_off_topic", [])
+    monkeypatch.setattr(agent_profiles, "db", SimpleNamespace(get_async_db=lambda: kb))
+    monkeypatch.setattr(agent_profiles, "get_custom_agents_collection", lambda: agents)
+    return agents
+
+
+class TestRouteToMember:
+    """Tests para app.core.agent_profiles.route_to_member."""
+
+    @pytest.mark.asyncio
+    async def test_best_member_above_threshold(self, profiles):
+        """Test: Gana el miembro más similar; por debajo de MEMBER_ROUTING_MIN_SCORE decide el LLM router."""
+        profiles.agents.append({"agent_id": "legal", "profile_embedding": [0.6, 0.8, 0.0]})
+
+        match = await agent_profiles.route_to_member([0.0, 1.0, 0.0], ["cto", "legal"], CORE_PROMPTS)
+        assert match["member_id"] == "legal" and match["core_role"] is None
+        assert match["agent"]["agent_id"] == "legal" and "profile_embedding" not in match["agent"]
+
+        low = agent_profiles.MEMBER_ROUTING_MIN_SCORE / 2
+        assert await agent_profiles.route_to_member([low, 0.0, 0.0], ["cto", "legal"], CORE_PROMPTS) is None
+
+    @pytest.mark.asyncio
+    async def test_off_topic_query_falls_back(self, profiles):
+        """Test: Un saludo que supera el umbral con algún perfil pero se parece más a las frases fuera de tema no enruta."""
+        profiles.agents.append({"agent_id": "legal", "profile_embedding": [0.6, 0.8, 0.0]})
+        greeting = [0.0, 0.5, 0.866]  # ~0.4 con "legal", ~0.87 con los saludos
+        assert 0.4 > agent_profiles.MEMBER_ROUTING_MIN_SCORE
+
+        assert await agent_profiles.route_to_member(greeting, ["cto", "legal"], CORE_PROMPTS) is None
+
+        # Las frases fuera de tema se embeben una sola vez por proceso
+        await agent_profiles.route_to_member(greeting, ["cto", "legal"], CORE_PROMPTS)
+        assert profiles.embedded.count(agent_profiles.OFF_TOPIC_ANCHORS[0]) == 1
+
+    @pytest.mark.asyncio
+    async def test_members_without_profile_are_computed(self, profiles):
+        """Test: Un agente sin profile_embedding (o vacío) calcula y guarda su perfil en el turno y compite."""
+        profiles.agents += [
+            {"agent_id": "sin-perfil", "identity": {"role": "Abogado"}},
+            {"agent_id": "vacio", "profile_embedding": []},
+        ]
+
+        match = await agent_profiles.route_to_member([1.0, 0.0, 0.0], ["sin-perfil", "vacio"], CORE_PROMPTS)
+        assert match["member_id"] == "sin-perfil"
+        assert profiles.agents[0]["profile_embedding"] == [1.0, 0.0, 0.0]
+        assert profiles.agents[1]["profile_embedding"] == [0.0, 1.0, 0.0]
+
+    @pytest.mark.asyncio
+    async def test_failed_profile_is_skipped(self, profiles, monkeypatch):
+        """Test: Si el perfil no se puede calcular el agente no compite; sin ningún perfil no hay match."""
+        async def broken_embed(texts):
+            raise RuntimeError("OpenAI no disponible")
+
+        profiles.agents.append({"agent_id": "sin-perfil"})
+        monkeypatch.setattr(agent_profiles, "embed_texts", broken_embed)
+
+        assert await agent_profiles.route_to_member([1.0, 0.0, 0.0], ["sin-perfil"], CORE_PROMPTS) is None
+
+    @pytest.mark.asyncio
+    async def test_tie_goes_to_first_listed_member(self, profiles):
+        """Test: Con el mismo score, core y custom, gana el miembro listado antes en la sesión."""
+        profiles.agents.append({"agent_id": "arquitecto", "profile_embedding": [1.0, 0.0, 0.0]})
+
+        first = await agent_profiles.route_to_member([1.0, 0.0, 0.0], ["arquitecto", "cto"], CORE_PROMPTS)
+        assert first["member_id"] == "arquitecto"
+        first = await agent_profiles.route_to_member([1.0, 0.0, 0.0], ["cto", "arquitecto"], CORE_PROMPTS)
+        assert first["member_id"] == "cto"
+
+
+class TestBackfillAgentProfiles:
+    """Tests para app.core.agent_profiles.backfill_agent_profiles."""
+
+    @pytest.mark.asyncio
+    async def test_only_agents_without_profile(self, profiles):
+        """Test: El backfill de arranque solo calcula los perfiles que faltan."""
+        profiles.agents += [
+            {"agent_id": "legal", "identity": {"role": "Abogado"}},
+            {"agent_id": "ventas", "profile_embedding": [0.0, 1.0, 0.0]},
+        ]
+
+        assert await agent_profiles.backfill_agent_profiles() == 1
+        assert profiles.agents[0]["profile_embedding"] == [1.0, 0.0, 0.0]
+        assert len(profiles.embedded) == 1
+
+
+class TestCoreRoleForMember:
+    """Tests para app.core.agent_profiles.core_role_for_member."""
+
+    def test_only_known_core_ids(self):
+        """Test: Solo los ids de CORE_MEMBER_IDS son roles core; un agente custom con prefijo de rol no."""
+        assert agent_profiles.core_role_for_member("CTO") == "CTO"
+        assert agent_profiles.core_role_for_member("cfo-1") == "CFO"
+        assert agent_profiles.core_role_for_member("cto-consultor") is None
+        assert agent_profiles.core_role_for_member("legal") is None
+
+
+LEGAL = {
+    "agent_id": "legal",
+    "identity": {"name": "Lex", "role": "Abogado", "description": "Contratos y compliance."},
+    "brain_config": {"system_prompt": "Eres el abogado.", "model": "deepseek-chat"},
+}
+
+
+@pytest.fixture
+def group_router(orchestrator, monkeypatch):
+    """router_node sin match por perfil: decide un LLM router falso que registra su prompt."""
+    class FakeRouter:
+        def __init__(self):
+            self.answer = "1"
+            self.prompts = []
+
+        async def ainvoke(self, messages):
+            self.prompts.append(messages[0].content)
+            return SimpleNamespace(content=self.answer)
+
+    async def no_match(query_vector, members, core_prompts):
+        return None
+
+    async def fake_embed(query):
+        return [0.0, 1.0, 0.0]
+
+    router = FakeRouter()
+    monkeypatch.setattr(orchestrator, "llm_router", router)
+    monkeypatch.setattr(orchestrator, "route_to_member", no_match)
+    monkeypatch.setattr(orchestrator, "embed_query", fake_embed)
+    monkeypatch.setattr(orchestrator, "get_custom_agents_collection", lambda: FakeAgents([LEGAL]))
+    return router
+
+
+def _group_state(members, **previous):
+    # Las sesiones GROUP llegan sin target_role
+    return {"query": "hola", "target_role": None, "members": members, **previous}
+
+
+class TestGroupRouterState:
+    """Tests para router_node en sesiones GROUP (requiere el orquestador)."""
+
+    @pytest.mark.asyncio
+    async def test_llm_fallback_clears_custom_persona(self, orchestrator, group_router):
+        """Test: Si decide el LLM router, el prompt/modelo del miembro custom del turno anterior no sobrevive."""
+        # Turno anterior enrutado a "legal"
+        state = _group_state(["cto", "legal"], system_prompt="Eres el abogado.", model_config={"model": "deepseek-r1"})
+        update = await orchestrator.router_node(state, {})
+
+        assert update == {"next_agent": "CTO", "system_prompt": None, "model_config": None, "target_role": "CTO"}
+
+    @pytest.mark.asyncio
+    async def test_llm_fallback_only_offers_members(self, orchestrator, group_router):
+        """Test: El LLM router solo elige entre los miembros (sin CEO si no está en la sesión)."""
+        group_router.answer = "2"
+        update = await orchestrator.router_node(_group_state(["cfo-1", "legal"]), {})
+
+        assert update["target_role"] == "legal" and update["system_prompt"] == "Eres el abogado."
+        assert "1. CFO:" in group_router.prompts[0] and "2. Lex:" in group_router.prompts[0]
+        assert "CEO:" not in group_router.prompts[0]
+
+    @pytest.mark.asyncio
+    async def test_invalid_llm_answer_picks_first_member(self, orchestrator, group_router):
+        """Test: Una respuesta que no es un miembro (p. ej. 'CEO') cae en el primer miembro, no en el CEO."""
+        group_router.answer = "CEO"
+        update = await orchestrator.router_node(_group_state(["cmo", "legal"]), {})
+        assert update["next_agent"] == "CMO"
+
+        update = await orchestrator.router_node(_group_state(["legal"]), {})
+        assert update["target_role"] == "legal" and len(group_router.prompts) == 1  # un solo miembro: sin LLM
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
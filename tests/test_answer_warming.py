@@ -0,0 +1,175 @@
+"""
+Tests para el precalentado de respuestas frecuentes.
+Verifica la normalización usada para las coincidencias casi exactas y que
+los fallos del precalentado no afectan a la ingesta ni al resto del job.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import app.core.answer_warming as answer_warming
+from app.core.answer_warming import normalize_query
+from tests.conftest import FakeCursor
+
+
+class FakeWarmAnswers:
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.deleted = []
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.docs)
+
+    async def delete_many(self, query):
+        self.deleted.append(query)
+
+
+class TestAnswerWarming:
+    """Tests para app.core.answer_warming."""
+
+    def test_normalize_query_near_exact_matches(self):
+        """Test: Mayúsculas, tildes, puntuación y espacios no cambian la clave."""
+        assert normalize_query("¿Qué es SPHERE?") == "que es sphere"
+        assert normalize_query("  que   es sphere ") == normalize_query("¿Qué es SPHERE?")
+
+    def test_normalize_query_keeps_distinct_queries_apart(self):
+        """Test: Queries con palabras distintas no colisionan."""
+        assert normalize_query("¿Qué es SPHERE?") != normalize_query("¿Quién es SPHERE?")
+        assert normalize_query("???") == ""
+
+
+class TestRunWarmingFailures:
+    """Tests para los pasos protegidos de app.core.answer_warming.run_warming."""
+
+    @pytest.mark.asyncio
+    async def test_failed_steps_are_counted_not_raised(self, monkeypatch):
+        """Test: Un fallo al minar o al calcular la huella de un agente no aborta el job."""
+        warmed = []
+
+        async def broken_mining(agents, top_n, min_count):
+            raise RuntimeError("query_stats no disponible")
+
+        async def fingerprint(agent_key):
+            if agent_key == "CTO":
+                raise RuntimeError("knowledge_base no disponible")
+            return "huella"
+
+        async def warm_query(agent_key, query, fp, graph=None):
+            warmed.append((agent_key, query))
+            return True
+
+        monkeypatch.setattr(answer_warming, "mine_frequent_queries", broken_mining)
+        monkeypatch.setattr(answer_warming, "agent_fingerprint", fingerprint)
+        monkeypatch.setattr(answer_warming, "warm_query", warm_query)
+        monkeypatch.setattr(answer_warming, "get_warm_answers_collection", lambda: FakeWarmAnswers())
+
+        summary = await answer_warming.run_warming(seeds={"CEO": ["¿Qué es SPHERE?"], "CTO": ["¿Qué stack?"]})
+
+        assert warmed == [("CEO", "¿Qué es SPHERE?")]
+        assert summary["errors"] == 2 and summary["warmed"] == 1
+
+
+class TestRefreshAfterIngest:
+    """Tests para el refresco de perfil y precalentado tras ingerir un documento."""
+
+    @pytest.mark.asyncio
+    async def test_ingest_completes_without_waiting_for_refresh(self, monkeypatch):
+        """Test: El documento queda 'completed' aunque el refresco falle, y la ingesta no espera al precalentado."""
+        import app.core.agent_profiles as agent_profiles
+        import app.core.database as database
+        import app.core.document_processor as document_processor
+
+        status_updates = []
+        rewarm_started = asyncio.Event()
+        release_rewarm = asyncio.Event()
+
+        class FakeCollection:
+            async def update_one(self, query, update):
+                status_updates.append(update["$set"] if "$set" in update else update)
+
+        async def store(agent_id, file_id, filename, chunks, embeddings):
+            return len(chunks)
+
+        async def broken_profile(agent_id):
+            raise RuntimeError("OpenAI no disponible")
+
+        async def slow_rewarm(agent_key):
+            rewarm_started.set()
+            await release_rewarm.wait()
+
+        monkeypatch.setattr(document_processor, "parse_document", lambda data, name: "texto")
+        monkeypatch.setattr(document_processor, "chunk_text", lambda text, name: ["chunk"])
+        monkeypatch.setattr(document_processor, "embed_chunks_sync", lambda chunks: [[0.1]])
+        monkeypatch.setattr(document_processor, "store_document_vectors", store)
+        monkeypatch.setattr(database, "get_gridfs_bucket", lambda: SimpleNamespace(_files=FakeCollection()))
+        monkeypatch.setattr(database, "get_custom_agents_collection", lambda: FakeCollection())
+        monkeypatch.setattr(agent_profiles, "refresh_agent_profile", broken_profile)
+        monkeypatch.setattr(answer_warming, "rewarm_agent", slow_rewarm)
+
+        result = await document_processor.process_document("agent-1", "0" * 24, "a.md", b"texto")
+        assert result == {"status": "completed", "chunks_stored": 1}
+
+        # El precalentado sigue en curso tras volver la ingesta; el fallo del perfil no lo impidió
+        await asyncio.wait_for(rewarm_started.wait(), 1)
+        release_rewarm.set()
+        await asyncio.gather(*document_processor._background)
+        assert {"metadata.processing_status": "failed"} not in status_updates
+        assert status_updates[0]["metadata.processing_status"] == "completed"
+
+
+class TestFirstTurnDetection:
+    """Tests para la detección del primer turno en /stream (flag `started` de la sesión)."""
+
+    @staticmethod
+    def _patch(monkeypatch, orchestrator, session_doc, warm=None):
+        import app.core.database as database
+
+        class FakeSessions:
+            async def find_one(self, query):
+                return session_doc
+
+        async def no_checkpoint_read(*args, **kwargs):
+            raise AssertionError("el primer turno no debe consultar el checkpointer")
+
+        lookups = []
+
+        async def lookup(agent_key, query):
+            lookups.append(query)
+            return warm
+
+        monkeypatch.setattr(database, "get_sessions_collection", lambda: FakeSessions())
+        monkeypatch.setattr(orchestrator.checkpointer, "aresolve_checkpoint_id", no_checkpoint_read)
+        monkeypatch.setattr(answer_warming, "lookup_warm_answer", lookup)
+        return lookups
+
+    @pytest.mark.asyncio
+    async def test_started_session_skips_warm_lookup(self, orchestrator, monkeypatch):
+        """Test: Una sesión ya iniciada no busca respuesta precalentada ni lee checkpoints."""
+        from app.api.v1 import stream
+
+        session_doc = {"session_id": "s1", "type": "direct", "base_agent_id": "CEO", "started": True}
+        lookups = self._patch(monkeypatch, orchestrator, session_doc)
+
+        response = await stream.chat_stream_endpoint(stream.StreamRequest(query="hola", session_id="s1"))
+
+        assert lookups == []
+        assert response.background.tasks == []
+
+    @pytest.mark.asyncio
+    async def test_new_session_is_marked_started(self, orchestrator, monkeypatch):
+        """Test: El primer turno consulta el precalentado y marca la sesión como iniciada."""
+        from app.api.v1 import stream
+
+        session_doc = {"session_id": "s2", "type": "direct", "base_agent_id": "CEO", "started": False}
+        lookups = self._patch(monkeypatch, orchestrator, session_doc)
+
+        response = await stream.chat_stream_endpoint(stream.StreamRequest(query="hola", session_id="s2"))
+
+        assert lookups == ["hola"]
+        tasks = [task.func for task in response.background.tasks]
+        assert tasks == [stream.mark_session_started, answer_warming.record_first_turn]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,122 @@
+"""
+Tests para el runner de inferencia batch.
+Usa un grafo falso: verifica parseo, reanudación (solo de items correctos),
+reintentos ante rate limit y concurrencia acotada.
+"""
+import asyncio
+
+import pytest
+
+import app.core.batch_runner as batch_runner
+from app.core.batch_runner import BatchInputError, load_items, read_done_ids, run_batch
+
+
+class RateLimitError(Exception):
+    """Como openai.RateLimitError: status_code 429."""
+    status_code = 429
+
+
+class FakeGraph:
+    """Grafo mínimo con la interfaz ainvoke de LangGraph."""
+
+    def __init__(self, fail_on=None, rate_limited=0):
+        self.fail_on = fail_on
+        self.rate_limited = rate_limited
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    async def ainvoke(self, state, config=None):
+        self.calls.append(state["query"])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if state["query"] == self.fail_on:
+            raise RuntimeError("LLM caído")
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise RateLimitError("429 Too Many Requests")
+        return {"next_agent": state["target_role"] or "CEO", "final_response": f"eco: {state['query']}"}
+
+
+class TestBatchRunner:
+    """Tests para app.core.batch_runner."""
+
+    def test_load_items_parses_targets(self):
+        """Test: role/agent_id se normalizan a target y las líneas vacías se ignoran."""
+        items = load_items([
+            '{"id": "a", "query": "hola", "role": "CTO"}',
+            "",
+            '{"query": "sin id", "agent_id": "agent-1"}',
+        ])
+
+        assert items == [
+            {"id": "a", "query": "hola", "target": "CTO"},
+            {"id": "3", "query": "sin id", "target": "agent-1"},
+        ]
+
+    def test_load_items_rejects_invalid_lines(self):
+        """Test: JSON inválido, query vacía o ids duplicados fallan con el nº de línea."""
+        with pytest.raises(BatchInputError, match="Línea 1"):
+            load_items(["{no json"])
+        with pytest.raises(BatchInputError, match="query"):
+            load_items(['{"id": "a"}'])
+        with pytest.raises(BatchInputError, match="duplicado"):
+            load_items(['{"id": "a", "query": "x"}', '{"id": "a", "query": "y"}'])
+
+    @pytest.mark.asyncio
+    async def test_run_batch_skips_done_and_bounds_concurrency(self):
+        """Test: Se saltan los ids hechos y nunca hay más items en vuelo que la concurrencia."""
+        items = load_items([f'{{"id": "q{i}", "query": "consulta {i}"}}' for i in range(10)])
+        graph = FakeGraph(fail_on="consulta 3")
+        results = []
+
+        async def sink(result):
+            results.append(result)
+
+        summary = await run_batch(
+            items, sink, concurrency=2, requests_per_minute=0, done_ids={"q0", "q1"}, graph=graph
+        )
+
+        assert summary["skipped"] == 2
+        assert summary["ok"] == 7 and summary["error"] == 1
+        assert graph.max_in_flight <= 2
+        assert {r["id"] for r in results} == {f"q{i}" for i in range(2, 10)}
+        failed = next(r for r in results if r["status"] == "error")
+        assert failed["id"] == "q3" and "latency_ms" in failed
+
+    @pytest.mark.asyncio
+    async def test_rate_limit_is_retried_with_backoff(self, monkeypatch):
+        """Test: Un 429 se reintenta con backoff; agotados los reintentos el item queda con error."""
+        monkeypatch.setattr(batch_runner, "RATE_LIMIT_BACKOFF_S", 0)
+        item = load_items(['{"id": "q1", "query": "hola"}'])[0]
+
+        result = await batch_runner.run_item(item, FakeGraph(rate_limited=2))
+        assert result["status"] == "ok" and result["attempts"] == 3
+
+        result = await batch_runner.run_item(item, FakeGraph(rate_limited=batch_runner.RATE_LIMIT_RETRIES + 1))
+        assert result["status"] == "error" and result["rate_limited"]
+        assert result["attempts"] == batch_runner.RATE_LIMIT_RETRIES + 1
+
+    def test_read_done_ids_ignores_truncated_lines(self, tmp_path):
+        """Test: Una última línea truncada por un corte no cuenta como hecha."""
+        output = tmp_path / "out.jsonl"
+        output.write_text('{"id": "q1", "status": "ok"}\n{"id": "q2", "sta', encoding="utf-8")
+
+        assert read_done_ids(str(output)) == {"q1"}
+
+    def test_read_done_ids_retries_failed_items(self, tmp_path):
+        """Test: Los items con error no cuentan como hechos; si un reintento acabó bien, sí."""
+        output = tmp_path / "out.jsonl"
+        output.write_text(
+            '{"id": "q1", "status": "error"}\n{"id": "q2", "status": "error"}\n{"id": "q2", "status": "ok"}\n',
+            encoding="utf-8",
+        )
+
+        assert read_done_ids(str(output)) == {"q2"}
+        assert read_done_ids(str(tmp_path / "no-existe.jsonl")) == set()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,164 @@
+"""
+Tests para la caché del último checkpoint de ForkAwareMongoDBSaver.
+Verifica aciertos, entradas obsoletas escritas o borradas por otro worker,
+la expulsión LRU, la invalidación al registrar writes pendientes y la
+invalidación por change stream (eventos simulados: mongomock no los emite).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langgraph.checkpoint.base import empty_checkpoint
+
+from app.core.checkpointing import ForkAwareMongoDBSaver
+
+
+def _config(thread_id, checkpoint_id=None):
+    configurable = {"thread_id": thread_id, "checkpoint_ns": ""}
+    if checkpoint_id:
+        configurable["checkpoint_id"] = checkpoint_id
+    return {"configurable": configurable}
+
+
+def _put(saver, thread_id, value, parent=None):
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"value": value}
+    parent_id = parent["configurable"]["checkpoint_id"] if parent else None
+    return saver.put(_config(thread_id, parent_id), checkpoint, {"step": value}, {})
+
+
+def _value(loaded):
+    return loaded.checkpoint["channel_values"]["value"]
+
+
+@pytest.fixture
+def workers(mongo_client_mock):
+    """Dos procesos (cada uno con su caché) sobre la misma base de datos."""
+    return (
+        ForkAwareMongoDBSaver(mongo_client_mock, cache_watch=False),
+        ForkAwareMongoDBSaver(mongo_client_mock, cache_watch=False),
+    )
+
+
+class TestCheckpointCache:
+    """Tests para la caché LRU write-through de checkpoints."""
+
+    def test_hit_after_write_through(self, workers):
+        """Test: El checkpoint recién escrito se lee de la caché, como copia aislada."""
+        saver, _ = workers
+        _put(saver, "t", 1)
+
+        loaded = saver.get_tuple(_config("t"))
+        loaded.checkpoint["channel_values"]["value"] = 99
+        assert _value(saver.get_tuple(_config("t"))) == 1
+        assert saver.cache_stats()["hits"] == 2 and saver.cache_stats()["misses"] == 0
+
+    def test_latest_written_by_other_worker_is_stale(self, workers):
+        """Test: Si otro worker escribió un checkpoint más nuevo, la entrada se descarta y se lee de Mongo."""
+        saver, other = workers
+        first = _put(saver, "t", 1)
+        _put(other, "t", 2, parent=first)
+
+        assert _value(saver.get_tuple(_config("t"))) == 2
+        assert saver.cache_stats()["stale"] == 1
+        assert _value(saver.get_tuple(_config("t"))) == 2
+        assert saver.cache_stats()["hits"] == 1  # la lectura de Mongo pasó a ser la entrada cacheada
+
+    def test_explicit_id_is_verified(self, workers):
+        """Test: Un checkpoint pedido por id que otro worker borró no se sirve de la caché."""
+        saver, other = workers
+        written = _put(saver, "t", 1)
+        other.delete_thread("t")
+
+        assert saver.get_tuple(written) is None
+        assert saver.cache_stats()["stale"] == 1
+
+    def test_trusted_cache_skips_verification(self, mongo_client_mock):
+        """Test: Con cache_trust (sesiones sticky) el acierto no consulta Mongo."""
+        saver = ForkAwareMongoDBSaver(mongo_client_mock, cache_trust=True)
+        _put(saver, "t", 1)
+        saver.checkpoint_collection.delete_many({})
+
+        assert _value(saver.get_tuple(_config("t"))) == 1
+
+    def test_lru_eviction(self, mongo_client_mock):
+        """Test: Por encima de cache_size se expulsa el thread menos reciente."""
+        saver = ForkAwareMongoDBSaver(mongo_client_mock, cache_size=2, cache_watch=False)
+        for thread_id in ("a", "b", "c"):
+            _put(saver, thread_id, 1)
+
+        assert saver.cache_stats()["evictions"] == 1 and saver.cache_stats()["size"] == 2
+        saver.get_tuple(_config("a"))
+        saver.get_tuple(_config("c"))
+        assert saver.cache_stats()["misses"] == 1 and saver.cache_stats()["hits"] == 1
+
+    def test_put_writes_invalidates_entry(self, workers):
+        """Test: Un write pendiente sobre el checkpoint cacheado lo invalida; con writes no se vuelve a cachear."""
+        saver, _ = workers
+        written = _put(saver, "t", 1)
+        saver.put_writes(written, [("value", 2)], task_id="tarea-1")
+
+        loaded = saver.get_tuple(_config("t"))
+        assert [w[1:] for w in loaded.pending_writes] == [("value", 2)]
+        saver.get_tuple(_config("t"))
+        assert saver.cache_stats()["misses"] == 2 and saver.cache_stats()["hits"] == 0
+
+    def test_counters_from_executor_threads(self, mongo_client_mock):
+        """Test: Los contadores no pierden incrementos con lecturas concurrentes desde varios threads."""
+        saver = ForkAwareMongoDBSaver(mongo_client_mock, cache_trust=True)
+        _put(saver, "t", 1)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: saver.get_tuple(_config("t")), range(400)))
+        assert saver.cache_stats()["hits"] == 400
+
+
+def _insert_event(saver, thread_id):
+    """Evento 'insert' del change stream para el último checkpoint del thread en Mongo."""
+    doc = saver.checkpoint_collection.find_one({"thread_id": thread_id}, sort=[("checkpoint_id", -1)])
+    return {
+        "operationType": "insert",
+        "fullDocument": {key: doc[key] for key in ("thread_id", "checkpoint_ns", "checkpoint_id")},
+    }
+
+
+class TestCheckpointCacheWatch:
+    """Tests para la invalidación por change stream (sin lectura de verificación)."""
+
+    @pytest.fixture
+    def watched(self, workers):
+        saver, other = workers
+        saver.watching = True  # como si el change stream estuviera abierto
+        return saver, other
+
+    def test_hit_without_verification_read(self, watched):
+        """Test: Con el stream abierto, un acierto no consulta Mongo."""
+        saver, _ = watched
+        _put(saver, "t", 1)
+        saver._on_change(_insert_event(saver, "t"))  # eco de la escritura propia: no invalida
+
+        assert _value(saver.get_tuple(_config("t"))) == 1
+        assert saver.cache_stats()["verify_reads"] == 0 and saver.cache_stats()["mode"] == "watch"
+
+    def test_newer_checkpoint_from_other_worker_invalidates(self, watched):
+        """Test: Un checkpoint más nuevo escrito por otro worker invalida la entrada y se lee de Mongo."""
+        saver, other = watched
+        first = _put(saver, "t", 1)
+        _put(other, "t", 2, parent=first)
+        saver._on_change(_insert_event(other, "t"))
+
+        assert _value(saver.get_tuple(_config("t"))) == 2
+        assert saver.cache_stats()["invalidated"] == 1 and saver.cache_stats()["misses"] == 1
+
+    def test_delete_event_clears_cache(self, watched):
+        """Test: Un borrado (sesión eliminada en otro worker) vacía la caché."""
+        saver, other = watched
+        written = _put(saver, "t", 1)
+        other.delete_thread("t")
+        saver._on_change({"operationType": "delete", "documentKey": {"_id": "x"}})
+
+        assert saver.get_tuple(written) is None
+        assert saver.cache_stats()["size"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,80 @@
+"""
+Tests para la contabilidad de escrituras de checkpoint por turno.
+Verifica que los contadores reflejan el modo de durabilidad (sync, async,
+exit) y que son del turno en curso aunque haya turnos concurrentes.
+"""
+import asyncio
+from typing import TypedDict
+
+import pytest
+from langgraph.graph import END, StateGraph
+
+import app.core.checkpointing as checkpointing
+from app.core.checkpointing import ForkAwareMongoDBSaver, record_turn, track_turn_writes, turn_stats
+
+
+class StepsState(TypedDict):
+    steps: int
+
+
+async def _step(state: StepsState):
+    await asyncio.sleep(0.001)  # cede el loop: los turnos concurrentes se intercalan
+    return {"steps": state.get("steps", 0) + 1}
+
+
+@pytest.fixture
+def graph(mongo_client_mock):
+    """Grafo de dos nodos (a -> b) con el checkpointer real sobre mongomock."""
+    workflow = StateGraph(StepsState)
+    workflow.add_node("a", _step)
+    workflow.add_node("b", _step)
+    workflow.set_entry_point("a")
+    workflow.add_edge("a", "b")
+    workflow.add_edge("b", END)
+    return workflow.compile(checkpointer=ForkAwareMongoDBSaver(mongo_client_mock, cache_watch=False))
+
+
+async def _turn(graph, thread_id, durability):
+    counters = track_turn_writes()
+    await graph.ainvoke({"steps": 0}, {"configurable": {"thread_id": thread_id}}, durability=durability)
+    return counters
+
+
+class TestTurnWrites:
+    """Tests para track_turn_writes / record_turn / turn_stats."""
+
+    @pytest.mark.asyncio
+    async def test_counts_follow_durability(self, graph):
+        """Test: sync y async escriben un checkpoint por paso con sus writes; exit, un único checkpoint."""
+        # input + __start__ + a + b, y un write por tarea (__start__, a, b)
+        assert await _turn(graph, "sync", "sync") == {"checkpoints": 4, "writes": 3}
+        assert await _turn(graph, "async", "async") == {"checkpoints": 4, "writes": 3}
+        assert await _turn(graph, "exit", "exit") == {"checkpoints": 1, "writes": 0}
+        assert graph.checkpointer.write_stats == {"checkpoints": 9, "writes": 6}
+
+    @pytest.mark.asyncio
+    async def test_concurrent_turns_do_not_share_counters(self, graph):
+        """Test: Dos turnos a la vez (sync y exit) cuentan cada uno solo sus propias escrituras."""
+        sync_turn, exit_turn = await asyncio.gather(
+            _turn(graph, "concurrente-1", "sync"),
+            _turn(graph, "concurrente-2", "exit"),
+        )
+
+        assert sync_turn == {"checkpoints": 4, "writes": 3}
+        assert exit_turn == {"checkpoints": 1, "writes": 0}
+
+    def test_turn_stats_average_per_mode(self, monkeypatch):
+        """Test: /health promedia latencia y escrituras por modo de durabilidad."""
+        monkeypatch.setattr(checkpointing, "_turn_stats", {})
+        record_turn("sync", 30.0, {"checkpoints": 4, "writes": 3})
+        record_turn("sync", 10.0, {"checkpoints": 4, "writes": 1})
+        record_turn("exit", 5.0, {"checkpoints": 1, "writes": 0})
+
+        assert turn_stats() == {
+            "sync": {"turns": 2, "avg_ms": 20.0, "avg_checkpoints": 4.0, "avg_writes": 2.0},
+            "exit": {"turns": 1, "avg_ms": 5.0, "avg_checkpoints": 1.0, "avg_writes": 0.0},
+        }
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,179 @@
+"""
+Tests para los forks copy-on-write del checkpointer (ForkAwareMongoDBSaver).
+Verifica la lectura del historial a través del padre, el aislamiento entre
+ramas y la limpieza de checkpoints al eliminar padres y forks (mongomock).
+"""
+from typing import Annotated, TypedDict
+
+import pytest
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langgraph.graph import END, StateGraph
+from langgraph.graph.message import add_messages
+
+from app.core.checkpointing import ForkAwareMongoDBSaver
+
+
+class EchoState(TypedDict):
+    messages: Annotated[list[BaseMessage], add_messages]
+
+
+def _echo(state: EchoState):
+    return {"messages": [AIMessage(content=f"eco: {state['messages'][-1].content}")]}
+
+
+@pytest.fixture
+def saver(mongo_client_mock):
+    return ForkAwareMongoDBSaver(mongo_client_mock, cache_watch=False)
+
+
+@pytest.fixture
+def graph(saver):
+    workflow = StateGraph(EchoState)
+    workflow.add_node("echo", _echo)
+    workflow.set_entry_point("echo")
+    workflow.add_edge("echo", END)
+    return workflow.compile(checkpointer=saver)
+
+
+def _config(thread_id, checkpoint_id=None):
+    configurable = {"thread_id": thread_id, "checkpoint_ns": ""}
+    if checkpoint_id:
+        configurable["checkpoint_id"] = checkpoint_id
+    return {"configurable": configurable}
+
+
+def _say(graph, thread_id, text):
+    graph.invoke({"messages": [HumanMessage(content=text)]}, _config(thread_id))
+
+
+def _contents(graph, thread_id):
+    return [msg.content for msg in graph.get_state(_config(thread_id)).values["messages"]]
+
+
+def _fork(saver, thread_id, parent_thread_id, checkpoint_id=None):
+    checkpoint_id = saver.resolve_checkpoint_id(parent_thread_id, checkpoint_id)
+    return saver.register_fork(thread_id, parent_thread_id, checkpoint_id)
+
+
+class TestForkReads:
+    """Tests para la resolución de lecturas por la cadena de padres."""
+
+    def test_fork_reads_parent_history(self, graph, saver):
+        """Test: Un fork recién creado ve el historial del padre y su historial completo como propio."""
+        _say(graph, "padre", "hola")
+        _say(graph, "padre", "segunda")
+        _fork(saver, "rama", "padre")
+
+        assert _contents(graph, "rama") == _contents(graph, "padre")
+        parent_history = list(graph.get_state_history(_config("padre")))
+        fork_history = list(graph.get_state_history(_config("rama")))
+        assert [s.config["configurable"]["checkpoint_id"] for s in fork_history] == [
+            s.config["configurable"]["checkpoint_id"] for s in parent_history
+        ]
+        assert {s.config["configurable"]["thread_id"] for s in fork_history} == {"rama"}
+        assert saver.checkpoint_collection.count_documents({"thread_id": "rama"}) == 0  # O(1): nada copiado
+
+    def test_branches_are_isolated(self, graph, saver):
+        """Test: Lo que el padre añade tras el fork no llega a la rama, y lo de la rama no llega al padre."""
+        _say(graph, "padre", "hola")
+        _fork(saver, "rama", "padre")
+
+        _say(graph, "padre", "solo padre")
+        _say(graph, "rama", "solo rama")
+
+        assert _contents(graph, "padre") == ["hola", "eco: hola", "solo padre", "eco: solo padre"]
+        assert _contents(graph, "rama") == ["hola", "eco: hola", "solo rama", "eco: solo rama"]
+        # El historial de la rama: sus checkpoints y, tras ellos, los del padre hasta el punto de fork
+        ids = lambda thread_id: [s.config["configurable"]["checkpoint_id"] for s in graph.get_state_history(_config(thread_id))]
+        own = [doc["checkpoint_id"] for doc in saver.checkpoint_collection.find({"thread_id": "rama"})]
+        fork_point = saver.get_fork("rama")["parent_checkpoint_id"]
+        assert ids("rama") == sorted(own, reverse=True) + [i for i in ids("padre") if i <= fork_point]
+
+    def test_fork_from_earlier_checkpoint(self, graph, saver):
+        """Test: Un fork desde un checkpoint anterior no ve lo posterior ni checkpoints ajenos al punto de fork."""
+        _say(graph, "padre", "hola")
+        first_turn = saver.resolve_checkpoint_id("padre")
+        _say(graph, "padre", "segunda")
+        _fork(saver, "rama", "padre", first_turn)
+
+        assert _contents(graph, "rama") == ["hola", "eco: hola"]
+        assert saver.resolve_checkpoint_id("rama", first_turn) == first_turn
+        assert saver.resolve_checkpoint_id("rama", saver.resolve_checkpoint_id("padre")) is None
+
+
+class TestForkRelease:
+    """Tests para ForkAwareMongoDBSaver.arelease_thread (borrado de sesiones con forks)."""
+
+    @staticmethod
+    def _sessions(*alive):
+        alive = set(alive)
+
+        async def has_session(thread_id):
+            return thread_id in alive
+
+        return alive, has_session
+
+    def _threads(self, saver):
+        return set(saver.checkpoint_collection.distinct("thread_id"))
+
+    @pytest.mark.asyncio
+    async def test_deleting_parent_keeps_checkpoints_for_forks(self, graph, saver):
+        """Test: Borrar un padre con forks conserva sus checkpoints; la rama sigue leyendo su historial."""
+        _say(graph, "padre", "hola")
+        _fork(saver, "rama", "padre")
+        alive, has_session = self._sessions("rama")
+
+        assert await saver.arelease_thread("padre", has_session) == []
+        assert _contents(graph, "rama") == ["hola", "eco: hola"]
+
+    @pytest.mark.asyncio
+    async def test_deleting_last_fork_collects_deleted_parent(self, graph, saver):
+        """Test: Al borrar el último fork de un padre ya eliminado se borran también los checkpoints del padre."""
+        _say(graph, "padre", "hola")
+        _fork(saver, "rama", "padre")
+        _fork(saver, "rama-2", "padre")
+        _say(graph, "rama", "más")
+        alive, has_session = self._sessions("rama", "rama-2")
+
+        await saver.arelease_thread("padre", has_session)
+        alive.discard("rama")
+        assert await saver.arelease_thread("rama", has_session) == ["rama"]
+        assert self._threads(saver) == {"padre"}  # rama-2 aún depende del padre
+
+        alive.discard("rama-2")
+        assert await saver.arelease_thread("rama-2", has_session) == ["rama-2", "padre"]
+        assert self._threads(saver) == set()
+        assert saver.writes_collection.count_documents({}) == 0
+        assert saver.forks_collection.count_documents({}) == 0
+
+    @pytest.mark.asyncio
+    async def test_deleting_fork_keeps_live_parent(self, graph, saver):
+        """Test: Borrar un fork no toca al padre si su sesión sigue existiendo."""
+        _say(graph, "padre", "hola")
+        _fork(saver, "rama", "padre")
+        _say(graph, "rama", "más")
+        alive, has_session = self._sessions("padre")
+
+        assert await saver.arelease_thread("rama", has_session) == ["rama"]
+        assert _contents(graph, "padre") == ["hola", "eco: hola"]
+        assert saver.get_fork("rama") is None
+
+    @pytest.mark.asyncio
+    async def test_retained_fork_keeps_its_own_parent_link(self, graph, saver):
+        """Test: Un fork intermedio borrado con hijos conserva su enlace al abuelo; al borrar el nieto se recoge la cadena."""
+        _say(graph, "abuelo", "hola")
+        _fork(saver, "padre", "abuelo")
+        _say(graph, "padre", "medio")
+        _fork(saver, "nieto", "padre")
+        alive, has_session = self._sessions("abuelo", "nieto")
+
+        assert await saver.arelease_thread("padre", has_session) == []
+        assert _contents(graph, "nieto") == ["hola", "eco: hola", "medio", "eco: medio"]
+
+        alive.discard("nieto")
+        assert await saver.arelease_thread("nieto", has_session) == ["nieto", "padre"]
+        assert self._threads(saver) == {"abuelo"}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,87 @@
+"""
+Tests para la compresión extractiva de pasajes.
+Verifica que se conservan las frases que responden a la query y se ahorran tokens.
+"""
+import pytest
+
+from app.core import compressor
+from app.core.compressor import GAP_MARKER, candidate_sentences, compress_passages, split_sentences
+from app.core.context_assembler import assemble_context
+
+FILLER = " ".join(f"El equipo revisó el apartado {i} del plan de comunicación interna." for i in range(12))
+ANSWER = "El margen bruto del trimestre fue del 42% gracias a la subida de precios."
+
+
+def passage(content, title="informe.pdf (chunk 1)", **extra):
+    return {"title": title, "content_markdown": content, **extra}
+
+
+class TestCompressor:
+    """Tests para app.core.compressor."""
+
+    def test_split_sentences_spans(self):
+        """Test: Las frases se separan por puntuación final y saltos de línea."""
+        text = "Primera frase. Segunda frase!\n- viñeta\n\nÚltima"
+        assert [text[a:b] for a, b in split_sentences(text)] == ["Primera frase.", "Segunda frase!", "- viñeta", "Última"]
+
+    def test_keeps_answer_with_context_window(self):
+        """Test: Se conserva la frase relevante y sus vecinas; el resto se sustituye por el marcador."""
+        text = f"{FILLER} Antes del dato. {ANSWER} Después del dato. {FILLER}"
+
+        [compressed] = compress_passages("¿cuál fue el margen bruto?", [passage(text)], ratio=0.1, window=1)
+        content = compressed["content_markdown"]
+
+        assert f"Antes del dato. {ANSWER} Después del dato." in content
+        assert GAP_MARKER.strip() in content
+        assert len(content) < len(text) / 3
+
+    def test_unrelated_and_short_passages_untouched(self):
+        """Test: Pasajes cortos o sin términos de la query se devuelven intactos."""
+        short = passage("Margen bruto 42%.")
+        unrelated = passage(FILLER)
+
+        result = compress_passages("margen bruto", [short, unrelated])
+
+        assert result[0] is short
+        assert result[1] is unrelated
+
+    def test_semantic_signal_finds_paraphrased_answer(self, monkeypatch):
+        """Test: Con la señal semántica activada, la frase que responde sin términos en común se elige por su embedding."""
+        monkeypatch.setattr(compressor, "RAG_COMPRESSION_SEMANTIC_WEIGHT", 0.5)
+        paraphrase = "La rentabilidad de las ventas mejoró tras revisar las tarifas."
+        doc = passage(f"{FILLER} {paraphrase} {FILLER}")
+        semantic = {sentence: 0.1 for sentence in candidate_sentences([doc])}
+        semantic[paraphrase] = 0.8
+
+        assert compress_passages("¿cuál fue el margen bruto?", [doc], ratio=0.1)[0] is doc
+        [compressed] = compress_passages("¿cuál fue el margen bruto?", [doc], ratio=0.1, semantic=semantic)
+
+        assert paraphrase in compressed["content_markdown"]
+        assert len(compressed["content_markdown"]) < len(doc["content_markdown"]) / 3
+
+    def test_candidate_sentences_skip_short_passages_and_repeats(self):
+        """Test: Solo se vectorizan frases de pasajes comprimibles, sin repetir y hasta el límite."""
+        short = passage("Margen bruto 42%.")
+        long = passage(f"{ANSWER} {FILLER} {ANSWER}")
+
+        sentences = candidate_sentences([short, long, long])
+
+        assert sentences[0] == ANSWER and sentences.count(ANSWER) == 1
+        assert "Margen bruto 42%." not in sentences
+        assert len(candidate_sentences([long], limit=3)) == 3
+
+    def test_assembler_reports_savings(self):
+        """Test: assemble_context con query comprime y contabiliza los tokens ahorrados."""
+        snippets = [passage(f"{FILLER} {ANSWER} {FILLER}", score=0.9)]
+
+        plain = assemble_context(snippets, budget=5000)
+        compressed = assemble_context(snippets, budget=5000, query="margen bruto del trimestre")
+
+        assert ANSWER in compressed.passages[0]["content_markdown"]
+        assert compressed.compressed == 1
+        assert compressed.saved > 0
+        assert compressed.tokens < plain.tokens
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
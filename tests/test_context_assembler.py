@@ -0,0 +1,69 @@
+"""
+Tests para el ensamblado del contexto RAG con presupuesto en tokens.
+Verifica la unión de chunks contiguos, el corte en frase y el presupuesto.
+"""
+import pytest
+
+from app.core.context_assembler import assemble_context, cut_at_sentence, merge_overlap
+from app.core.token_budget import count_tokens
+
+
+def snippet(file_id, index, content, score=None, **extra):
+    doc = {"title": f"{file_id}.pdf (chunk {index})", "content_markdown": content,
+           "source_file_id": file_id, "chunk_index": index, **extra}
+    if score is not None:
+        doc["score"] = score
+    return doc
+
+
+SENTENCES = " ".join(f"Frase número {i} sobre la arquitectura." for i in range(200))
+
+
+class TestContextAssembler:
+    """Tests para app.core.context_assembler."""
+
+    def test_merge_overlap_removes_repeated_text(self):
+        """Test: El solape de chunk_text no se repite al unir chunks consecutivos."""
+        first = "Primer párrafo completo.\nEl solape compartido entre ambos chunks"
+        second = "El solape compartido entre ambos chunks\nSegundo párrafo nuevo."
+
+        merged = merge_overlap(first, second)
+
+        assert merged.count("El solape compartido") == 1
+        assert merged.endswith("Segundo párrafo nuevo.")
+
+    def test_adjacent_chunks_become_one_passage(self):
+        """Test: Chunks contiguos del mismo archivo (también los plegados en 'adjacent') forman un pasaje."""
+        snippets = [
+            snippet("a", 3, "Texto tres compartido final", score=0.9,
+                    adjacent=[snippet("a", 4, "compartido final y texto cuatro")]),
+            snippet("b", 1, "Otro archivo.", score=0.5),
+        ]
+
+        plan = assemble_context(snippets, budget=500)
+
+        assert [p["title"] for p in plan.passages] == ["a.pdf (chunks 3-4)", "b.pdf (chunk 1)"]
+        assert plan.passages[0]["content_markdown"] == "Texto tres compartido final y texto cuatro"
+        assert plan.merged == 1
+
+    def test_sources_ordered_by_score(self):
+        """Test: Los pasajes salen ordenados por score, no por orden de llegada."""
+        plan = assemble_context([snippet("a", 1, "A.", score=0.2), snippet("b", 1, "B.", score=0.8)], budget=500)
+        assert [p["content_markdown"] for p in plan.passages] == ["B.", "A."]
+
+    def test_budget_respected_with_sentence_cut(self):
+        """Test: El contexto no supera el presupuesto y el corte cae en final de frase."""
+        plan = assemble_context([snippet("a", 1, SENTENCES, score=1.0), snippet("b", 1, SENTENCES, score=0.5)], budget=300)
+
+        assert 0 < plan.tokens <= 300
+        assert plan.truncated == 1
+        assert plan.passages[0]["content_markdown"].endswith(".")
+
+    def test_cut_at_sentence_keeps_short_text(self):
+        """Test: Un texto que ya cabe no se toca."""
+        assert cut_at_sentence("Corto.", 100) == "Corto."
+        assert count_tokens(cut_at_sentence(SENTENCES, 50)) <= 50
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
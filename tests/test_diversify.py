@@ -0,0 +1,70 @@
+"""
+Tests para la diversificación post-retrieval (colapso de contiguos + MMR).
+"""
+import pytest
+
+from app.core.diversify import collapse_adjacent, diversify, mmr_select, snippet_refs
+
+
+def chunk(file_id, index, embedding, title=None):
+    return {
+        "title": title or f"{file_id}#{index}",
+        "content_markdown": "...",
+        "source_file_id": file_id,
+        "chunk_index": index,
+        "embedding": embedding,
+    }
+
+
+class TestDiversify:
+    """Tests para app.core.diversify."""
+
+    def test_collapse_adjacent_keeps_best_of_each_run(self):
+        """Test: De una racha de chunks contiguos del mismo archivo queda el mejor situado con sus vecinos."""
+        candidates = [chunk("a", 5, [1, 0]), chunk("a", 6, [1, 0]), chunk("b", 6, [0, 1]),
+                      chunk("a", 7, [1, 0]), chunk("a", 9, [1, 0])]
+
+        collapsed = collapse_adjacent(candidates)
+
+        assert [d["title"] for d in collapsed] == ["a#5", "b#6", "a#9"]
+        assert [n["chunk_index"] for n in collapsed[0]["adjacent"]] == [6, 7]
+        assert "embedding" not in collapsed[0]["adjacent"][0]
+
+    def test_mmr_skips_near_duplicates(self):
+        """Test: Un casi-duplicado del primero cede su puesto a un candidato distinto."""
+        candidates = [
+            chunk("a", 1, [1.0, 0.0, 0.0]),
+            chunk("b", 1, [0.99, 0.05, 0.0]),
+            chunk("c", 1, [0.0, 1.0, 0.0]),
+        ]
+
+        assert [d["title"] for d in mmr_select(candidates, k=2)] == ["a#1", "c#1"]
+        assert [d["title"] for d in mmr_select(candidates, k=2, lambda_mult=1.0)] == ["a#1", "b#1"]
+
+    def test_diversify_strips_vectors(self):
+        """Test: Los snippets que llegan al estado no llevan embedding (sí su posición)."""
+        result = diversify([chunk("a", 1, [1.0, 0.0]), chunk("b", 1, [0.0, 1.0])], k=3)
+
+        assert len(result) == 2
+        assert all("embedding" not in doc and doc["chunk_index"] == 1 for doc in result)
+
+    def test_without_embeddings_keeps_order(self):
+        """Test: Candidatos sin vector (p.ej. backend sin with_vectors) mantienen el ranking."""
+        candidates = [{"title": str(i)} for i in range(5)]
+        assert mmr_select(candidates, k=2) == candidates[:2]
+
+    def test_snippet_refs_without_chunk_id_keep_text(self):
+        """Test: Sin chunk_id (búsqueda síncrona) el estado guarda el texto; con chunk_id, solo la referencia."""
+        docs = [
+            {"chunk_id": "c1", **chunk("a", 1, [1.0]), "score": 0.9},
+            {"title": "t", "content_markdown": "texto", "score": 0.5, "embedding": [1.0]},
+        ]
+
+        assert snippet_refs(docs) == [
+            {"chunk_id": "c1", "source_file_id": "a", "chunk_index": 1, "score": 0.9},
+            {"title": "t", "content_markdown": "texto", "score": 0.5},
+        ]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
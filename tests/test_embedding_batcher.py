@@ -0,0 +1,62 @@
+"""
+Tests para el micro-batching de embeddings de queries.
+Verifica que las peticiones concurrentes comparten una llamada por lote.
+"""
+import asyncio
+
+import pytest
+
+from app.core.embedding_batcher import EmbeddingBatcher
+
+
+class RecordingEmbedder:
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, texts):
+        self.batches.append(list(texts))
+        await asyncio.sleep(0)
+        return [[float(len(t))] for t in texts]
+
+
+class TestEmbeddingBatcher:
+    """Tests para app.core.embedding_batcher."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_call(self):
+        """Test: Las queries de la misma ventana salen en un único lote y cada una recibe su vector."""
+        embed = RecordingEmbedder()
+        batcher = EmbeddingBatcher(embed, window_ms=5, max_batch=64)
+
+        results = await asyncio.gather(*[batcher.submit(q) for q in ("a", "bb", "a", "ccc")])
+
+        assert results == [[1.0], [2.0], [1.0], [3.0]]
+        assert embed.batches == [["a", "bb", "ccc"]]
+        assert batcher.stats()["avg_batch_size"] == 4
+
+    @pytest.mark.asyncio
+    async def test_full_batch_flushes_before_window(self):
+        """Test: Al llegar a max_batch el lote sale sin esperar la ventana."""
+        embed = RecordingEmbedder()
+        batcher = EmbeddingBatcher(embed, window_ms=10_000, max_batch=2)
+
+        results = await asyncio.wait_for(asyncio.gather(batcher.submit("a"), batcher.submit("bb")), timeout=1)
+
+        assert results == [[1.0], [2.0]]
+        assert len(embed.batches) == 1
+
+    @pytest.mark.asyncio
+    async def test_batch_error_reaches_every_caller(self):
+        """Test: Si la llamada del lote falla, todos los llamantes reciben la excepción."""
+        async def broken(texts):
+            raise RuntimeError("rate limit")
+
+        batcher = EmbeddingBatcher(broken, window_ms=1)
+        results = await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert batcher.stats()["errors"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
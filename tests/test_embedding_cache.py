@@ -0,0 +1,82 @@
+"""
+Tests para la caché de embeddings de queries.
+Verifica aciertos L1, claves por modelo y coalescencia de peticiones en vuelo.
+"""
+import asyncio
+
+import pytest
+
+from app.core.embedding_cache import EmbeddingCache, cache_key
+
+
+class CountingEmbedder:
+    def __init__(self, delay: float = 0.0):
+        self.calls = 0
+        self.delay = delay
+
+    async def __call__(self, text: str):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return [float(len(text))]
+
+
+class TestEmbeddingCache:
+    """Tests para app.core.embedding_cache (solo L1, sin Mongo)."""
+
+    def test_key_normalizes_text_and_separates_models(self):
+        """Test: Mayúsculas/espacios comparten clave; otro modelo no."""
+        assert cache_key("m", "  Hola   mundo ") == cache_key("m", "hola mundo")
+        assert cache_key("m", "hola") != cache_key("otro", "hola")
+
+    @pytest.mark.asyncio
+    async def test_repeated_query_hits_l1(self):
+        """Test: La segunda vez la query no llama a la API."""
+        cache, embed = EmbeddingCache(size=10, persist=False), CountingEmbedder()
+
+        assert await cache.get_or_compute("m", "hola", embed) == [4.0]
+        assert await cache.get_or_compute("m", "Hola ", embed) == [4.0]
+
+        assert embed.calls == 1
+        assert cache.stats()["l1_hits"] == 1
+        assert cache.stats()["hit_rate"] == 0.5
+
+    @pytest.mark.asyncio
+    async def test_concurrent_queries_share_one_request(self):
+        """Test: Queries idénticas concurrentes esperan a una única llamada."""
+        cache, embed = EmbeddingCache(size=10, persist=False), CountingEmbedder(delay=0.02)
+
+        results = await asyncio.gather(*[cache.get_or_compute("m", "hola", embed) for _ in range(10)])
+
+        assert embed.calls == 1
+        assert all(r == [4.0] for r in results)
+        assert cache.stats()["coalesced"] == 9
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_does_not_cancel_shared_call(self):
+        """Test: Cancelar a un llamante no aborta la llamada compartida."""
+        cache, embed = EmbeddingCache(size=10, persist=False), CountingEmbedder(delay=0.02)
+
+        first = asyncio.create_task(cache.get_or_compute("m", "hola", embed))
+        second = asyncio.create_task(cache.get_or_compute("m", "hola", embed))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        assert await second == [4.0]
+        assert first.cancelled()
+        assert embed.calls == 1
+
+    @pytest.mark.asyncio
+    async def test_lru_evicts_oldest(self):
+        """Test: La L1 no supera su capacidad."""
+        cache, embed = EmbeddingCache(size=2, persist=False), CountingEmbedder()
+        for text in ("a", "bb", "ccc"):
+            await cache.get_or_compute("m", text, embed)
+
+        await cache.get_or_compute("m", "a", embed)
+
+        assert cache.stats()["size"] == 2
+        assert embed.calls == 4
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
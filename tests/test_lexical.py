@@ -0,0 +1,55 @@
+"""
+Tests para la recuperación léxica (BM25) y la fusión RRF del RAG híbrido.
+"""
+import pytest
+
+from app.core.lexical import BM25Index, reciprocal_rank_fusion, term_overlap, tokenize
+
+
+class TestLexical:
+    """Tests para app.core.lexical."""
+
+    def test_tokenize_keeps_exact_terms(self):
+        """Test: Tickers, versiones y cláusulas quedan como un solo token."""
+        assert tokenize("Cláusula 4.3 del contrato ISO-27001 para AAPL") == [
+            "clausula", "4.3", "contrato", "iso-27001", "aapl",
+        ]
+
+    def test_bm25_ranks_exact_term_first(self):
+        """Test: El documento con el término raro gana aunque otros compartan palabras comunes."""
+        index = BM25Index()
+        index.add("a", "resultados financieros del trimestre")
+        index.add("b", "resultados de AAPL en el trimestre")
+        index.add("c", "plan de marketing del trimestre")
+
+        assert index.search("AAPL trimestre", limit=3)[0][0] == "b"
+
+    def test_bm25_incremental_remove(self):
+        """Test: Dar de baja un documento lo saca de los resultados y de las estadísticas."""
+        index = BM25Index()
+        index.add("a", "contrato marco")
+        index.add("b", "contrato de servicios")
+
+        index.remove(["a"])
+
+        assert [doc_id for doc_id, _ in index.search("contrato marco", limit=5)] == ["b"]
+        assert len(index) == 1
+
+    def test_rrf_promotes_documents_in_both_rankings(self):
+        """Test: Un documento presente en ambos rankings supera a los que solo están en uno."""
+        vector = [{"title": "x", "content_markdown": "1"}, {"title": "y", "content_markdown": "2"}]
+        lexical = [{"title": "z", "content_markdown": "3"}, {"title": "y", "content_markdown": "2"}]
+
+        fused = reciprocal_rank_fusion([vector, lexical], limit=2)
+
+        assert fused[0]["title"] == "y"
+        assert len(fused) == 2
+
+    def test_term_overlap_ignores_stopwords(self):
+        """Test: El solape cuenta términos distintos de la query, sin palabras vacías ni tildes."""
+        assert term_overlap("¿Cuál es el margen bruto?", "margen BRUTO y neto") == pytest.approx(2 / 3)
+        assert term_overlap("de la", "cualquier texto") == 0.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
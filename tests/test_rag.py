@@ -0,0 +1,376 @@
+"""
+Tests para la ruta async del RAG.
+Verifica la búsqueda única [agente, 'all'] con boost, la caché negativa, la
+caché de resultados versionada y que los errores no rompen el turno.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import app.core.embedding_cache as embedding_cache
+import app.core.rag as rag
+import app.core.vector_store as vector_store
+from app.core.retrieval_cache import RetrievalCache, retrieval_key
+from tests.conftest import FakeCursor
+
+
+class FakeEmbeddings:
+    async def create(self, input, model):
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1, 0.2]) for _ in input])
+
+
+class FakeKnowledge:
+    """knowledge_base con documentos por agent_target (y archivos de contexto con su dueño)."""
+
+    def __init__(self, docs_by_target, file_owners=None):
+        self.docs_by_target = docs_by_target
+        self.file_owners = file_owners or {}
+        self.targets = []
+        self.counts = []
+
+    def aggregate(self, pipeline):
+        if "$match" in pipeline[0]:
+            files = pipeline[0]["$match"]["source_file_id"]["$in"]
+            return FakeCursor([{"_id": f, "agent_target": self.file_owners[f]} for f in files if f in self.file_owners])
+        if "$search" in pipeline[0]:
+            return FakeCursor([])  # sin coincidencias léxicas
+        target = pipeline[0]["$vectorSearch"]["filter"]["agent_target"]
+        self.targets.append(target)
+        if isinstance(target, dict):
+            docs = [
+                {**doc, "agent_target": t} for t in target["$in"] for doc in self.docs_by_target.get(t, [])
+            ]
+            return FakeCursor(sorted(docs, key=lambda d: d.get("score", 0), reverse=True))
+        return FakeCursor(self.docs_by_target.get(target, []))
+
+    async def count_documents(self, query):
+        self.counts.append(query["agent_target"])
+        return len(self.docs_by_target.get(query["agent_target"], []))
+
+
+class FakeStats:
+    """knowledge_stats vacía: cada agent_target se cuenta una vez en knowledge_base."""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+
+    async def find_one(self, query):
+        self.reads += 1
+        doc = self.docs.get(query["_id"])
+        return dict(doc) if doc else None
+
+    async def update_one(self, query, update, upsert=False):
+        upserted_id = None
+        if query["_id"] not in self.docs:
+            if not upsert:
+                return SimpleNamespace(upserted_id=None)
+            self.docs[query["_id"]] = dict(update.get("$setOnInsert", {}))
+            upserted_id = query["_id"]
+        doc = self.docs[query["_id"]]
+        doc.update(update.get("$set", {}))
+        for field, delta in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + delta
+        return SimpleNamespace(upserted_id=upserted_id)
+
+
+@pytest.fixture
+def fake_clients(monkeypatch):
+    kb = FakeKnowledge({
+        "CTO": [{"title": "arq", "content_markdown": "x"}],
+        "all": [{"title": "global", "score": 0.9}],
+        "agent-2": [{"title": "propio", "score": 0.7}],
+    }, file_owners={"f-propio": "agent-2"})
+    monkeypatch.setattr(rag, "get_async_openai", lambda: SimpleNamespace(embeddings=FakeEmbeddings()))
+    monkeypatch.setattr(vector_store, "get_knowledge_collection", lambda: kb)
+    monkeypatch.setattr(rag, "get_knowledge_collection", lambda: kb)
+    monkeypatch.setattr(vector_store, "_store", vector_store.AtlasVectorStore())
+    stats = FakeStats()
+    monkeypatch.setattr(vector_store, "get_knowledge_stats_collection", lambda: stats)
+    monkeypatch.setattr(rag, "knowledge_stats", vector_store.KnowledgeStats())
+    monkeypatch.setattr(rag, "retrieval_cache", RetrievalCache())
+    monkeypatch.setattr(rag, "_file_owners", {})
+    monkeypatch.setattr(embedding_cache, "embedding_cache", embedding_cache.EmbeddingCache(persist=False))
+    return kb
+
+
+class TestRetrieveSnippets:
+    """Tests para app.core.rag.retrieve_snippets."""
+
+    @pytest.mark.asyncio
+    async def test_role_filter(self, fake_clients):
+        """Test: La búsqueda filtra por el rol del experto."""
+        assert await rag.retrieve_snippets("arquitectura", "CTO") == [{"title": "arq", "content_markdown": "x"}]
+        assert fake_clients.targets == ["CTO"]
+
+    @pytest.mark.asyncio
+    async def test_custom_agent_without_docs_searches_all(self, fake_clients):
+        """Test: Un agente custom sin documentos busca solo en 'all' y se recuerda (caché negativa); una KB vacía no se consulta."""
+        assert await rag.retrieve_snippets("q", "agent-1", query_vector=[0.0, 1.0]) == [{"title": "global", "score": 0.9}]
+        await rag.retrieve_snippets("q", "agent-1", query_vector=[0.0, 1.0])
+        assert await rag.retrieve_snippets("q", "CFO") == []
+        assert fake_clients.targets == ["all"]  # repetida: caché de resultados; CFO sin KB: ni se busca
+        assert fake_clients.counts == ["agent-1", "all", "CFO"]
+
+    @pytest.mark.asyncio
+    async def test_custom_agent_single_search_with_boost(self, fake_clients):
+        """Test: Un agente con documentos hace una sola búsqueda $in y lo propio sube por el boost."""
+        results = await rag.retrieve_snippets("q", "agent-2", limit=2, query_vector=[0.0, 1.0])
+
+        assert fake_clients.targets == [{"$in": ["agent-2", "all"]}]
+        assert [r["title"] for r in results] == ["propio", "global"]
+
+    @pytest.mark.asyncio
+    async def test_context_files_search_their_owner_kb(self, fake_clients):
+        """Test: Con context_files se busca en la KB del dueño de los archivos, responda el miembro que responda."""
+        for member in ("CTO", "agent-1"):
+            await rag.retrieve_snippets("q", member, query_vector=[0.0, 1.0], file_ids=["f-propio"])
+
+        assert fake_clients.targets == ["agent-2", "agent-2"]
+        assert await rag.retrieve_snippets("q", "CTO", query_vector=[0.0, 1.0], file_ids=["borrado"]) == []
+
+    @pytest.mark.asyncio
+    async def test_repeated_question_is_cached_until_knowledge_changes(self, fake_clients):
+        """Test: Una pregunta repetida no vuelve a buscar; una ingesta (nueva versión) invalida la entrada."""
+        first = await rag.retrieve_snippets("arquitectura", "CTO", query_vector=[0.3, 0.4])
+        assert await rag.retrieve_snippets("Arquitectura ", "CTO", query_vector=[0.3, 0.4000001]) == first
+        assert fake_clients.targets == ["CTO"]
+
+        await rag.knowledge_stats.record("CTO", 1)
+        await rag.retrieve_snippets("arquitectura", "CTO", query_vector=[0.3, 0.4])
+        assert fake_clients.targets == ["CTO", "CTO"]
+        assert rag.retrieval_cache.stats()["hits"] == 1
+
+    @pytest.mark.asyncio
+    async def test_repeated_question_reads_no_stats(self, fake_clients):
+        """Test: Una repetición sale de la caché sin leer knowledge_stats; RAG_RESULT_CACHE_VERIFY la relee."""
+        stats = vector_store.get_knowledge_stats_collection()
+        await rag.retrieve_snippets("arquitectura", "CTO", query_vector=[0.3, 0.4])
+        reads = stats.reads
+
+        await rag.retrieve_snippets("arquitectura", "CTO", query_vector=[0.3, 0.4])
+        assert stats.reads == reads
+
+        rag.RAG_RESULT_CACHE_VERIFY, verify = True, rag.RAG_RESULT_CACHE_VERIFY
+        try:
+            await rag.retrieve_snippets("arquitectura", "CTO", query_vector=[0.3, 0.4])
+        finally:
+            rag.RAG_RESULT_CACHE_VERIFY = verify
+        assert stats.reads == reads + 1
+        assert fake_clients.targets == ["CTO"]
+
+    @pytest.mark.asyncio
+    async def test_errors_return_empty(self, monkeypatch, fake_clients):
+        """Test: Un fallo de OpenAI/Mongo devuelve un vacío distinguible de 'sin coincidencias' y no se cachea."""
+        class Broken:
+            async def create(self, input, model):
+                raise RuntimeError("timeout")
+
+        monkeypatch.setattr(rag, "get_async_openai", lambda: SimpleNamespace(embeddings=Broken()))
+        failed = await rag.retrieve_snippets("q", "CTO")
+        assert failed == [] and isinstance(failed, rag.RetrievalFailed)
+        assert rag.empty_context_message(failed) == rag.RETRIEVAL_FAILED_MESSAGE
+        assert await rag.retrieve_context("q", "CTO") == rag.RETRIEVAL_FAILED_MESSAGE
+
+        no_hits = await rag.retrieve_snippets("q", "CFO")  # KB vacía: sin coincidencias reales
+        assert not isinstance(no_hits, rag.RetrievalFailed)
+        assert rag.empty_context_message(no_hits) == rag.NO_CONTEXT_MESSAGE
+
+
+class TestLexicalFloor:
+    """Tests para el umbral de la rama BM25 del RAG híbrido."""
+
+    @pytest.mark.asyncio
+    async def test_lexical_only_hits_need_term_overlap(self, monkeypatch):
+        """Test: Un hit solo léxico con un término suelto no llega; uno con los términos de la query o presente en el vectorial sí."""
+        relevant = {"title": "margen", "content_markdown": "El margen bruto del trimestre subió al 42%."}
+        incidental = {"title": "ruido", "content_markdown": "El trimestre que viene cambiamos de oficina."}
+        shared = {"title": "ambos", "content_markdown": "Resumen del trimestre.", "score": 0.8}
+
+        class Store:
+            async def search(self, *args, **kwargs):
+                return [shared]
+
+            async def lexical_search(self, *args, **kwargs):
+                return [incidental, relevant, dict(shared, score=3.0)]
+
+        monkeypatch.setattr(rag, "get_vector_store", lambda: Store())
+        monkeypatch.setattr(rag, "RAG_HYBRID", True)
+        monkeypatch.setattr(rag, "RAG_MMR", False)
+
+        results = await rag._search("margen bruto del trimestre", [1.0, 0.0], "CFO", "CFO", 5, 10)
+
+        assert {doc["title"] for doc in results} == {"margen", "ambos"}
+
+
+class TestSentenceSimilarities:
+    """Tests para app.core.rag.sentence_similarities (señal semántica de la compresión)."""
+
+    @pytest.mark.asyncio
+    async def test_sentences_embedded_in_one_cached_batch(self, monkeypatch):
+        """Test: Las frases de un turno salen en una sola llamada a OpenAI y se reutilizan en el siguiente."""
+        from app.core import compressor
+        from app.core.compressor import candidate_sentences
+        from app.core.embedding_batcher import EmbeddingBatcher
+
+        monkeypatch.setattr(compressor, "RAG_COMPRESSION_SEMANTIC_WEIGHT", 0.5)
+
+        calls = []
+
+        async def embed_texts(texts):
+            calls.append(list(texts))
+            return [[1.0, 0.0] if "margen" in text else [0.0, 1.0] for text in texts]
+
+        monkeypatch.setattr(rag, "sentence_cache", embedding_cache.EmbeddingCache(persist=False))
+        monkeypatch.setattr(rag, "sentence_batcher", EmbeddingBatcher(embed_texts, window_ms=1, max_batch=128))
+        text = " ".join(f"Frase de relleno número {i} del informe." for i in range(20)) + " El margen fue del 42%."
+        passages = [{"title": "informe", "content_markdown": text}]
+
+        scores = await rag.sentence_similarities("margen", passages, query_vector=[1.0, 0.0])
+        again = await rag.sentence_similarities("margen", passages, query_vector=[1.0, 0.0])
+
+        assert len(calls) == 1 and len(calls[0]) == len(candidate_sentences(passages))
+        assert scores == again
+        assert scores["El margen fue del 42%."] == pytest.approx(1.0)
+        assert scores["Frase de relleno número 0 del informe."] == pytest.approx(0.0)
+
+    @pytest.mark.asyncio
+    async def test_embedding_failure_falls_back_to_lexical(self, monkeypatch):
+        """Test: Si OpenAI falla, no hay señal semántica (la compresión sigue siendo léxica)."""
+        from app.core import compressor
+        from app.core.embedding_batcher import EmbeddingBatcher
+
+        async def broken(texts):
+            raise RuntimeError("timeout")
+
+        monkeypatch.setattr(compressor, "RAG_COMPRESSION_SEMANTIC_WEIGHT", 0.5)
+        monkeypatch.setattr(rag, "sentence_cache", embedding_cache.EmbeddingCache(persist=False))
+        monkeypatch.setattr(rag, "sentence_batcher", EmbeddingBatcher(broken, window_ms=1))
+        passages = [{"title": "informe", "content_markdown": "Una frase larga del informe. " * 40}]
+
+        assert await rag.sentence_similarities("margen", passages, query_vector=[1.0, 0.0]) == {}
+
+    @pytest.mark.asyncio
+    async def test_disabled_by_default_without_network(self, monkeypatch):
+        """Test: Por defecto (peso 0) la compresión es solo léxica y no vectoriza frases."""
+        from app.core.embedding_batcher import EmbeddingBatcher
+
+        calls = []
+
+        async def embed_texts(texts):
+            calls.append(texts)
+            return [[1.0, 0.0] for _ in texts]
+
+        monkeypatch.setattr(rag, "sentence_batcher", EmbeddingBatcher(embed_texts, window_ms=1))
+        passages = [{"title": "informe", "content_markdown": "Una frase larga del informe. " * 40}]
+
+        assert rag.compressor.RAG_COMPRESSION_SEMANTIC_WEIGHT == 0
+        assert await rag.sentence_similarities("margen", passages, query_vector=[1.0, 0.0]) == {}
+        assert calls == []
+
+
+class TestKnowledgeStats:
+    """Tests para vector_store.KnowledgeStats (contadores en knowledge_stats)."""
+
+    @pytest.mark.asyncio
+    async def test_record_before_backfill_is_not_lost(self, fake_clients):
+        """Test: Una ingesta sin fila previa crea las estadísticas contando la KB; el backfill posterior no las pisa."""
+        stats = vector_store.get_knowledge_stats_collection()
+        fake_clients.docs_by_target["CTO"].append({"title": "nuevo", "content_markdown": "y"})
+
+        await rag.knowledge_stats.record("CTO", 1)
+        assert stats.docs["CTO"]["chunks"] == 2 and stats.docs["CTO"]["version"] == 1
+
+        await rag.knowledge_stats.record("CTO", 1)
+        assert await rag.knowledge_stats.snapshot("CTO", fresh=True) == (3, 2)
+        assert rag.knowledge_stats.stats()["backfills"] == 1
+
+    @pytest.mark.asyncio
+    async def test_backfill_keeps_live_counters(self, fake_clients):
+        """Test: Si otra ingesta crea la fila mientras se cuenta la KB, el backfill ($setOnInsert) no la sobrescribe."""
+        stats = vector_store.get_knowledge_stats_collection()
+        count_documents = fake_clients.count_documents
+
+        async def racing_count(query):
+            count = await count_documents(query)
+            await stats.update_one({"_id": "CTO"}, {"$inc": {"chunks": 5, "version": 1}}, upsert=True)
+            return count
+
+        fake_clients.count_documents = racing_count
+        assert await rag.knowledge_stats.snapshot("CTO") == (5, 1)
+        assert stats.docs["CTO"] == {"chunks": 5, "version": 1}
+
+
+    @pytest.mark.asyncio
+    async def test_watched_entries_do_not_expire(self, fake_clients):
+        """Test: Con el change stream abierto no hay TTL; un evento de otro worker descarta la entrada."""
+        stats = vector_store.get_knowledge_stats_collection()
+        knowledge = vector_store.KnowledgeStats(ttl=0)
+        knowledge.watching = True
+        await knowledge.snapshot("CTO")
+        reads = stats.reads
+
+        assert await knowledge.snapshot("CTO") == (1, 0)
+        assert stats.reads == reads
+
+        await stats.update_one({"_id": "CTO"}, {"$inc": {"chunks": 1, "version": 1}})
+        knowledge.invalidate("CTO")  # evento del change stream
+        assert await knowledge.snapshot("CTO") == (2, 1)
+
+    @pytest.mark.asyncio
+    async def test_invalidation_during_read_is_not_cached(self, fake_clients):
+        """Test: Una lectura en vuelo que cruza una invalidación no deja su versión en la caché."""
+        stats = vector_store.get_knowledge_stats_collection()
+        await stats.update_one({"_id": "CTO"}, {"$setOnInsert": {"chunks": 1, "version": 0}}, upsert=True)
+        knowledge = vector_store.KnowledgeStats(ttl=3600)
+        find_one = stats.find_one
+
+        async def racing_find_one(query):
+            doc = await find_one(query)
+            knowledge.invalidate("CTO")  # ingesta en otro worker mientras se leía
+            return doc
+
+        stats.find_one = racing_find_one
+        assert await knowledge.snapshot("CTO") == (1, 0)
+        assert "CTO" not in knowledge._known
+
+
+class TestRetrievalKey:
+    """Tests para la clave de app.core.retrieval_cache."""
+
+    def test_quantized_vector_and_versions(self):
+        """Test: El mismo vector con ruido de redondeo comparte clave; otra versión de la KB u otra pregunta no."""
+        key = retrieval_key(["CTO"], [3], [0.5, -0.25, 0.125], "q")
+        assert retrieval_key(["CTO"], [3], [0.5, -0.2500001, 0.125], "q") == key
+        assert retrieval_key(["CTO"], [4], [0.5, -0.25, 0.125], "q") != key
+        assert retrieval_key(["CTO"], [3], [0.5, 0.25, 0.125], "q") != key
+
+
+class TestAdaptiveSearchParams:
+    """Tests para el dimensionado de la búsqueda según knowledge_stats."""
+
+    def test_small_kb_is_exact_and_limit_never_exceeds_chunks(self):
+        """Test: Una KB pequeña usa búsqueda exacta y no pide más resultados que chunks tiene."""
+        assert rag.num_candidates_for(50, 4) is None
+        assert rag.adaptive_limit(2, 4) == 2
+        assert rag.adaptive_limit(0, 4) == 0
+
+    def test_large_kb_scales_candidates_and_limit(self):
+        """Test: Una KB grande pide más candidatos (sqrt del tamaño) y algún resultado más."""
+        medium = rag.num_candidates_for(rag.RAG_EXACT_MAX_CHUNKS + 1, 4)
+        large = rag.num_candidates_for(1_000_000, 4)
+        assert medium == 4 * rag.RAG_CANDIDATES_PER_RESULT
+        assert medium < large <= rag.ATLAS_MAX_CANDIDATES
+        assert 4 < rag.adaptive_limit(1_000_000, 4) <= rag.RAG_MAX_LIMIT
+
+    def test_pipeline_drops_low_scores_server_side(self):
+        """Test: El pipeline exacto no lleva numCandidates y filtra por score tras la proyección."""
+        pipeline = vector_store.atlas_search_pipeline([0.1, 0.2], "CTO", 3, None, min_score=0.6)
+
+        stage = pipeline[0]["$vectorSearch"]
+        assert stage["exact"] is True and "numCandidates" not in stage
+        assert pipeline[-1] == {"$match": {"score": {"$gte": 0.6}}}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
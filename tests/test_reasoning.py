@@ -0,0 +1,41 @@
+"""
+Tests para el soporte de modelos de razonamiento.
+Verifica que el razonamiento no llega al historial.
+"""
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.core.reasoning import is_reasoning_model, pop_reasoning, strip_reasoning
+
+
+class TestReasoning:
+    """Tests para app.core.reasoning."""
+
+    def test_reasoning_models(self):
+        """Test: Solo r1 se trata como modelo de razonamiento."""
+        assert is_reasoning_model("deepseek-r1")
+        assert not is_reasoning_model("deepseek-chat")
+        assert not is_reasoning_model(None)
+
+    def test_pop_reasoning_removes_it_from_message(self):
+        """Test: El razonamiento se extrae y no queda en el mensaje."""
+        msg = AIMessage(content="respuesta", additional_kwargs={"reasoning_content": "paso 1", "agent_role": "CTO"})
+
+        assert pop_reasoning(msg) == "paso 1"
+        assert msg.additional_kwargs == {"agent_role": "CTO"}
+        assert pop_reasoning(msg) == ""
+
+    def test_strip_reasoning_does_not_mutate_history(self):
+        """Test: El historial replayado va sin razonamiento y el original queda intacto."""
+        original = AIMessage(content="r", additional_kwargs={"reasoning_content": "largo " * 100})
+        history = [HumanMessage(content="p"), original]
+
+        cleaned = strip_reasoning(history)
+
+        assert "reasoning_content" not in cleaned[1].additional_kwargs
+        assert cleaned[1].content == "r"
+        assert "reasoning_content" in original.additional_kwargs
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
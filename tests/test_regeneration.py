@@ -0,0 +1,184 @@
+"""
+Tests para la regeneración de la última respuesta (prepare_regeneration).
+Verifica el rebobinado al checkpoint previo al experto, el fallback con
+RemoveMessage, que el estado guarda solo ids y scores del RAG y que la
+regeneración rehidrata el mismo contexto (vecinos incluidos), y que una
+recuperación fallida no se guarda como "sin contexto".
+"""
+import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+
+from tests.conftest import FakeCursor
+
+
+class FakeExpert(GenericFakeChatModel):
+    """LLM experto con respuestas numeradas; bind_tools no cambia nada."""
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+def _expert():
+    return FakeExpert(messages=iter(AIMessage(content=f"respuesta {i}") for i in range(100)))
+
+
+@pytest.fixture
+def stream(orchestrator):
+    import app.api.v1.stream as stream
+    return stream
+
+
+KB = {
+    "c0": {"_id": "c0", "title": "plan", "content_markdown": "plan de escalado"},
+    "c1": {"_id": "c1", "title": "plan", "content_markdown": "vecino " * 50},
+}
+
+
+class FakeKnowledge:
+    """knowledge_base para rehydrate_snippets: find por _id y cuenta lecturas."""
+
+    def __init__(self):
+        self.reads = 0
+
+    def find(self, query, projection=None):
+        self.reads += 1
+        return FakeCursor([dict(KB[i]) for i in query["_id"]["$in"] if i in KB])
+
+
+@pytest.fixture
+def graph(orchestrator, stream, monkeypatch):
+    """Grafo real con checkpointer en memoria, LLM falso, RAG contado y contextos ensamblados registrados."""
+    import app.core.rag as rag
+
+    app = orchestrator.workflow.compile(checkpointer=InMemorySaver())
+    searches, contexts = [], []
+    knowledge = FakeKnowledge()
+
+    async def fake_retrieve(session_id, query, rag_role, query_vector=None, file_ids=None):
+        searches.append(query)
+        neighbour = {"chunk_id": "c1", **KB["c1"], "source_file_id": "f", "chunk_index": 1, "score": 0.8}
+        neighbour.pop("_id")
+        return [{
+            "chunk_id": "c0", "title": "plan", "content_markdown": "plan de escalado", "score": 0.9,
+            "source_file_id": "f", "chunk_index": 0, "embedding": [0.1, 0.2], "adjacent": [neighbour],
+        }], "fresh"
+
+    assemble = orchestrator.assemble_context
+
+    def recording_assemble(snippets, **kwargs):
+        contexts.append(snippets)
+        return assemble(snippets, **kwargs)
+
+    monkeypatch.setattr(stream, "orchestrator_app", app)
+    monkeypatch.setattr(orchestrator, "llm_expert", _expert())
+    monkeypatch.setattr(orchestrator, "retrieve_for_session", fake_retrieve)
+    monkeypatch.setattr(orchestrator, "assemble_context", recording_assemble)
+    monkeypatch.setattr(orchestrator, "get_custom_agents_collection", lambda: None)  # solo roles core
+    monkeypatch.setattr(rag, "get_knowledge_collection", lambda: knowledge)
+    app.searches, app.contexts, app.knowledge = searches, contexts, knowledge
+    return app
+
+
+def _config(session_id):
+    return {"configurable": {"thread_id": session_id, "checkpoint_ns": ""}}
+
+
+async def _turn(app, session_id, query, durability="async"):
+    state = {"query": query, "messages": [HumanMessage(content=query)], "target_role": "CEO", "members": []}
+    await app.ainvoke(state, _config(session_id), durability=durability)
+
+
+async def _contents(app, session_id):
+    state = await app.aget_state(_config(session_id))
+    return [msg.content for msg in state.values["messages"]]
+
+
+class TestPrepareRegeneration:
+    """Tests para app.api.v1.stream.prepare_regeneration."""
+
+    @pytest.mark.asyncio
+    async def test_rewinds_to_checkpoint_before_expert(self, graph, stream):
+        """Test: Regenerar rebobina al checkpoint tras el router y reutiliza el RAG (1 sola llamada al LLM)."""
+        await _turn(graph, "regen-1", "hola")
+        await _turn(graph, "regen-1", "segunda")
+
+        resume_config, role = await stream.prepare_regeneration("regen-1")
+        assert role == "CEO"
+        assert resume_config["configurable"]["checkpoint_id"]
+
+        await graph.ainvoke(None, resume_config)
+        assert await _contents(graph, "regen-1") == ["hola", "respuesta 0", "segunda", "respuesta 2"]
+        assert graph.searches == ["hola", "segunda"]  # la regeneración no vuelve a buscar
+
+        # Mismo contexto que la respuesta original (vecinos incluidos), rehidratado de la KB
+        original, regenerated = graph.contexts[1], graph.contexts[2]
+        assert regenerated == [{k: v for k, v in original[0].items() if k != "embedding"}]
+        assert graph.knowledge.reads == 1
+
+    @pytest.mark.asyncio
+    async def test_fallback_removes_last_answer(self, graph, stream):
+        """Test: Sin checkpoint previo al experto (durability=exit) se retira la respuesta con RemoveMessage."""
+        await _turn(graph, "regen-2", "hola", durability="exit")
+        assert not [s async for s in graph.aget_state_history(_config("regen-2")) if s.next == ("expert_agent",)]
+
+        resume_config, role = await stream.prepare_regeneration("regen-2")
+        assert role == "CEO"
+
+        await graph.ainvoke(None, resume_config)
+        assert await _contents(graph, "regen-2") == ["hola", "respuesta 1"]
+        assert graph.searches == ["hola"]
+
+    @pytest.mark.asyncio
+    async def test_nothing_to_regenerate_without_ai_reply(self, graph, stream, orchestrator, monkeypatch):
+        """Test: Sin respuesta tras el último mensaje del usuario (turno fallido o thread vacío) no hay nada que regenerar."""
+        class BrokenExpert(FakeExpert):
+            async def ainvoke(self, *args, **kwargs):
+                raise RuntimeError("timeout")
+
+        monkeypatch.setattr(orchestrator, "llm_expert", BrokenExpert(messages=iter([])))
+        with pytest.raises(RuntimeError):
+            await _turn(graph, "regen-3", "hola", durability="sync")
+
+        assert await _contents(graph, "regen-3") == ["hola"]
+        assert await stream.prepare_regeneration("regen-3") is None
+        assert await stream.prepare_regeneration("regen-vacio") is None
+
+    @pytest.mark.asyncio
+    async def test_failed_retrieval_is_not_stored(self, graph, orchestrator, monkeypatch):
+        """Test: Si el RAG falla el prompt avisa del fallo y el estado no guarda un 'sin contexto' reutilizable."""
+        import app.core.rag as rag
+
+        async def failed_retrieve(session_id, query, rag_role, query_vector=None, file_ids=None):
+            return rag.RetrievalFailed(), "fresh"
+
+        prompts = []
+
+        class RecordingExpert(FakeExpert):
+            async def ainvoke(self, messages, *args, **kwargs):
+                prompts.append(messages[0].content)
+                return AIMessage(content="sin contexto")
+
+        monkeypatch.setattr(orchestrator, "retrieve_for_session", failed_retrieve)
+        monkeypatch.setattr(orchestrator, "llm_expert", RecordingExpert(messages=iter([])))
+        await _turn(graph, "regen-5", "hola")
+
+        assert rag.RETRIEVAL_FAILED_MESSAGE in prompts[0] and rag.NO_CONTEXT_MESSAGE not in prompts[0]
+        state = await graph.aget_state(_config("regen-5"))
+        assert state.values["rag_refs"] is None
+
+    @pytest.mark.asyncio
+    async def test_state_stores_snippet_refs(self, graph):
+        """Test: El estado guarda ids, scores y posición de los snippets y sus vecinos, sin texto ni embeddings."""
+        await _turn(graph, "regen-4", "hola")
+
+        state = await graph.aget_state(_config("regen-4"))
+        assert state.values["rag_refs"] == [{
+            "chunk_id": "c0", "score": 0.9, "source_file_id": "f", "chunk_index": 0,
+            "adjacent": [{"chunk_id": "c1", "source_file_id": "f", "chunk_index": 1, "score": 0.8}],
+        }]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,128 @@
+"""
+Tests para la memoria de recuperación por sesión.
+Verifica la detección de repreguntas y los modos reuse / top_up / fresh.
+"""
+import pytest
+
+import app.core.rag as rag
+import app.core.session_retrieval as session_retrieval
+import app.core.vector_store as vector_store
+from app.core.session_retrieval import SessionRetrievalMemory, is_follow_up, retrieve_for_session
+
+
+@pytest.fixture
+def fake_search(monkeypatch):
+    """retrieve_snippets que registra cada búsqueda."""
+    calls = []
+
+    async def retrieve_snippets(query, role, limit=3, query_vector=None, file_ids=None, resolved=None):
+        calls.append((query, limit))
+        return [{"title": f"{query} #{i}", "content_markdown": query} for i in range(limit)]
+
+    monkeypatch.setattr(rag, "retrieve_snippets", retrieve_snippets)
+    monkeypatch.setattr(session_retrieval, "session_memory", SessionRetrievalMemory())
+    return calls
+
+
+@pytest.fixture
+def fake_rag(fake_search, monkeypatch):
+    """Búsqueda registrada y KB en versión configurable."""
+    versions = {"CFO": (1,)}
+
+    async def resolve_targets(role, fresh=None, file_ids=None):
+        return role, 3, versions[role]
+
+    monkeypatch.setattr(rag, "resolve_targets", resolve_targets)
+    return fake_search, versions
+
+
+class TestFollowUpDetection:
+    """Tests para app.core.session_retrieval.is_follow_up."""
+
+    def test_short_connector_or_anaphora(self):
+        """Test: Repreguntas cortas con conector o anáfora sí; preguntas completas no."""
+        assert is_follow_up("¿Y en euros?")
+        assert is_follow_up("Explícalo más simple")
+        assert is_follow_up("¿eso cuánto cuesta?")
+        assert not is_follow_up("¿Cuál es el runway de la empresa con el burn actual?")
+        assert not is_follow_up("Y además quiero que me prepares un plan completo de marketing digital para 2025")
+
+
+class TestRetrieveForSession:
+    """Tests para app.core.session_retrieval.retrieve_for_session."""
+
+    @pytest.mark.asyncio
+    async def test_similar_query_reuses_previous_snippets(self, fake_rag):
+        """Test: Una query casi igual a la anterior reutiliza los snippets sin buscar."""
+        calls, _ = fake_rag
+        first, mode = await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0])
+        assert mode == "fresh"
+
+        again, mode = await retrieve_for_session("s1", "el runway actual", "CFO", [0.99, 0.05])
+
+        assert mode == "reuse" and again == first
+        assert len(calls) == 1
+        assert session_retrieval.session_memory.stats()["reuse"] == 1
+
+    @pytest.mark.asyncio
+    async def test_follow_up_tops_up_with_combined_query(self, fake_rag):
+        """Test: Una repregunta conserva el contexto y añade unos pocos snippets del tema combinado."""
+        calls, _ = fake_rag
+        first, _ = await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0])
+
+        snippets, mode = await retrieve_for_session("s1", "¿y en euros?", "CFO", [0.0, 1.0])
+
+        assert mode == "top_up"
+        assert calls[-1] == ("runway actual ¿y en euros?", session_retrieval.RAG_FOLLOWUP_TOPUP)
+        assert snippets[:len(first)] == first and len(snippets) > len(first)
+
+    @pytest.mark.asyncio
+    async def test_unrelated_query_or_new_kb_version_searches_again(self, fake_rag):
+        """Test: Otro tema, otra sesión o una KB que cambió hacen una búsqueda completa."""
+        calls, versions = fake_rag
+        await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0])
+
+        assert (await retrieve_for_session("s1", "plan de contratación para ventas", "CFO", [0.0, 1.0]))[1] == "fresh"
+        assert (await retrieve_for_session("s2", "plan de contratación para ventas", "CFO", [0.0, 1.0]))[1] == "fresh"
+        versions["CFO"] = (2,)
+        assert (await retrieve_for_session("s1", "plan de contratación para ventas", "CFO", [0.0, 1.0]))[1] == "fresh"
+        assert len(calls) == 4
+
+    @pytest.mark.asyncio
+    async def test_version_change_in_other_worker_is_not_reused(self, fake_search, monkeypatch):
+        """Test: knowledge_stats se lee una vez por turno; una ingesta en otro worker (change stream) invalida la reutilización."""
+        class Stats:
+            def __init__(self):
+                self.docs = {"CFO": {"chunks": 3, "version": 1}}
+                self.reads = 0
+
+            async def find_one(self, query):
+                self.reads += 1
+                return dict(self.docs[query["_id"]])
+
+        stats = Stats()
+        knowledge = vector_store.KnowledgeStats(ttl=3600)
+        monkeypatch.setattr(vector_store, "get_knowledge_stats_collection", lambda: stats)
+        monkeypatch.setattr(rag, "knowledge_stats", knowledge)
+        await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0])
+        assert stats.reads == 1
+
+        stats.docs["CFO"]["version"] = 2  # ingesta desde otro worker
+        knowledge.invalidate("CFO")       # evento del change stream de knowledge_stats
+        assert (await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0]))[1] == "fresh"
+        assert (await retrieve_for_session("s1", "runway actual", "CFO", [1.0, 0.0]))[1] == "reuse"
+        assert stats.reads == 2 and len(fake_search) == 2
+
+    @pytest.mark.asyncio
+    async def test_changing_context_files_searches_again(self, fake_rag):
+        """Test: Añadir o quitar archivos de contexto de la sesión invalida la recuperación guardada."""
+        calls, _ = fake_rag
+        await retrieve_for_session("s1", "cláusula de penalización", "CFO", [1.0, 0.0], file_ids=["contrato"])
+
+        _, mode = await retrieve_for_session("s1", "cláusula de penalización", "CFO", [1.0, 0.0])
+
+        assert mode == "fresh" and len(calls) == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
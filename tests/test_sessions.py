@@ -132,6 +132,36 @@ class TestSessionsEndpoint:
         
         assert response.status_code == 404, f"Error detallado: {response.text}"
 
+    @pytest.mark.asyncio
+    async def test_attach_unknown_context_file(self, async_client):
+        """Test: Adjuntar un archivo inexistente al contexto devuelve 404 y no toca la sesión."""
+        create_response = await async_client.post("/api/v1/sessions/", json={"title": "Contexto"})
+        session_id = create_response.json()["session_id"]
+
+        response = await async_client.post(
+            f"/api/v1/sessions/{session_id}/context-files", json={"file_id": "no-es-un-objectid"}
+        )
+        assert response.status_code == 404
+
+        # Retirar es idempotente: la lista sigue vacía
+        response = await async_client.delete(f"/api/v1/sessions/{session_id}/context-files/otro")
+        assert response.status_code == 200
+        assert response.json() == []
+        await async_client.delete(f"/api/v1/sessions/{session_id}")
+
+    @pytest.mark.asyncio
+    async def test_regenerate_without_answer(self, async_client):
+        """Test: Regenerar en una sesión sin respuestas devuelve 409; en una inexistente, 404."""
+        create_response = await async_client.post("/api/v1/sessions/", json={"title": "Regenerar"})
+        session_id = create_response.json()["session_id"]
+
+        response = await async_client.post(f"/api/v1/sessions/{session_id}/regenerate")
+        assert response.status_code == 409, f"Error detallado: {response.text}"
+
+        response = await async_client.post("/api/v1/sessions/nonexistent-session-12345/regenerate")
+        assert response.status_code == 404
+        await async_client.delete(f"/api/v1/sessions/{session_id}")
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "-s"])
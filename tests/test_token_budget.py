@@ -0,0 +1,132 @@
+"""
+Tests para la contabilidad de tokens pre-vuelo.
+Verifica la medición por sección y el orden de recorte.
+"""
+import pytest
+from langchain_core.messages import HumanMessage, AIMessage
+
+import app.core.token_budget as token_budget
+from app.core.token_budget import fit_prompt, count_tokens, get_prompt_budget
+
+
+def _render(doc: dict) -> str:
+    return f"---\nFUENTE: {doc['title']}\nCONTENIDO: {doc['content_markdown']}\n\n"
+
+
+def _history(turns: int):
+    messages = []
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"pregunta {i} " + "palabra " * 50))
+        messages.append(AIMessage(content=f"respuesta {i} " + "palabra " * 50))
+    return messages
+
+
+SNIPPETS = [
+    {"title": f"doc {i}", "content_markdown": "contenido relevante " * 100}
+    for i in range(3)
+]
+
+
+class TestTokenBudget:
+    """Tests para app.core.token_budget."""
+
+    def test_no_trim_when_within_budget(self):
+        """Test: Sin recortes cuando el prompt cabe en el presupuesto."""
+        plan = fit_prompt(
+            model="deepseek-chat",
+            system_prompt="Eres el CEO.",
+            history=_history(2),
+            snippets=SNIPPETS,
+            tools=[],
+            query="¿Qué hacemos?",
+            render_snippet=_render,
+        )
+
+        assert plan.trimmed == {"history": 0, "context": 0, "tools": 0}
+        assert len(plan.history) == 4
+        assert len(plan.snippets) == 3
+        assert set(plan.sections) == {"system", "history", "context", "tools", "query"}
+        assert plan.total == sum(plan.sections.values())
+
+    def test_trims_oldest_history_first(self):
+        """Test: El historial antiguo se recorta antes que el contexto RAG."""
+        full = fit_prompt("deepseek-chat", "Eres el CEO.", _history(10), SNIPPETS, [], "hola", _render)
+        budget = full.total - full.sections["history"] // 2
+
+        plan = fit_prompt("deepseek-chat", "Eres el CEO.", _history(10), SNIPPETS, [], "hola", _render, budget=budget)
+
+        assert plan.trimmed["history"] > 0
+        assert plan.trimmed["context"] == 0
+        assert plan.total <= budget
+        # El historial restante es el más reciente y empieza por un HumanMessage
+        assert isinstance(plan.history[0], HumanMessage)
+        assert plan.history[-1].content.startswith("respuesta 9")
+
+    def test_trims_lowest_ranked_snippets_after_history(self):
+        """Test: Sin historial que recortar, se descartan los snippets peores."""
+        full = fit_prompt("deepseek-chat", "Eres el CEO.", _history(1), SNIPPETS, [], "hola", _render)
+        budget = full.total - full.sections["history"] - 10
+
+        plan = fit_prompt("deepseek-chat", "Eres el CEO.", _history(1), SNIPPETS, [], "hola", _render, budget=budget)
+
+        assert plan.history == []
+        assert plan.trimmed["context"] >= 1
+        assert plan.snippets == SNIPPETS[:len(plan.snippets)]
+
+    def test_budget_reserves_output_tokens(self):
+        """Test: El presupuesto deja margen para la respuesta."""
+        assert get_prompt_budget("gpt-4o") < 128_000
+        assert get_prompt_budget("modelo-desconocido") > 0
+
+    def test_reasoning_models_reserve_more_output(self):
+        """Test: Los modelos de razonamiento reservan salida para el razonamiento y la pasan como max_tokens."""
+        from app.core.reasoning import build_reasoning_llm
+
+        reserve = token_budget.get_output_reserve("deepseek-r1")
+        assert reserve == token_budget.REASONING_OUTPUT_TOKENS > token_budget.get_output_reserve("deepseek-chat")
+        assert get_prompt_budget("deepseek-r1") == token_budget.MODEL_CONTEXT_WINDOWS["deepseek-r1"] - reserve
+        assert get_prompt_budget("deepseek-r1") < get_prompt_budget("deepseek-chat")
+        assert build_reasoning_llm("deepseek-r1", "test", "https://api.deepseek.com").max_tokens == reserve
+
+    def test_count_tokens_per_model_encoding(self):
+        """Test: El conteo usa el encoding de cada modelo."""
+        text = "Arquitectura de microservicios escalable"
+        assert count_tokens(text, "deepseek-chat") > 0
+        assert count_tokens(text, "gpt-4o") > 0
+        assert count_tokens("", "gpt-4o") == 0
+
+    def test_encoding_unavailable_falls_back_to_estimate(self, monkeypatch):
+        """Test: Si tiktoken no puede cargar el encoding (sin red), se estima en lugar de fallar."""
+        import tiktoken
+
+        def offline(name):
+            raise ConnectionError("sin red")
+
+        monkeypatch.setattr(tiktoken, "get_encoding", offline)
+        token_budget.get_encoding.cache_clear()
+        try:
+            assert count_tokens("a" * 40, "modelo-offline") == 10
+            encoding = token_budget.get_encoding("modelo-offline")
+            assert encoding.decode(encoding.encode("texto de prueba")) == "texto de prueba"
+        finally:
+            token_budget.get_encoding.cache_clear()
+
+    def test_empty_context_counts_placeholder(self):
+        """Test: Sin snippets, el bloque CONTEXTO cuenta el mensaje que lo sustituye en el prompt."""
+        placeholder = "No encontré información específica en mi base de conocimientos sobre este tema."
+        plan = fit_prompt("deepseek-chat", "Eres el CEO.", [], [], [], "hola", _render, empty_context=placeholder)
+
+        assert plan.sections["context"] == count_tokens(placeholder, "deepseek-chat")
+
+        # Si se recortan todos los snippets, el placeholder entra en el presupuesto
+        full = fit_prompt("deepseek-chat", "Eres el CEO.", [], SNIPPETS, [], "hola", _render, empty_context=placeholder)
+        budget = full.total - full.sections["context"]
+        plan = fit_prompt(
+            "deepseek-chat", "Eres el CEO.", [], SNIPPETS, [], "hola", _render, budget=budget, empty_context=placeholder
+        )
+        assert plan.snippets == []
+        assert plan.over_budget
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
@@ -0,0 +1,84 @@
+"""
+Tests para el prefetch de I/O de un turno.
+Verifica la cancelación estructurada y el registro de tiempos por etapa.
+"""
+import asyncio
+
+import pytest
+
+from app.core.turn_context import TurnContext, get_turn_context
+
+
+class TestTurnContext:
+    """Tests para app.core.turn_context."""
+
+    @pytest.mark.asyncio
+    async def test_get_returns_prefetched_result_and_timing(self):
+        """Test: get() devuelve el resultado y la etapa queda cronometrada."""
+        async with TurnContext("hola") as ctx:
+            ctx.start("embedding", asyncio.sleep(0.01, result=[1.0]))
+            assert ctx.has("embedding")
+            assert await ctx.get("embedding") == [1.0]
+
+        assert "embedding" in ctx.timings
+        assert "prefetch solapado" in ctx.summary()
+
+    @pytest.mark.asyncio
+    async def test_exit_cancels_pending_tasks(self):
+        """Test: Al salir del turno (p.ej. desconexión) se cancelan las tareas pendientes."""
+        async with TurnContext("hola") as ctx:
+            ctx.start("snippets", asyncio.sleep(10))
+            task = ctx._tasks["snippets"]
+
+        assert task.cancelled()
+
+    @pytest.mark.asyncio
+    async def test_get_propagates_prefetch_errors(self):
+        """Test: Un prefetch fallido propaga su excepción para que el nodo haga fallback."""
+        async def boom():
+            raise RuntimeError("mongo caído")
+
+        async with TurnContext("hola") as ctx:
+            ctx.start("agent", boom())
+            with pytest.raises(RuntimeError):
+                await ctx.get("agent")
+            with pytest.raises(KeyError):
+                await ctx.get("embedding")
+
+    @pytest.mark.asyncio
+    async def test_background_wait_not_counted(self):
+        """Test: Una etapa que espera a otra en background no suma al tiempo bloqueado."""
+        async with TurnContext("hola") as ctx:
+            ctx.start("embedding", asyncio.sleep(0.01, result=[1.0]))
+            await ctx.get("embedding", count_wait=False)
+
+        assert ctx._waited_ms == 0.0
+
+    @pytest.mark.asyncio
+    async def test_prefetch_prepares_core_tools(self, orchestrator, monkeypatch):
+        """Test: Con un rol core el prefetch deja las tools medidas y bindeadas."""
+        import app.core.rag as rag
+        from app.tools.registry import get_tools_for_role
+        from app.core.turn_context import prefetch_turn
+
+        async def fake_embed(query):
+            return [0.0]
+        monkeypatch.setattr(rag, "embed_query", fake_embed)
+
+        async with TurnContext("hola", target_role="CTO") as ctx:
+            prefetch_turn(ctx)
+            tools, llm = await ctx.get("tools")
+
+        assert [t.name for t in tools] == [t.name for t in get_tools_for_role("CTO")]
+        assert llm is not orchestrator.llm_expert or not tools
+
+    def test_get_turn_context_from_config(self):
+        """Test: Sin TurnContext en la config los nodos reciben None."""
+        ctx = TurnContext("hola")
+        assert get_turn_context({"configurable": {"turn_context": ctx}}) is ctx
+        assert get_turn_context({}) is None
+        assert get_turn_context(None) is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
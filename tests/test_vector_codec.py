@@ -0,0 +1,56 @@
+"""
+Tests para la codificación de embeddings (BSON binary vector).
+Verifica el formato del subtipo 9, la cuantización int8 y el formato legado.
+"""
+import bson
+import numpy as np
+import pytest
+from bson.binary import Binary, BinaryVectorDtype
+
+from app.core.vector_codec import decode_vector, decode_vectors, encode_vector, storage_bytes
+
+
+class TestVectorCodec:
+    """Tests para app.core.vector_codec."""
+
+    def test_float32_matches_bson_spec(self):
+        """Test: El float32 empaquetado es el binary vector estándar (lo lee Binary.as_vector)."""
+        vector = [0.25, -1.5, 3.0]
+
+        encoded = encode_vector(vector, "float32")
+
+        assert encoded == Binary.from_vector(vector, BinaryVectorDtype.FLOAT32)
+        assert decode_vector(encoded).tolist() == vector
+
+    def test_int8_preserves_cosine(self):
+        """Test: La cuantización int8 mantiene el coseno y ocupa 1 byte por componente."""
+        rng = np.random.default_rng(0)
+        a, b = rng.normal(size=1536), rng.normal(size=1536)
+        b = a + 0.5 * b
+
+        qa, qb = decode_vector(encode_vector(a, "int8")), decode_vector(encode_vector(b, "int8"))
+
+        cosine = a @ b / np.linalg.norm(a) / np.linalg.norm(b)
+        assert qa @ qb / np.linalg.norm(qa) / np.linalg.norm(qb) == pytest.approx(cosine, abs=1e-3)
+        assert len(encode_vector(a, "int8")) == 1536 + 2
+
+    def test_legacy_arrays_and_mixed_batches(self):
+        """Test: Los arrays de doubles legados se leen igual, también mezclados con binarios."""
+        matrix = decode_vectors([[1.0, 0.0], encode_vector([0.0, 2.0], "float32")])
+        assert matrix.dtype == np.float32
+        assert matrix.tolist() == [[1.0, 0.0], [0.0, 2.0]]
+        assert encode_vector([1, 2], "array") == [1.0, 2.0]
+
+    def test_binary_storage_is_several_fold_smaller(self):
+        """Test: El binary vector float32 ocupa menos de un tercio que el array BSON de doubles."""
+        vector = np.random.default_rng(1).normal(size=1536).tolist()
+
+        legacy = storage_bytes([vector])
+        packed = storage_bytes([encode_vector(vector, "float32")])
+
+        assert packed * 3 < legacy
+        assert len(bson.encode({"v": encode_vector(vector, "int8")})) * 12 < legacy
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])
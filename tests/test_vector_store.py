@@ -0,0 +1,258 @@
+"""
+Tests para el vector store local (NumPy).
+Verifica el orden por similitud, los snapshots, la sincronización con la KB
+y la búsqueda en dos etapas (vector corto + reordenado a dimensión completa).
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+import app.core.vector_store as vector_store
+from app.core.vector_codec import decode_vector, encode_vector
+from app.core.vector_store import LocalVectorStore
+from tests.conftest import FakeCursor
+
+
+class FakeKnowledge:
+    """knowledge_base mínima: find por agent_target."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.finds = 0
+
+    def find(self, query, projection=None):
+        self.finds += 1
+        return FakeCursor([d for d in self.docs if d["agent_target"] == query["agent_target"]])
+
+
+def kb_doc(target, title, embedding, file_id="f1"):
+    return {"_id": ObjectId(), "agent_target": target, "title": title, "content_markdown": title,
+            "embedding": embedding, "source_file_id": file_id}
+
+
+@pytest.fixture
+def kb(monkeypatch):
+    # Formatos mezclados: arrays legados y binary vectors
+    docs = [
+        kb_doc("CTO", "kubernetes", [1.0, 0.0, 0.0]),
+        kb_doc("CTO", "bases de datos", encode_vector([0.7, 0.7, 0.0])),
+        kb_doc("CTO", "marketing", [0.0, 0.0, 1.0], file_id="f2"),
+        kb_doc("CFO", "caja", [1.0, 0.0, 0.0]),
+    ]
+    fake = FakeKnowledge(docs)
+    monkeypatch.setattr(vector_store, "get_knowledge_collection", lambda: fake)
+    return fake
+
+
+class TestLocalVectorStore:
+    """Tests para app.core.vector_store.LocalVectorStore."""
+
+    @pytest.mark.asyncio
+    async def test_exact_search_orders_by_cosine_and_filters_target(self, kb, tmp_path):
+        """Test: Mejor primero, solo documentos del agent_target pedido."""
+        store = LocalVectorStore(directory=str(tmp_path))
+
+        results = await store.search([2.0, 0.1, 0.0], "CTO", limit=2)
+
+        assert [r["title"] for r in results] == ["kubernetes", "bases de datos"]
+        assert results[0]["score"] > results[1]["score"]
+        assert await store.search([1.0, 0.0, 0.0], "CMO", limit=3) == []
+
+    @pytest.mark.asyncio
+    async def test_multi_target_search_merges_partitions(self, kb, tmp_path):
+        """Test: Una búsqueda sobre varios agent_target mezcla sus particiones por score y marca el origen."""
+        store = LocalVectorStore(directory=str(tmp_path))
+
+        results = await store.search([1.0, 0.1, 0.0], ["CFO", "CTO"], limit=3)
+
+        titles = [r["title"] for r in results]
+        assert set(titles[:2]) == {"caja", "kubernetes"}  # mismo vector, empatan
+        assert titles[2] == "bases de datos"
+        assert {r["agent_target"] for r in results} == {"CFO", "CTO"}
+
+    @pytest.mark.asyncio
+    async def test_file_scoped_search_only_sees_those_files(self, kb, tmp_path):
+        """Test: Con file_ids (context_files de la sesión) solo compiten los chunks de esos archivos."""
+        store = LocalVectorStore(directory=str(tmp_path))
+
+        results = await store.search([1.0, 0.0, 0.0], "CTO", limit=3, file_ids=["f2"])
+        lexical = await store.lexical_search("kubernetes marketing", "CTO", limit=3, file_ids=["f2"])
+
+        assert [r["title"] for r in results] == ["marketing"]
+        assert [r["title"] for r in lexical] == ["marketing"]
+        assert await store.search([1.0, 0.0, 0.0], "CTO", limit=3, file_ids=["otro"]) == []
+
+    def test_atlas_pipeline_prefilters_by_file(self):
+        """Test: source_file_id entra en el filter de $vectorSearch y es campo filter del índice."""
+        pipeline = vector_store.atlas_search_pipeline([0.1, 0.2], "CTO", 3, None, file_ids=["f1"])
+
+        assert pipeline[0]["$vectorSearch"]["filter"] == {"agent_target": "CTO", "source_file_id": {"$in": ["f1"]}}
+        fields = vector_store.atlas_vector_indexes(short_dims=0)[vector_store.ATLAS_INDEX_NAME]["fields"]
+        assert {"type": "filter", "path": "source_file_id"} in fields
+
+    @pytest.mark.asyncio
+    async def test_snapshot_is_reused_by_a_new_process(self, kb, tmp_path):
+        """Test: Un segundo store (otro worker/reinicio) lee el snapshot sin ir a Mongo."""
+        await LocalVectorStore(directory=str(tmp_path)).search([1.0, 0.0, 0.0], "CTO", limit=1)
+        finds = kb.finds
+
+        results = await LocalVectorStore(directory=str(tmp_path)).search([0.0, 0.0, 1.0], "CTO", limit=1)
+
+        assert results[0]["title"] == "marketing"
+        assert kb.finds == finds
+
+    @pytest.mark.asyncio
+    async def test_add_and_delete_keep_partition_in_sync(self, kb, tmp_path):
+        """Test: Ingesta y borrado de un archivo se reflejan sin reconstruir."""
+        store = LocalVectorStore(directory=str(tmp_path))
+        await store.search([1.0, 0.0, 0.0], "CTO", limit=1)
+
+        await store.add([kb_doc("CTO", "nuevo", [0.0, 1.0, 0.0], file_id="f3")])
+        assert (await store.search([0.0, 1.0, 0.0], "CTO", limit=1))[0]["title"] == "nuevo"
+
+        await store.delete("CTO", source_file_id="f3")
+        titles = [r["title"] for r in await store.search([0.0, 1.0, 0.0], "CTO", limit=5)]
+        assert "nuevo" not in titles and len(titles) == 3
+        assert store.stats()["rebuilds"] == 1
+
+    @pytest.mark.asyncio
+    async def test_lexical_search_tracks_ingestion(self, kb, tmp_path):
+        """Test: El índice BM25 de la partición se actualiza al ingerir y borrar."""
+        store = LocalVectorStore(directory=str(tmp_path))
+        assert (await store.lexical_search("kubernetes", "CTO", limit=3))[0]["title"] == "kubernetes"
+
+        await store.add([kb_doc("CTO", "cláusula 4.3 SLA", [0.0, 1.0, 0.0], file_id="f3")])
+        assert (await store.lexical_search("4.3", "CTO", limit=3))[0]["title"] == "cláusula 4.3 SLA"
+
+        await store.delete("CTO", source_file_id="f3")
+        assert await store.lexical_search("4.3", "CTO", limit=3) == []
+
+    @pytest.mark.asyncio
+    async def test_delete_agent_drops_snapshot(self, kb, tmp_path):
+        """Test: Borrar el agente elimina su snapshot; la KB se relee de Mongo."""
+        store = LocalVectorStore(directory=str(tmp_path))
+        await store.search([1.0, 0.0, 0.0], "CFO", limit=1)
+
+        await store.delete("CFO")
+
+        assert not list(tmp_path.glob("CFO.*"))
+        await store.search([1.0, 0.0, 0.0], "CFO", limit=1)
+        assert store.stats()["rebuilds"] == 2
+
+
+class TestTwoStageSearch:
+    """Tests para la búsqueda en dos etapas (EMBED_SHORT_DIMS)."""
+
+    def test_shorten_renormalizes(self):
+        """Test: El vector corto son las primeras componentes con norma 1."""
+        assert vector_store.shorten([3.0, 4.0, 12.0], 2).tolist() == pytest.approx([0.6, 0.8])
+
+    @pytest.mark.asyncio
+    async def test_local_rescores_candidates_at_full_dimension(self, kb, tmp_path):
+        """Test: Los candidatos de la 1ª etapa se reordenan con el coseno completo."""
+        store = LocalVectorStore(directory=str(tmp_path), short_dims=2)
+
+        [result] = await store.search([0.1, 0.0, 1.0], "CTO", limit=1)
+
+        # Con solo 2 dimensiones "marketing" puntuaría 0; a dimensión completa es el mejor
+        assert result["title"] == "marketing"
+        assert result["score"] == pytest.approx((1 + 1.0 / (1.01 ** 0.5)) / 2, rel=1e-5)
+
+    @pytest.mark.asyncio
+    async def test_atlas_searches_short_index_and_rescores(self, monkeypatch):
+        """Test: Atlas busca en embedding_short y devuelve el orden a dimensión completa sin vectores."""
+        pipelines = []
+
+        class Knowledge:
+            def aggregate(self, pipeline):
+                pipelines.append(pipeline)
+                hits = [
+                    {"title": "corto", "embedding": [1.0, 0.0, 0.0], "score": 0.99},
+                    {"title": "completo", "embedding": [0.9, 0.0, 1.0], "score": 0.95},
+                ]
+                return SimpleNamespace(to_list=lambda length=None: asyncio.sleep(0, result=hits))
+
+        monkeypatch.setattr(vector_store, "get_knowledge_collection", lambda: Knowledge())
+        store = vector_store.AtlasVectorStore(short_dims=2)
+
+        results = await store.search([0.5, 0.0, 1.0], "CTO", limit=1)
+
+        stage = pipelines[0][0]["$vectorSearch"]
+        assert (stage["path"], stage["index"]) == ("embedding_short", vector_store.ATLAS_SHORT_INDEX_NAME)
+        assert len(decode_vector(stage["queryVector"])) == 2 and stage["limit"] == vector_store.RAG_RESCORE_FACTOR
+        assert [r["title"] for r in results] == ["completo"]
+        assert "embedding" not in results[0]
+
+
+    def test_atlas_index_definitions_are_reconciled(self):
+        """Test: Los índices que faltan se crean, los distintos se actualizan y los iguales no se tocan."""
+        wanted = vector_store.atlas_vector_indexes(short_dims=256)
+        existing = [
+            {"name": vector_store.ATLAS_INDEX_NAME, "latestDefinition": wanted[vector_store.ATLAS_INDEX_NAME]},
+        ]
+        assert vector_store.index_changes(existing, wanted) == [
+            ("create", vector_store.ATLAS_SHORT_INDEX_NAME, wanted[vector_store.ATLAS_SHORT_INDEX_NAME])
+        ]
+
+        existing.append({"name": vector_store.ATLAS_SHORT_INDEX_NAME,
+                         "latestDefinition": vector_store.atlas_vector_indexes(short_dims=512)[vector_store.ATLAS_SHORT_INDEX_NAME]})
+        assert [change[0] for change in vector_store.index_changes(existing, wanted)] == ["update"]
+
+    @pytest.mark.asyncio
+    async def test_startup_only_creates_missing_indexes(self, monkeypatch):
+        """Test: Al arrancar se crean los índices que faltan; uno existente distinto no se reconstruye salvo update=True."""
+        calls = []
+
+        class FakeCollection:
+            def list_search_indexes(self):
+                return FakeCursor([{"name": vector_store.ATLAS_INDEX_NAME, "latestDefinition": {"fields": []}}])
+
+            async def create_search_index(self, model):
+                calls.append(("create", model.document["name"]))
+
+            async def update_search_index(self, name, definition):
+                calls.append(("update", name))
+
+        monkeypatch.setattr(vector_store, "get_knowledge_collection", lambda: FakeCollection())
+        wanted = vector_store.atlas_vector_indexes(short_dims=256)
+        monkeypatch.setattr(vector_store, "atlas_vector_indexes", lambda: wanted)
+
+        changes = await vector_store.ensure_atlas_indexes()
+        assert calls == [("create", vector_store.ATLAS_SHORT_INDEX_NAME), ("create", vector_store.ATLAS_TEXT_INDEX_NAME)]
+        assert ("update", vector_store.ATLAS_INDEX_NAME) in [change[:2] for change in changes]
+
+        calls.clear()
+        await vector_store.ensure_atlas_indexes(update=True)
+        assert ("update", vector_store.ATLAS_INDEX_NAME) in calls
+
+    @pytest.mark.asyncio
+    async def test_lexical_search_waits_for_queryable_text_index(self, monkeypatch):
+        """Test: Sin índice de texto consultable no se lanza $search; se vuelve a mirar pasado el intervalo."""
+        indexes = [{"name": vector_store.ATLAS_TEXT_INDEX_NAME, "queryable": False}]
+        aggregations = []
+
+        class FakeCollection:
+            def list_search_indexes(self):
+                return FakeCursor(indexes)
+
+            def aggregate(self, pipeline):
+                aggregations.append(pipeline)
+                return FakeCursor([{"title": "bm25", "content_markdown": "x", "score": 2.0}])
+
+        monkeypatch.setattr(vector_store, "get_knowledge_collection", lambda: FakeCollection())
+        store = vector_store.AtlasVectorStore(short_dims=0)
+
+        assert await store.lexical_search("margen", "CFO", 3) == []
+        indexes[0]["queryable"] = True  # Atlas terminó de construirlo
+        assert await store.lexical_search("margen", "CFO", 3) == []
+        assert aggregations == []
+
+        monkeypatch.setattr(vector_store, "ATLAS_TEXT_INDEX_RECHECK_S", 0)
+        assert [hit["title"] for hit in await store.lexical_search("margen", "CFO", 3)] == ["bm25"]
+        assert store.stats()["text_index"] == vector_store.ATLAS_TEXT_INDEX_NAME
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "-s"])